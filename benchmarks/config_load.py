@@ -0,0 +1,79 @@
+"""Compares loading the same config from INI, YAML and TOML files.
+
+Usage: python benchmarks/config_load.py [instances]
+"""
+from __future__ import print_function, unicode_literals
+from ploy.config import Config
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+
+
+def make_conf(count):
+    lines = [
+        "[plain-instance:base]",
+        "user = root",
+        "ssh-timeout = 10",
+        "fingerprint = ignore"]
+    for i in range(count):
+        lines.extend([
+            "[plain-instance:host%s]" % i,
+            "<= base",
+            "host = 10.0.%s.%s" % (i // 256, i % 256),
+            "port = 22",
+            "roles = web db"])
+    return "\n".join(lines)
+
+
+def make_yml(count):
+    lines = [
+        "plain-instance:",
+        "    base:",
+        "        user: root",
+        "        ssh-timeout: 10",
+        "        fingerprint: ignore"]
+    for i in range(count):
+        lines.extend([
+            "    host%s:" % i,
+            "        <: base",
+            "        host: 10.0.%s.%s" % (i // 256, i % 256),
+            "        port: 22",
+            "        roles: web db"])
+    return "\n".join(lines)
+
+
+def make_toml(count):
+    lines = [
+        "[plain-instance.base]",
+        "user = \"root\"",
+        "ssh-timeout = 10",
+        "fingerprint = \"ignore\""]
+    for i in range(count):
+        lines.extend([
+            "[plain-instance.host%s]" % i,
+            "\"<\" = \"base\"",
+            "host = \"10.0.%s.%s\"" % (i // 256, i % 256),
+            "port = 22",
+            "roles = \"web db\""])
+    return "\n".join(lines)
+
+
+def main(count=5000):
+    directory = tempfile.mkdtemp()
+    try:
+        for ext, make_content in (
+                ('conf', make_conf), ('yml', make_yml), ('toml', make_toml)):
+            path = os.path.join(directory, 'ploy.%s' % ext)
+            with open(path, 'w') as f:
+                f.write(make_content(count))
+            timer = timeit.Timer(lambda: Config(path).parse())
+            best = min(timer.repeat(repeat=3, number=1))
+            print("%-4s %6.2f s for %s instances" % (ext, best, count))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main(*[int(x) for x in sys.argv[1:]])
@@ -0,0 +1,52 @@
+"""Measures the memory used by a parsed config with many instances.
+
+The generated config has one macro and the given number of plain instances
+which use it, similar to big generated setups.
+
+Usage: python benchmarks/config_memory.py [instances]
+"""
+from __future__ import print_function, unicode_literals
+from io import StringIO
+from ploy.config import Config, read_config
+import gc
+import sys
+import timeit
+import tracemalloc
+
+
+def make_content(count):
+    lines = [
+        "[plain-instance:base]",
+        "user = root",
+        "ssh-timeout = 10",
+        "fingerprint = ignore",
+        "startup_script = startup.sh"]
+    for i in range(count):
+        lines.extend([
+            "[plain-instance:host%s]" % i,
+            "<= base",
+            "host = 10.0.%s.%s" % (i // 256, i % 256),
+            "port = 22",
+            "master = default"])
+    return "\n".join(lines)
+
+
+def main(count=10000):
+    content = make_content(count)
+    gc.collect()
+    tracemalloc.start()
+    start = timeit.default_timer()
+    config = Config(StringIO(content))
+    config._parse(read_config(config.config, config.path))
+    duration = timeit.default_timer() - start
+    gc.collect()
+    (current, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print("%s instances parsed in %.2f s" % (count, duration))
+    print("memory: %.1f MiB (peak %.1f MiB), %.0f bytes per instance" % (
+        current / 1024. / 1024., peak / 1024. / 1024., current / float(count)))
+    return config
+
+
+if __name__ == '__main__':
+    main(*[int(x) for x in sys.argv[1:]])
@@ -0,0 +1,50 @@
+"""Measures the cost of writing values into config sections.
+
+Every value which isn't a ``ConfigValue`` records where it was set from,
+like plugins do in ``augment_instance``. This compares the provenance modes
+of the config.
+
+Usage: python benchmarks/config_write.py [number]
+"""
+from __future__ import print_function, unicode_literals
+from io import StringIO
+from ploy.config import Config, read_config
+import sys
+import timeit
+
+
+def make_config(provenance):
+    config = Config(StringIO("[plain-instance:foo]\nhost = localhost\n"))
+    config._parse(read_config(config.config, config.path))
+    config.provenance = provenance
+    return config
+
+
+def write(section):
+    for i in range(100):
+        section['key%s' % i] = 'value'
+
+
+def main(number=200):
+    for provenance in ('full', 'lazy', None):
+        config = make_config(provenance)
+        section = config['plain-instance']['foo']
+        timer = timeit.Timer(lambda: write(section))
+        best = min(timer.repeat(repeat=5, number=number))
+        print("provenance=%-6s %15.2f us per write" % (
+            provenance, best / (number * 100) * 1e6))
+    config = make_config('lazy')
+    section = config['plain-instance']['foo']
+    timings = []
+    for i in range(5):
+        write(section)
+        values = list(section._dict.values())
+        start = timeit.default_timer()
+        [x.src for x in values]
+        timings.append(timeit.default_timer() - start)
+    print("resolving lazy source          %8.2f us per value" % (
+        min(timings) / len(values) * 1e6))
+
+
+if __name__ == '__main__':
+    main(*[int(x) for x in sys.argv[1:]])
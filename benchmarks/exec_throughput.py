@@ -0,0 +1,122 @@
+"""Compares running commands with InstanceExecutor in threads and with
+AsyncInstanceExecutor on one event loop.
+
+An SSH server is started in the same process. It answers each command
+after the given latency in milliseconds. Every host gets its own
+connection, so the threads of paramiko's transports exist in both cases,
+only the threads waiting for the commands differ.
+
+Usage: python benchmarks/exec_throughput.py [hosts] [commands] [latency]
+"""
+from __future__ import print_function, unicode_literals
+from ploy.aio import AsyncInstanceExecutor
+from ploy.common import InstanceExecutor, run_rolling
+import asyncio
+import paramiko
+import socket
+import sys
+import threading
+import time
+
+
+class Server(paramiko.ServerInterface):
+    def __init__(self, latency):
+        self.latency = latency
+
+    def get_allowed_auths(self, username):
+        return 'none'
+
+    def check_auth_none(self, username):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_channel_exec_request(self, channel, command):
+        def reply():
+            # the client only sends stdin after the exec request succeeded,
+            # replying earlier could close the channel before that
+            while channel.recv(1024):
+                pass
+            time.sleep(self.latency)
+            channel.sendall(command + b'\n')
+            channel.send_exit_status(0)
+            channel.close()
+        threading.Thread(target=reply).start()
+        return True
+
+
+def serve(sock, host_key, latency, transports):
+    while True:
+        try:
+            (client, addr) = sock.accept()
+        except OSError:
+            return
+        transport = paramiko.Transport(client)
+        transport.add_server_key(host_key)
+        transport.start_server(server=Server(latency))
+        transports.append(transport)
+
+
+class Instance(object):
+    _ploy_forward_agent = False
+
+    def __init__(self, port, index):
+        self.uid = 'host%s' % index
+        self.transport = paramiko.Transport(('127.0.0.1', port))
+        self.transport.start_client()
+        self.transport.auth_none('bench')
+        self.conn = self
+
+    def get_transport(self):
+        return self.transport
+
+
+def run_threads(instances, commands):
+    def run(instance):
+        executor = InstanceExecutor(instance)
+        for i in range(commands):
+            executor('echo', str(i), stdin=b'', rc=0)
+    run_rolling(run, instances, len(instances))
+
+
+def run_async(instances, commands):
+    async def run(instance):
+        executor = AsyncInstanceExecutor(instance)
+        for i in range(commands):
+            await executor('echo', str(i), stdin=b'', rc=0)
+
+    async def main():
+        await asyncio.gather(*(run(x) for x in instances))
+
+    asyncio.run(main())
+
+
+def main(hosts=100, commands=5, latency=50):
+    host_key = paramiko.RSAKey.generate(2048)
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(hosts)
+    transports = []
+    server = threading.Thread(
+        target=serve, args=(sock, host_key, latency / 1000.0, transports))
+    server.daemon = True
+    server.start()
+    instances = [Instance(sock.getsockname()[1], i) for i in range(hosts)]
+    try:
+        for name, func in (('threads', run_threads), ('asyncio', run_async)):
+            start = time.time()
+            func(instances, commands)
+            duration = time.time() - start
+            print("%-8s %6.2f s %8.1f commands/s for %s hosts" % (
+                name, duration, hosts * commands / duration, hosts))
+    finally:
+        for instance in instances:
+            instance.transport.close()
+        for transport in transports:
+            transport.close()
+        sock.close()
+
+
+if __name__ == '__main__':
+    main(*[int(x) for x in sys.argv[1:]])
@@ -0,0 +1,54 @@
+"""Measures looking up a single instance in a config with many instances.
+
+This is what most commands do, like ``ploy ssh host0``. The config is
+cached after the first run, so mostly the creation of the masters and the
+instance index is measured.
+
+Usage: python benchmarks/instance_lookup.py [instances]
+"""
+from __future__ import print_function, unicode_literals
+from ploy import Controller
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+
+
+def make_content(count):
+    lines = [
+        "[plain-instance:base]",
+        "user = root",
+        "ssh-timeout = 10",
+        "fingerprint = ignore"]
+    for i in range(count):
+        lines.extend([
+            "[plain-instance:host%s]" % i,
+            "<= base",
+            "host = 10.0.%s.%s" % (i // 256, i % 256),
+            "port = 22"])
+    return "\n".join(lines)
+
+
+def lookup(path):
+    ctrl = Controller(configpath=os.path.dirname(path))
+    ctrl.configfile = path
+    return ctrl.instances['host0']
+
+
+def main(count=5000):
+    directory = tempfile.mkdtemp()
+    os.environ['PLOY_CACHE_DIR'] = os.path.join(directory, 'cache')
+    try:
+        path = os.path.join(directory, 'ploy.conf')
+        with open(path, 'w') as f:
+            f.write(make_content(count))
+        timer = timeit.Timer(lambda: lookup(path))
+        best = min(timer.repeat(repeat=3, number=1))
+        print("%6.3f s for one of %s instances" % (best, count))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main(*[int(x) for x in sys.argv[1:]])
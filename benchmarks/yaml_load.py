@@ -0,0 +1,51 @@
+"""Compares the safe and round trip loaders for YAML configs.
+
+Usage: python benchmarks/yaml_load.py [instances]
+"""
+from __future__ import print_function, unicode_literals
+from ploy.config import read_yml_config
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+
+
+def make_content(count):
+    lines = [
+        "plain-instance:",
+        "    base:",
+        "        user: root",
+        "        ssh-timeout: 10",
+        "        fingerprint: ignore"]
+    for i in range(count):
+        lines.extend([
+            "    host%s:" % i,
+            "        # instance %s" % i,
+            "        <: base",
+            "        host: 10.0.%s.%s" % (i // 256, i % 256),
+            "        port: 22",
+            "        roles:",
+            "            - web",
+            "            - db"])
+    return "\n".join(lines)
+
+
+def main(count=5000):
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'ploy.yml')
+        with open(path, 'w') as f:
+            f.write(make_content(count))
+        for round_trip in (True, False):
+            timer = timeit.Timer(
+                lambda: read_yml_config(path, None, round_trip=round_trip))
+            best = min(timer.repeat(repeat=3, number=1))
+            print("round_trip=%-5s %6.2f s for %s instances" % (
+                round_trip, best, count))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main(*[int(x) for x in sys.argv[1:]])
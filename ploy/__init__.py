@@ -1,8 +1,8 @@
 from __future__ import print_function, unicode_literals
 try:
-    from collections.abc import MutableMapping
+    from collections.abc import Mapping, MutableMapping
 except ImportError:
-    from collections import MutableMapping
+    from collections import Mapping, MutableMapping
 try:
     from importlib.metadata import PackageNotFoundError
     from importlib.metadata import distribution
@@ -11,18 +11,26 @@ except ImportError:
     from importlib_metadata import PackageNotFoundError
     from importlib_metadata import distribution
     from importlib_metadata import entry_points
+from functools import partial
+from io import BytesIO
 from lazy import lazy
 from ploy import hookspecs, template
-from ploy.common import InstanceExecutor
+from ploy.common import InstanceExecutor, PrefixedOutput
+from ploy.common import batch_size, get_batch_size, run_rolling
 from ploy.common import sorted_choices
 from pluggy import PluginManager
 from traceback import format_exc
+import attr
+import fnmatch
+import json
 import logging
 import argparse
 import os
-import paramiko
 import socket
 import sys
+import tempfile
+import threading
+import time
 import weakref
 
 
@@ -62,27 +70,332 @@ def versionaction_factory(ctrl):
     return VersionAction
 
 
+IMPORT_PROFILE_MARKER = 'ploy-import-profile:'
+IMPORT_PROFILE_SCRIPT = '''
+import sys
+sys.stderr.write('%(marker)s ploy\\n')
+import ploy
+for entrypoint in ploy.iter_entry_points('ploy.plugins'):
+    sys.stderr.write('%(marker)s plugin %%s\\n' %% entrypoint.name)
+    entrypoint.load()
+''' % dict(marker=IMPORT_PROFILE_MARKER)
+
+
+def parse_import_profile(lines):
+    """ Parses the output of ``python -X importtime`` with the markers of
+        ``IMPORT_PROFILE_SCRIPT``.
+
+        Returns a list of ``(section, imports)`` tuples, where ``imports``
+        is a list of ``(module, self, cumulative)`` for the modules which
+        were imported in that section. The times are in microseconds.
+    """
+    sections = []
+    imports = None
+    for line in lines:
+        if line.startswith(IMPORT_PROFILE_MARKER):
+            imports = []
+            sections.append((line[len(IMPORT_PROFILE_MARKER):].strip(), imports))
+            continue
+        if imports is None or not line.startswith('import time:'):
+            continue
+        parts = line[len('import time:'):].split('|')
+        if len(parts) != 3 or not parts[0].strip().isdigit():
+            continue
+        imports.append((
+            parts[2].strip(), int(parts[0]), int(parts[1])))
+    return sections
+
+
+def importprofileaction_factory(ctrl):
+    class ImportProfileAction(argparse.Action):
+        def __init__(self, *args, **kw):
+            kw['nargs'] = 0
+            argparse.Action.__init__(self, *args, **kw)
+
+        def __call__(self, parser, namespace, values, option_string=None):
+            import subprocess
+            if sys.version_info < (3, 7):
+                log.error("The import profile needs Python 3.7 or newer.")
+                sys.exit(1)
+            env = dict(os.environ)
+            env['PYTHONPATH'] = os.pathsep.join(sys.path)
+            proc = subprocess.Popen(
+                [sys.executable, '-X', 'importtime', '-c', IMPORT_PROFILE_SCRIPT],
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env,
+                universal_newlines=True)
+            (stdout, stderr) = proc.communicate()
+            if proc.returncode:
+                log.error("Profiling the imports failed:\n%s" % stderr)
+                sys.exit(1)
+            for section, imports in parse_import_profile(stderr.splitlines()):
+                packages = {}
+                for name, self_time, cumulative in imports:
+                    package = name.split('.')[0]
+                    packages[package] = packages.get(package, 0) + self_time
+                total = sum(packages.values())
+                print("%-40s %9.1f ms" % (section, total / 1000.0))
+                packages = sorted(packages.items(), key=lambda x: (-x[1], x[0]))
+                for package, self_time in packages[:10]:
+                    print("    %-36s %9.1f ms" % (package, self_time / 1000.0))
+            sys.exit(0)
+    return ImportProfileAction
+
+
+# plugin keys with data, which is stored in the manifest
+PLUGIN_DATA_KEYS = ('augmented_commands',)
+
+
+def get_plugin_data(plugin):
+    return dict(
+        (x, sorted(plugin[x])) for x in PLUGIN_DATA_KEYS if x in plugin)
+
+
+def iter_entry_points(group):
+    eps = entry_points()
+    if hasattr(eps, 'select'):
+        return iter(eps.select(group=group))
+    return iter(eps.get(group, ()))
+
+
+def _no_capability(*args, **kw):
+    return ()
+
+
+class LazyPlugin(Mapping):
+    """ A plugin which is only imported when one of its capabilities is
+        used.
+
+        The capabilities are the keys of the plugin dict, checking for them
+        doesn't import the plugin. Neither does reading the ``data`` keys,
+        which are stored in the manifest.
+    """
+    def __init__(self, entrypoint, capabilities, plugin=None, data=None):
+        self.entrypoint = entrypoint
+        self.capabilities = capabilities
+        self.data = {} if data is None else data
+        self._plugin = plugin
+
+    @property
+    def plugin(self):
+        if self._plugin is None:
+            try:
+                self._plugin = self.entrypoint.load()
+            except Exception as e:
+                log.error(
+                    "Plugin %r could not be loaded: %s" % (self.entrypoint.name, e))
+                # the same as a plugin without manifest entry failing to load
+                self.capabilities = []
+                self.data = {}
+                self._plugin = {}
+        return self._plugin
+
+    def __getitem__(self, key):
+        if key not in self.capabilities:
+            raise KeyError(key)
+        if key in self.data:
+            return self.data[key]
+        plugin = self.plugin
+        if not self.capabilities:
+            # the capability was checked before the plugin failed to load
+            return _no_capability
+        return plugin[key]
+
+    def __contains__(self, key):
+        return key in self.capabilities
+
+    def __iter__(self):
+        return iter(self.capabilities)
+
+    def __len__(self):
+        return len(self.capabilities)
+
+
+class PluginManifest(object):
+    """ Stores the capabilities of installed plugins on disk.
+
+        The capabilities and data of a plugin are reused as long as the name
+        and version of the distribution providing it and its entry point stay
+        the same.
+    """
+    version = 2
+
+    def __init__(self, cache_dir=None):
+        from .config import get_cache_dir
+        if cache_dir is None:
+            cache_dir = get_cache_dir()
+        self.cache_dir = cache_dir
+        self.path = None
+        if cache_dir is not None:
+            self.path = os.path.join(cache_dir, 'plugins.json')
+        self.plugins = {}
+        self.changed = False
+
+    def get_key(self, entrypoint):
+        dist = getattr(entrypoint, 'dist', None)
+        version = getattr(dist, 'version', None)
+        if version is None:
+            return
+        return [
+            self.version, list(sys.version_info[:2]),
+            entrypoint.name, entrypoint.value, dist.name, version]
+
+    def load(self):
+        if self.path is None:
+            return self
+        try:
+            with open(self.path) as f:
+                self.plugins = json.load(f)
+        except Exception as e:
+            if os.path.exists(self.path):
+                log.debug("Couldn't read plugin manifest '%s': %s", self.path, e)
+        return self
+
+    def get(self, entrypoint):
+        """ Returns a tuple of the capabilities and data of the plugin or
+            ``None``. """
+        key = self.get_key(entrypoint)
+        info = self.plugins.get(entrypoint.name)
+        if key is None or info is None or info['key'] != key:
+            return
+        return (info['capabilities'], info['data'])
+
+    def add(self, entrypoint, capabilities, data):
+        key = self.get_key(entrypoint)
+        if key is None:
+            return
+        self.plugins[entrypoint.name] = dict(
+            key=key, capabilities=capabilities, data=data)
+        self.changed = True
+
+    def save(self, names):
+        for name in set(self.plugins).difference(names):
+            del self.plugins[name]
+            self.changed = True
+        if self.path is None or not self.changed:
+            return
+        tmp = None
+        try:
+            if not os.path.exists(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            (fd, tmp) = tempfile.mkstemp(dir=self.cache_dir)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self.plugins, f)
+            getattr(os, 'replace', os.rename)(tmp, self.path)
+        except Exception as e:
+            log.debug("Couldn't write plugin manifest '%s': %s", self.path, e)
+            if tmp is not None and os.path.exists(tmp):
+                os.remove(tmp)
+
+
 class LazyInstanceDict(MutableMapping):
+    """ The instances of all masters by uid and unique short names.
+
+        The index maps the names to the master and the id of the instance,
+        which is only created and augmented when it's accessed.
+
+        The names of instances supporting a command are looked up by the
+        class of the instances and cached per command. Instances are only
+        augmented to check for commands their class doesn't have, if a
+        plugin may add those in ``augment_instance``.
+    """
     def __init__(self, ctrl):
         self._cache = dict()
+        self._capabilities = dict()
+        self._commands = dict()
         self._dict = dict()
+        self._index = dict()
         self.ctrl = weakref.ref(ctrl)
 
+    def add_index(self, key, master, sid):
+        self._dict.pop(key, None)
+        self._cache.pop(key, None)
+        self._commands.clear()
+        self._index[key] = (master, sid)
+
+    def _is_augmented(self, command):
+        # whether any plugin may add the command in augment_instance,
+        # plugins which don't declare their commands may add any
+        for plugin in self.plugins.values():
+            if 'augment_instance' not in plugin:
+                continue
+            if command in plugin.get('augmented_commands', (command,)):
+                return True
+        return False
+
+    def supports(self, key, command):
+        """ Returns whether the instance supports the command.
+
+            The instance is only created and augmented if its class doesn't
+            have the command and a plugin may add it.
+        """
+        if key in self._cache:
+            return getattr(self._cache[key], command, None) is not None
+        instance = self._dict.get(key)
+        if instance is None:
+            if key not in self._index:
+                return False
+            (master, sid) = self._index[key]
+            instance = master.instances.get_created(sid)
+            if instance is None:
+                instance_class = master.instances.get_class(sid)
+                if getattr(instance_class, '__getattr__', None) is not None:
+                    # the attributes are looked up on another object, as
+                    # with proxies
+                    instance = self._get_instance(key)
+        if instance is not None:
+            if getattr(instance, command, None) is not None:
+                return True
+        else:
+            capability = (instance_class, command)
+            if capability not in self._capabilities:
+                self._capabilities[capability] = getattr(
+                    instance_class, command, None) is not None
+            if self._capabilities[capability]:
+                return True
+        if not self._is_augmented(command):
+            return False
+        return getattr(self[key], command, None) is not None
+
+    def get_uid(self, key):
+        """ Returns the uid of the instance, without creating it. """
+        instance = self._dict.get(key)
+        if instance is None:
+            (master, sid) = self._index[key]
+            instance = master.instances.get_created(sid)
+            if instance is None:
+                return "%s-%s" % (master.id, sid)
+        return instance.uid
+
+    def get_supporting(self, command):
+        """ Returns the sorted names of the instances which support the
+            command. """
+        keys = self._commands.get(command)
+        if keys is None:
+            keys = self._commands[command] = sorted(
+                x for x in self.keys() if self.supports(x, command))
+        return keys
+
+    def _get_instance(self, key):
+        # returns the instance without augmenting it
+        instance = self._dict.get(key)
+        if instance is None and key in self._index:
+            (master, sid) = self._index[key]
+            instance = self._dict[key] = master.instances[sid]
+        return instance
+
     def __getitem__(self, key):
         if key in self._cache:
             return self._cache[key]
-        try:
-            instance = self._dict[key]
-        except KeyError:
+        instance = self._get_instance(key)
+        if instance is None:
             ctrl = self.ctrl()
-            candidates = []
-            for sectionname, section in ctrl.config.items():
-                if key in section:
-                    candidates.append("    %s:%s" % (sectionname, key))
+            candidates = [
+                "    %s:%s" % (sectiongroupname, key)
+                for sectiongroupname in ctrl.config.get_section_groups(key)]
             if candidates:
                 log.error("Instance '%s' not found. Did you forget to install a plugin? The following sections might match:\n%s" % (
                     key, "\n".join(candidates)))
-            raise
+            raise KeyError(key)
         get_massagers = getattr(instance, 'get_massagers', lambda: [])
         for massager in get_massagers():
             instance.config.add_massager(massager)
@@ -94,26 +407,117 @@ class LazyInstanceDict(MutableMapping):
         return instance
 
     def __setitem__(self, key, value):
+        self._commands.clear()
         self._dict[key] = value
 
     def __delitem__(self, key):
-        del self._dict[key]
+        if key not in self._dict and key not in self._index:
+            raise KeyError(key)
+        self._commands.clear()
+        self._dict.pop(key, None)
+        self._index.pop(key, None)
         self._cache.pop(key, None)
 
     def keys(self):
-        return self._dict.keys()
+        keys = list(self._index)
+        keys.extend(x for x in self._dict if x not in self._index)
+        return keys
 
     def close_connections(self):
         for instance_id in self._cache:
             self[instance_id].close_conn()
 
     def __len__(self):
-        return len(self._dict)
+        return len(self.keys())
 
     def __iter__(self):
         return iter(self.keys())
 
 
+@attr.s(slots=True)
+class ConfigChanges(object):
+    """ The result of ``Controller.reload_config``.
+
+        The ``sections`` are (sectiongroupname, sectionname) tuples, the
+        ``masters`` are ids and the ``instances`` uids of the ones which were
+        added, changed or removed.
+    """
+    sections = attr.ib()
+    masters = attr.ib()
+    instances = attr.ib()
+
+
+class InstanceChoices(Mapping):
+    """ The instances which support a command.
+
+        Checking for an instance only looks at that instance, so it can be
+        used as ``choices`` for arguments. Iterating returns the sorted
+        names of all matching instances. Neither creates or augments any
+        instance, that only happens when one is accessed.
+    """
+    def __init__(self, instances, command):
+        self.instances = instances
+        self.command = command
+
+    def __contains__(self, key):
+        return self.instances.supports(key, self.command)
+
+    def __getitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        return self.instances[key]
+
+    def __iter__(self):
+        return iter(self.instances.get_supporting(self.command))
+
+    def __len__(self):
+        return len(self.instances.get_supporting(self.command))
+
+
+class CommandDict(Mapping):
+    """ The commands of the controller and its plugins.
+
+        The built in commands are available right away, the ones of plugins
+        are only collected when a name isn't a built in command or all
+        commands are needed.
+    """
+    def __init__(self, ctrl):
+        self.ctrl = weakref.ref(ctrl)
+        self._builtin = dict(
+            (x[4:], getattr(ctrl, x))
+            for x in dir(ctrl) if x.startswith('cmd_'))
+        self._all = None
+
+    @property
+    def all(self):
+        if self._all is None:
+            cmds = dict(self._builtin)
+            for pluginname, plugin in self.ctrl().plugins.items():
+                if 'get_commands' not in plugin:
+                    continue
+                for cmd, func in plugin['get_commands'](self.ctrl()):
+                    if cmd in cmds:
+                        log.error("Command name '%s' of '%s' conflicts with existing command name.", cmd, pluginname)
+                        sys.exit(1)
+                    cmds[cmd] = func
+            self._all = cmds
+        return self._all
+
+    def __getitem__(self, key):
+        if key in self._builtin:
+            return self._builtin[key]
+        return self.all[key]
+
+    def __contains__(self, key):
+        return key in self._builtin or key in self.all
+
+    def __iter__(self):
+        return iter(self.all)
+
+    def __len__(self):
+        return len(self.all)
+
+
 class Controller(object):
     def __init__(self, configpath=None, configname=None, progname=None):
         logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
@@ -128,14 +532,24 @@ class Controller(object):
         if progname is None:
             progname = 'ploy'
         self.progname = progname
+        # set by commands which dump the config again before it's loaded
+        self.config_round_trip = False
+        # set by long running processes which reload the config
+        self.config_watch = False
+        self._config_parsed = {}
+        self._config_sections = None
+        self._config_signature = None
         self.pm = PluginManager('ploy')
         self.pm.add_hookspecs(hookspecs)
 
     @lazy
     def hook(self):
-        from .config import ConfigPlugin, YamlConfigPlugin
+        from .config import ConfigPlugin, SnapshotConfigPlugin
+        from .config import TomlConfigPlugin, YamlConfigPlugin
         self.pm.register(ConfigPlugin())
         self.pm.register(YamlConfigPlugin())
+        self.pm.register(TomlConfigPlugin())
+        self.pm.register(SnapshotConfigPlugin())
         for pluginname, plugin in self.plugins.items():
             pass
         self.pm.check_pending()
@@ -145,7 +559,14 @@ class Controller(object):
     def plugins(self):
         plugins = {}
         group = 'ploy.plugins'
-        for entrypoint in entry_points()[group]:
+        manifest = PluginManifest().load()
+        for entrypoint in iter_entry_points(group):
+            info = manifest.get(entrypoint)
+            if info is not None:
+                (capabilities, data) = info
+                plugins[entrypoint.name] = LazyPlugin(
+                    entrypoint, capabilities, data=data)
+                continue
             try:
                 plugin = entrypoint.load()
             except PackageNotFoundError:
@@ -154,7 +575,12 @@ class Controller(object):
                 log.error(
                     "Plugin %r could not be loaded: %s" % (entrypoint.name, e))
                 continue
-            plugins[entrypoint.name] = plugin
+            capabilities = sorted(plugin)
+            data = get_plugin_data(plugin)
+            manifest.add(entrypoint, capabilities, data)
+            plugins[entrypoint.name] = LazyPlugin(
+                entrypoint, capabilities, plugin, data)
+        manifest.save(plugins)
         return plugins
 
     @lazy
@@ -164,7 +590,127 @@ class Controller(object):
             log.error("Config '%s' doesn't exist." % configpath)
             sys.exit(1)
         plugins = self.plugins
-        return self.hook.ploy_load_config(fn=configpath, plugins=plugins)
+        config = self.hook.ploy_load_config(
+            fn=configpath, plugins=plugins,
+            round_trip=self.config_round_trip,
+            parsed=self._config_parsed if self.config_watch else None)
+        config.compile_schemas()
+        if self.config_watch:
+            from .config import _get_config_sections
+            from .config import _get_files_signature
+            self._config_sections = _get_config_sections(config._get_state())
+            self._config_signature = _get_files_signature(config.files)
+        return config
+
+    def _get_changed_instances(self, old_masters, changed):
+        # reuses the old instances which didn't change in the new masters
+        reused = set()
+        masters = set()
+        instances = set()
+        keys = {}
+        for key, (master, sid) in self.instances._index.items():
+            keys.setdefault((master.id, sid), []).append(key)
+        for master in self.masters.values():
+            old_master = old_masters.get(master.id)
+            section = master.master_config
+            if old_master is None or old_master.__class__ is not master.__class__:
+                old_master = None
+            elif (section.sectiongroupname, section.sectionname) in changed:
+                old_master = None
+            if old_master is None:
+                masters.add(master.id)
+            for sid, instance in list(master.instances.items()):
+                old_instance = None
+                if old_master is not None:
+                    old_instance = old_master.instances.get(sid)
+                sectiongroupnames = (
+                    'instance', instance.sectiongroupname,
+                    instance.__class__.sectiongroupname)
+                if old_instance is None or old_instance.__class__ is not instance.__class__:
+                    old_instance = None
+                elif any((x, sid) in changed for x in sectiongroupnames):
+                    old_instance = None
+                if old_instance is None:
+                    instances.add(instance.uid)
+                    continue
+                old_instance.master = master
+                # the old config is gone, but its section keeps the changes
+                # made by plugins when the instance was augmented
+                self.config._adopt_section(
+                    instance.__class__.sectiongroupname, sid,
+                    old_instance.config)
+                master.instances[sid] = old_instance
+                reused.add(id(old_instance))
+                for key in keys.get((master.id, sid), ()):
+                    self.instances[key] = old_instance
+                    self.instances._cache[key] = old_instance
+        for old_master in old_masters.values():
+            if old_master.id not in self.masters:
+                masters.add(old_master.id)
+            for old_instance in old_master.instances.values():
+                if id(old_instance) in reused:
+                    continue
+                instances.add(old_instance.uid)
+                old_instance.close_conn()
+        return (sorted(masters), sorted(instances))
+
+    def reload_config(self, callback=None):
+        """ Loads the config again if any of its files changed.
+
+            Only files which changed are parsed again. Masters and instances
+            whose sections were added, changed or removed are created again,
+            the others are kept including their connections.
+
+            Returns a ``ConfigChanges`` instance, which is also passed to
+            ``callback``, or ``None`` if nothing changed. Unless
+            ``config_watch`` was set before the config was loaded, the first
+            reload treats everything as changed.
+        """
+        from .config import _diff_config_sections
+        from .config import _get_files_signature
+        if 'config' not in self.__dict__:
+            return
+        try:
+            signature = _get_files_signature(self.config.files)
+        except OSError:
+            signature = None
+        if signature is not None and signature == self._config_signature:
+            return
+        old_sections = self._config_sections
+        old = dict(
+            (x, self.__dict__.pop(x))
+            for x in ('config', 'known_hosts', 'masters', 'instances')
+            if x in self.__dict__)
+        self.config_watch = True
+        try:
+            self.config
+        except SystemExit:
+            log.error("Keeping the previous config.")
+            self.__dict__.update(old)
+            self._config_signature = signature
+            return
+        if old_sections is None:
+            sections = sorted(x for x in self._config_sections if x is not None)
+        else:
+            sections = _diff_config_sections(
+                old_sections, self._config_sections)
+        (masters, instances) = self._get_changed_instances(
+            old.get('masters', {}), set(sections))
+        changes = ConfigChanges(
+            sections=sections, masters=masters, instances=instances)
+        if callback is not None:
+            callback(changes)
+        return changes
+
+    def watch_config(self, callback=None, interval=2, stop=None):
+        """ Calls ``reload_config`` every ``interval`` seconds until the
+            ``stop`` event is set.
+        """
+        if stop is None:
+            stop = threading.Event()
+        self.config_watch = True
+        while not stop.wait(interval):
+            self.reload_config(callback=callback)
 
     @lazy
     def masters(self):
@@ -178,6 +724,15 @@ class Controller(object):
                     result[master.id] = master
         return result
 
+    @lazy
+    def list_cmds(self):
+        list_cmds = {}
+        for pluginname, plugin in self.plugins.items():
+            if 'get_list_commands' in plugin:
+                for cmd, func in plugin['get_list_commands'](self):
+                    list_cmds.setdefault(cmd, []).append((pluginname, func))
+        return list_cmds
+
     @lazy
     def known_hosts(self):
         return os.path.join(self.config.path, 'known_hosts')
@@ -210,30 +765,151 @@ class Controller(object):
                 if instance_class is None:
                     log.error("Master '%s' has no default instance class." % (master.id))
                     sys.exit(1)
-                config.setdefault(instance_class.sectiongroupname, iconfig.__class__())
-                config[instance_class.sectiongroupname][instance_id] = iconfig.copy()
-                instance = instance_class(master, instance_id, config[instance_class.sectiongroupname][instance_id])
-                master.instances[instance_id] = instance
+                master.instances.add_factory(instance_id, partial(
+                    self._create_instance,
+                    master, instance_class, instance_id, iconfig),
+                    instance_class)
+        # only the names are indexed, the instances are created on access
         shortname_map = {}
         for master in self.masters.values():
             for instance_id in master.instances:
-                instance = master.instances[instance_id]
-                key = instance.uid
-                result[key] = instance
-                shortname_map.setdefault(instance_id, []).append(instance)
+                instance = master.instances.get_created(instance_id)
+                if instance is None:
+                    key = "%s-%s" % (master.id, instance_id)
+                else:
+                    key = instance.uid
+                result.add_index(key, master, instance_id)
+                shortname_map.setdefault(instance_id, []).append(
+                    (master, instance_id))
         for shortname, instances in shortname_map.items():
             if len(instances) == 1:
-                result[shortname] = instances[0]
+                result.add_index(shortname, *instances[0])
         result.plugins = self.plugins
         return result
 
+    def _create_instance(self, master, instance_class, instance_id, iconfig):
+        config = self.config
+        config.setdefault(instance_class.sectiongroupname, iconfig.__class__())
+        config[instance_class.sectiongroupname][instance_id] = iconfig.copy()
+        return instance_class(master, instance_id, config[instance_class.sectiongroupname][instance_id])
+
     def get_instances(self, command):
-        instances = {}
-        for instance_id in self.instances:
-            instance = self.instances[instance_id]
-            if getattr(instance, command, None) is not None:
-                instances[instance_id] = instance
-        return instances
+        return InstanceChoices(self.instances, command)
+
+    def select_instances(self, command, names=(), masters=(), groups=()):
+        """ Returns the sorted uids of the instances supporting the command,
+            which match any of the names or glob patterns, belong to one of
+            the masters or come from one of the section groups.
+
+            Logs an error and exits if a name or selector matches nothing.
+        """
+        instances = self.get_instances(command)
+        uids = set()
+        for name in names:
+            if name in instances:
+                uids.add(self.instances.get_uid(name))
+                continue
+            matches = [x for x in instances if fnmatch.fnmatchcase(x, name)]
+            if not matches:
+                log.error("No instance matches '%s'." % name)
+                sys.exit(1)
+            uids.update(self.instances.get_uid(x) for x in matches)
+        index = self.instances._index
+        for master_id in masters:
+            master = self.masters.get(master_id)
+            if master is None:
+                log.error("Master '%s' not found." % master_id)
+                sys.exit(1)
+            matches = [
+                x for x in instances
+                if x in index and index[x][0] is master]
+            if not matches:
+                log.error("Master '%s' has no instances for this command." % master_id)
+                sys.exit(1)
+            uids.update(self.instances.get_uid(x) for x in matches)
+        for group in groups:
+            matches = [
+                x for x in instances
+                if self.instances._get_instance(x).sectiongroupname == group]
+            if not matches:
+                log.error("Section group '%s' has no instances for this command." % group)
+                sys.exit(1)
+            uids.update(self.instances.get_uid(x) for x in matches)
+        return sorted(uids)
+
+    def _add_instances_argument(self, parser, instances):
+        parser.add_argument("instance", nargs="+",
+                            metavar="instance",
+                            help="Name of the instance from the config.",
+                            type=str,
+                            choices=instances)
+        self._add_rolling_arguments(parser)
+
+    def _add_rolling_arguments(self, parser):
+        parser.add_argument("-j", "--jobs", type=batch_size, default='10',
+                            help="Number or percentage of instances to process at the same time, the next one is started as soon as one is done")
+        parser.add_argument("--canary", type=int, default=0,
+                            help="Number of instances to process first, nothing else is started if one of them fails")
+        parser.add_argument("--max-failures", type=int, default=None,
+                            help="Don't start more instances once more than this number failed")
+        parser.add_argument("--pause", type=float, default=0,
+                            help="Seconds to wait before starting the next instance")
+
+    def _run_rolling(self, args, func, items, failed):
+        return run_rolling(
+            func, items, get_batch_size(args.jobs, len(items)),
+            canary=args.canary, max_failures=args.max_failures,
+            pause=args.pause, failed=failed)
+
+    def _get_selected_instances(self, instances, names):
+        # the same instance might be given by uid and short name
+        result = []
+        uids = set()
+        for name in names:
+            uid = self.instances.get_uid(name)
+            if uid in uids:
+                continue
+            uids.add(uid)
+            result.append(instances[name])
+        return result
+
+    def _fan_out(self, instances, func, args):
+        """ Calls ``func`` for each instance. Several instances are processed
+            concurrently using the rolling options in ``args``, afterwards a
+            summary is printed and the exit code is 1 if any of them failed
+            or were skipped.
+        """
+        if len(instances) == 1:
+            func(instances[0])
+            return
+
+        def run(instance):
+            start = time.time()
+            error = None
+            try:
+                func(instance)
+            except SystemExit:
+                # the reason was already logged
+                error = "exited"
+            except Exception as e:
+                log.exception("Error for instance '%s':" % instance.uid)
+                error = str(e) or e.__class__.__name__
+            return (instance.uid, error, time.time() - start)
+
+        results = self._run_rolling(
+            args, run, instances, lambda x: x[1] is not None)
+        width = max(len(x.uid) for x in instances)
+        print("%s  result   time" % "instance".ljust(width))
+        for instance, result in zip(instances, results):
+            if result is None:
+                print("%s  skipped" % instance.uid.ljust(width))
+                continue
+            (uid, error, duration) = result
+            print("%s  %-7s  %5.1f s%s" % (
+                uid.ljust(width), "failed" if error else "ok", duration,
+                "" if error is None else "  %s" % error))
+        if any(x is None or x[1] is not None for x in results):
+            sys.exit(1)
 
     def cmd_status(self, argv, help):
         """Prints status"""
@@ -242,14 +918,11 @@ class Controller(object):
             description=help,
         )
         instances = self.get_instances(command='status')
-        parser.add_argument("instance", nargs=1,
-                            metavar="instance",
-                            help="Name of the instance from the config.",
-                            type=str,
-                            choices=sorted_choices(instances))
+        self._add_instances_argument(parser, instances)
         args = parser.parse_args(argv)
-        instance = instances[args.instance[0]]
-        instance.status()
+        self._fan_out(
+            self._get_selected_instances(instances, args.instance),
+            lambda instance: instance.status(), args)
 
     def cmd_stop(self, argv, help):
         """Stops the instance"""
@@ -258,14 +931,11 @@ class Controller(object):
             description=help,
         )
         instances = self.get_instances(command='stop')
-        parser.add_argument("instance", nargs=1,
-                            metavar="instance",
-                            help="Name of the instance from the config.",
-                            type=str,
-                            choices=sorted_choices(instances))
+        self._add_instances_argument(parser, instances)
         args = parser.parse_args(argv)
-        instance = instances[args.instance[0]]
-        instance.stop()
+        self._fan_out(
+            self._get_selected_instances(instances, args.instance),
+            lambda instance: instance.stop(), args)
 
     def cmd_terminate(self, argv, help):
         """Terminates the instance"""
@@ -275,18 +945,23 @@ class Controller(object):
             description=help,
         )
         instances = self.get_instances(command='terminate')
-        parser.add_argument("instance", nargs=1,
-                            metavar="instance",
-                            help="Name of the instance from the config.",
-                            type=str,
-                            choices=sorted_choices(instances))
+        self._add_instances_argument(parser, instances)
         args = parser.parse_args(argv)
-        instance = instances[args.instance[0]]
-        if not yesno("Are you sure you want to terminate '%s'?" % instance.config_id):
+        selected = self._get_selected_instances(instances, args.instance)
+        if len(selected) == 1:
+            question = "Are you sure you want to terminate '%s'?" % selected[0].config_id
+        else:
+            question = "Are you sure you want to terminate %s instances (%s)?" % (
+                len(selected), ", ".join("'%s'" % x.config_id for x in selected))
+        if not yesno(question):
             return
-        instance.hooks.before_terminate(instance)
-        instance.terminate()
-        instance.hooks.after_terminate(instance)
+
+        def terminate(instance):
+            instance.hooks.before_terminate(instance)
+            instance.terminate()
+            instance.hooks.after_terminate(instance)
+
+        self._fan_out(selected, terminate, args)
 
     def _parse_overrides(self, options):
         overrides = dict()
@@ -311,24 +986,25 @@ class Controller(object):
             description=help,
         )
         instances = self.get_instances(command='start')
-        parser.add_argument("instance", nargs=1,
-                            metavar="instance",
-                            help="Name of the instance from the config.",
-                            type=str,
-                            choices=sorted_choices(instances))
+        self._add_instances_argument(parser, instances)
         parser.add_argument("-o", "--override", nargs="*", type=str,
                             dest="overrides", metavar="OVERRIDE",
                             help="Option to override in instance config for startup script (name=value).")
         args = parser.parse_args(argv)
         overrides = self._parse_overrides(args)
         overrides['instances'] = self.instances
-        instance = instances[args.instance[0]]
-        instance.hooks.before_start(instance)
-        result = instance.start(overrides)
-        instance.hooks.after_start(instance)
-        if result is None:
-            return
-        instance.status()
+
+        def start(instance):
+            instance.hooks.before_start(instance)
+            result = instance.start(dict(overrides))
+            instance.hooks.after_start(instance)
+            if result is None:
+                return
+            instance.status()
+
+        self._fan_out(
+            self._get_selected_instances(instances, args.instance),
+            start, args)
 
     def cmd_annotate(self, argv, help):
         """Prints annotated config"""
@@ -337,6 +1013,7 @@ class Controller(object):
             description=help,
         )
         parser.parse_args(argv)
+        self.config.provenance = 'full'
         list(self.instances.values())  # trigger instance augmentation
         for global_section in sorted(self.config):
             for sectionname in sorted(self.config[global_section]):
@@ -353,9 +1030,36 @@ class Controller(object):
             prog="%s annotate" % self.progname,
             description=help,
         )
-        parser.parse_args(argv)
+        parser.add_argument("-j", "--jobs", dest="jobs",
+                            type=int, default=4,
+                            help="Number of files to render and write at the same time.")
+        args = parser.parse_args(argv)
+        self.config_round_trip = True
+        self.config.provenance = 'full'
         list(self.instances.values())  # trigger instance augmentation
-        self.config.dump_yaml()
+        self.config.dump_yaml(workers=args.jobs)
+
+    def cmd_conf2snapshot(self, argv, help):
+        """Writes a binary snapshot of the expanded config"""
+        parser = argparse.ArgumentParser(
+            prog="%s conf2snapshot" % self.progname,
+            description=help,
+        )
+        parser.add_argument("snapshot", nargs=1,
+                            metavar="snapshot",
+                            help="Name of the snapshot file, use the '.snapshot' extension to load it with '-c'.",
+                            type=str)
+        args = parser.parse_args(argv)
+        self.config.provenance = 'full'
+        snapshot = BytesIO()
+        try:
+            self.config.dump_snapshot(snapshot)
+        except ValueError as e:
+            log.error("%s", e)
+            sys.exit(1)
+        with open(args.snapshot[0], 'wb') as f:
+            f.write(snapshot.getvalue())
+        log.info("Wrote config snapshot to '%s'.", args.snapshot[0])
 
     def cmd_debug(self, argv, help):
         """Prints some debug info for this script"""
@@ -443,26 +1147,103 @@ class Controller(object):
             func(args.listopts, func.__doc__)
 
     def cmd_exec(self, argv, help):
-        """Execute a command on the instance using the paramiko connection"""
+        """Execute a command on instances using the paramiko connection"""
         parser = argparse.ArgumentParser(
             prog="%s exec" % self.progname,
             description=help,
-        )
-        instances = self.get_instances(command='init_ssh_key')
-        parser.add_argument("instance", nargs=1,
+            usage="%(prog)s [-h] [options] "
+                  "(instance ... | [instance ...] -- ...)",
+            epilog="Without '--' the first instance is followed by the "
+                   "command. With it, several instances, glob patterns and "
+                   "the selectors can be used before it and the output of "
+                   "each instance is prefixed with its name. A '--' after "
+                   "anything else is part of the command.")
+        self._add_rolling_arguments(parser)
+        parser.add_argument("-m", "--master", dest="masters",
+                            action="append", default=[],
+                            help="Run on all instances of the master, can be used multiple times")
+        parser.add_argument("-g", "--group", dest="groups",
+                            action="append", default=[],
+                            help="Run on all instances of the section group, like 'plain-instance', can be used multiple times")
+        parser.add_argument("instances", nargs="*",
                             metavar="instance",
-                            help="Name of the instance from the config.",
-                            type=str,
-                            choices=sorted_choices(instances))
-        parser.add_argument("remainder", nargs=argparse.REMAINDER,
-                            metavar="...",
-                            help="command")
+                            help="Name or glob pattern of instances from the config.")
+
+        def skip_option(index):
+            # returns the index after the option and its value
+            arg = argv[index]
+            single = (
+                arg in ('-h', '--help') or '=' in arg
+                or (not arg.startswith('--') and len(arg) > 2))
+            return index + (1 if single else 2)
+
+        separator = None
+        if '--' in argv:
+            # only a separator if everything before it are options,
+            # instances or glob patterns
+            separator = argv.index('--')
+            names = set(self.instances.keys())
+            index = 0
+            while index < separator:
+                arg = argv[index]
+                if arg.startswith('-'):
+                    index = skip_option(index)
+                elif arg in names or any(x in arg for x in '*?['):
+                    index += 1
+                else:
+                    separator = None
+                    break
+        if separator is not None:
+            (argv, command) = (argv[:separator], argv[separator + 1:])
+        else:
+            # the command follows the first instance
+            index = 0
+            while index < len(argv) and argv[index].startswith('-'):
+                index = skip_option(index)
+            (argv, command) = (argv[:index + 1], argv[index + 1:])
         args = parser.parse_args(argv)
-        instance = instances[args.instance[0]]
-        executor = InstanceExecutor(instance)
-        (rc, out, err) = executor(
-            *args.remainder, stdout=sys.stdout, stderr=sys.stderr, use_shjoin=False)
-        sys.exit(rc)
+        if not (args.instances or args.masters or args.groups):
+            parser.error("no instances given")
+        if not command:
+            parser.error("no command given")
+        uids = self.select_instances(
+            'init_ssh_key', names=args.instances,
+            masters=args.masters, groups=args.groups)
+        selected = [(x, self.instances[x]) for x in uids]
+        lock = threading.Lock()
+
+        def run(item):
+            (uid, instance) = item
+            prefix = '' if len(selected) == 1 else "%s: " % uid
+            stdout = PrefixedOutput(sys.stdout, prefix, lock)
+            stderr = PrefixedOutput(sys.stderr, prefix, lock)
+            try:
+                executor = InstanceExecutor(instance)
+                (rc, out, err) = executor(
+                    *command, stdout=stdout, stderr=stderr, use_shjoin=False)
+            except SystemExit:
+                # the error was already logged, for example by _init_conn
+                rc = 255
+            except Exception:
+                log.exception("Error executing command on '%s':" % uid)
+                rc = 255
+            finally:
+                stdout.close()
+                stderr.close()
+            return rc
+
+        rcs = self._run_rolling(args, run, selected, lambda x: x != 0)
+        failed = [uid for (uid, instance), rc in zip(selected, rcs) if rc]
+        skipped = [uid for (uid, instance), rc in zip(selected, rcs) if rc is None]
+        if len(selected) > 1 and failed:
+            log.error(
+                "The command failed on %s of %s instances: %s" % (
+                    len(failed), len(selected), ", ".join(failed)))
+        if skipped:
+            log.error(
+                "The command wasn't run on %s instances after too many failures: %s" % (
+                    len(skipped), ", ".join(skipped)))
+        sys.exit(max(x for x in rcs if x is not None))
 
     def cmd_ssh(self, argv, help):
         """Log into the instance with ssh using the automatically generated known hosts"""
@@ -475,7 +1256,7 @@ class Controller(object):
                             metavar="instance",
                             help="Name of the instance from the config.",
                             type=str,
-                            choices=sorted_choices(instances))
+                            choices=instances)
         parser.add_argument("...", nargs=argparse.REMAINDER,
                             help="ssh options")
         iargs = enumerate(argv)
@@ -503,6 +1284,7 @@ class Controller(object):
         instance = instances[sid]
         if user is None:
             user = instance.config.get('user')
+        import paramiko
         try:
             ssh_info = instance.init_ssh_key(user=user)
         except (paramiko.SSHException, socket.error):
@@ -524,14 +1306,11 @@ class Controller(object):
             description=help,
         )
         instances = self.get_instances(command='snapshot')
-        parser.add_argument("instance", nargs=1,
-                            metavar="instance",
-                            help="Name of the instance from the config.",
-                            type=str,
-                            choices=sorted_choices(instances))
+        self._add_instances_argument(parser, instances)
         args = parser.parse_args(argv)
-        instance = instances[args.instance[0]]
-        instance.snapshot()
+        self._fan_out(
+            self._get_selected_instances(instances, args.instance),
+            lambda instance: instance.snapshot(), args)
 
     def cmd_help(self, argv, help):
         """Print help"""
@@ -546,11 +1325,11 @@ class Controller(object):
                             metavar="command",
                             help="Name of the command you want help for.",
                             type=str,
-                            choices=sorted_choices(self.subparsers.keys()))
+                            choices=sorted_choices(self.cmds))
         args = parser.parse_args(argv)
         if args.zsh:
             if args.command is None:
-                for cmd in self.subparsers.keys():
+                for cmd in self.cmds:
                     print(cmd)
             else:  # pragma: no cover
                 if hasattr(self.cmds[args.command], 'get_completion'):
@@ -588,37 +1367,38 @@ class Controller(object):
                             action=versionaction_factory(self),
                             help="Print versions and exit")
 
+        parser.add_argument('--import-profile',
+                            action=importprofileaction_factory(ctrl=self),
+                            help="Print the import time of ploy and its plugins and exit")
+
         parser.add_argument('-d', '--debug',
                             action="store_true",
                             help="Enable debug logging")
 
-        self.cmds = dict(
-            (x[4:], getattr(self, x))
-            for x in dir(self) if x.startswith('cmd_'))
-        self.list_cmds = {}
-        for pluginname, plugin in self.plugins.items():
-            if 'get_commands' in plugin:
-                for cmd, func in plugin['get_commands'](self):
-                    if cmd in self.cmds:
-                        log.error("Command name '%s' of '%s' conflicts with existing command name.", cmd, pluginname)
-                        sys.exit(1)
-                    self.cmds[cmd] = func
-            if 'get_list_commands' in plugin:
-                for cmd, func in plugin['get_list_commands'](self):
-                    self.list_cmds.setdefault(cmd, []).append((pluginname, func))
+        self.cmds = CommandDict(self)
+        # only the parser of the requested command is created, unless
+        # argparse has to show all of them
+        cmds = self.cmds
+        main_argv = argv
+        skip = True
+        for index, arg in enumerate(argv):
+            if skip:
+                skip = False
+            elif arg in ('-c', '--config'):
+                skip = True
+            elif not arg.startswith('-'):
+                if arg in self.cmds:
+                    cmds = {arg: self.cmds[arg]}
+                    main_argv = argv[:index + 1]
+                break
         cmdparsers = parser.add_subparsers(title="commands")
         cmdparsers.required = True
         cmdparsers.dest = 'commands'
         self.subparsers = {}
-        for cmd, func in self.cmds.items():
+        for cmd, func in cmds.items():
             subparser = cmdparsers.add_parser(cmd, help=func.__doc__)
             subparser.set_defaults(func=func)
             self.subparsers[cmd] = subparser
-        main_argv = []
-        for arg in argv:
-            main_argv.append(arg)
-            if arg in self.cmds:
-                break
         sub_argv = argv[len(main_argv):]
         args = parser.parse_args(main_argv[1:])
         self.configfile = args.configfile
@@ -645,7 +1425,9 @@ class Controller(object):
         except Exception:
             log.exception("Error calling command '%s':" % args.commands)
         finally:
-            self.instances.close_connections()
+            instances = self.__dict__.get('instances')
+            if instances is not None:
+                instances.close_connections()
 
 
 def ploy(configpath=None, configname=None, progname=None):  # pragma: no cover
@@ -0,0 +1,83 @@
+""" asyncio support, this module requires Python 3.7 or newer. """
+from __future__ import unicode_literals
+from io import BytesIO
+from ploy.common import BaseExecutor, shjoin
+import asyncio
+import logging
+
+
+log = logging.getLogger('ploy')
+
+
+class AsyncInstanceExecutor(BaseExecutor):
+    """ Like ``InstanceExecutor``, but calling it returns a coroutine.
+
+        The output of the channel is read on the event loop, so one thread
+        can drive many commands at the same time. Opening the connection
+        and the channel blocks and is done in the default executor of the
+        loop, the connections of several instances are set up one at a time.
+    """
+    def __init__(self, instance, **kw):
+        BaseExecutor.__init__(self, **kw)
+        self.instance = instance
+
+    async def __call__(self, *cmd_args, **kw):
+        (args, stdin, expected) = self._prepare(cmd_args, kw)
+        result = await self._run(args, stdin, **kw)
+        return self._check_result(args, result, **expected)
+
+    def _open_channel(self, cmd, stdin):
+        conn = self.instance.conn
+        chan = conn.get_transport().open_session()
+        forward = None
+        if conn._ploy_forward_agent:
+            import paramiko
+            forward = paramiko.agent.AgentRequestHandler(chan)
+        chan.exec_command(cmd)
+        if stdin is not None:
+            chan.sendall(stdin)
+            chan.shutdown_write()
+        return (chan, forward)
+
+    async def _run(self, args, stdin, stdout=None, stderr=None, use_shjoin=True):
+        cmd = shjoin(args) if use_shjoin else ' '.join(args)
+        log.debug('Executing on instance %s:\n%s', self.instance.uid, cmd)
+        loop = asyncio.get_running_loop()
+        (chan, forward) = await loop.run_in_executor(
+            None, self._open_channel, cmd, stdin)
+        _stdout = BytesIO() if stdout is None else stdout
+        _stderr = BytesIO() if stderr is None else stderr
+        # the file descriptor of the channel is readable while there is
+        # data in its buffers or after it was closed
+        readable = asyncio.Event()
+        fd = chan.fileno()
+        loop.add_reader(fd, readable.set)
+        try:
+            while 1:
+                await readable.wait()
+                readable.clear()
+                should_break = True
+                if chan.recv_ready():
+                    _stdout.write(chan.recv(len(chan.in_buffer)))
+                    should_break = False
+                if chan.recv_stderr_ready():
+                    _stderr.write(chan.recv_stderr(len(chan.in_stderr_buffer)))
+                    should_break = False
+                should_break = (
+                    should_break
+                    and chan.exit_status_ready()
+                    and not chan.recv_ready()
+                    and not chan.recv_stderr_ready())
+                if should_break:
+                    break
+        finally:
+            loop.remove_reader(fd)
+        rc = chan.recv_exit_status()
+        chan.shutdown_read()
+        chan.close()
+        if forward is not None:
+            forward.close()
+        return (
+            rc,
+            _stdout.getvalue() if stdout is None else None,
+            _stderr.getvalue() if stderr is None else None)
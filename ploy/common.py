@@ -1,27 +1,45 @@
 from __future__ import print_function, unicode_literals
 from contextlib import closing
+try:
+    from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+except ImportError:  # pragma: nocover
+    ThreadPoolExecutor = None
+from functools import partial
 from lazy import lazy
 from io import BytesIO
+try:
+    from collections.abc import MutableMapping
+except ImportError:  # pragma: nocover
+    from collections import MutableMapping  # for Python 2.7
 try:
     from shlex import quote as shquote
 except ImportError:  # pragma: nocover
     from pipes import quote as shquote  # for Python 2.7
 import binascii
+import codecs
 import gzip
 import hashlib
 import logging
+import math
 import os
-import paramiko
 import re
 import select
 import socket
 import subprocess
 import sys
+import threading
+import time
 
 
 log = logging.getLogger('ploy')
 
 
+# setting up ssh connections updates the shared known hosts files and may
+# ask for passwords, so instances connecting in threads take turns, it's
+# reentrant for instances connecting through their master instance
+conn_lock = threading.RLock()
+
+
 try:
     get_input = raw_input
 except NameError:  # pragma: nocover
@@ -143,6 +161,74 @@ class StartupScriptMixin(object):
             return result['raw']
 
 
+class MasterInstanceDict(MutableMapping):
+    """ The instances of a master.
+
+        Sections are added with a factory and the class of the instance it
+        creates, the instance is only created when it's accessed. Instances
+        can also be set directly.
+    """
+    def __init__(self):
+        self._classes = {}
+        self._factories = {}
+        self._dict = {}
+
+    def add_factory(self, sid, factory, instance_class):
+        # the id is checked right away against the pattern of the class, so
+        # invalid names are reported without creating the instances, a
+        # custom ``validate_id`` only runs when the instance is created
+        for cls in instance_class.__mro__:
+            if 'validate_id' in vars(cls):
+                break
+        if cls is BaseInstance:
+            instance_class.check_id(sid)
+        self._dict.pop(sid, None)
+        self._classes[sid] = instance_class
+        self._factories[sid] = factory
+
+    def get_created(self, sid):
+        """ Returns the instance if it was already created or set. """
+        return self._dict.get(sid)
+
+    def get_class(self, sid):
+        """ Returns the class of the instance without creating it. """
+        if sid in self._dict:
+            return self._dict[sid].__class__
+        return self._classes[sid]
+
+    def __getitem__(self, sid):
+        if sid in self._dict:
+            return self._dict[sid]
+        instance = self._factories[sid]()
+        self._factories.pop(sid, None)
+        return self._dict.setdefault(sid, instance)
+
+    def __setitem__(self, sid, instance):
+        self._classes.pop(sid, None)
+        self._factories.pop(sid, None)
+        self._dict[sid] = instance
+
+    def __delitem__(self, sid):
+        if sid not in self:
+            raise KeyError(sid)
+        self._classes.pop(sid, None)
+        self._factories.pop(sid, None)
+        self._dict.pop(sid, None)
+
+    def __contains__(self, sid):
+        return sid in self._dict or sid in self._factories
+
+    def __iter__(self):
+        for sid in list(self._dict):
+            yield sid
+        for sid in list(self._factories):
+            if sid not in self._dict:
+                yield sid
+
+    def __len__(self):
+        return len(self._dict) + len(self._factories)
+
+
 class BaseMaster(object):
     def __init__(self, ctrl, mid, master_config):
         from ploy.config import ConfigSection  # avoid circular import
@@ -154,7 +240,7 @@ class BaseMaster(object):
             master_config = ConfigSection(master_config)
         self.master_config = master_config
         self.known_hosts = self.ctrl.known_hosts
-        self.instances = {}
+        self.instances = MasterInstanceDict()
         if getattr(self, 'section_info', None) is None:
             self.section_info = {
                 None: self.instance_class,
@@ -164,10 +250,17 @@ class BaseMaster(object):
                 masters = config.get('master', self.id).split()
                 if self.id not in masters:
                     continue
-                self.main_config.setdefault(instance_class.sectiongroupname, config.__class__())
-                self.main_config[instance_class.sectiongroupname][sid] = config.copy()
-                self.instances[sid] = instance_class(self, sid, self.main_config[instance_class.sectiongroupname][sid])
-                self.instances[sid].sectiongroupname = sectiongroupname
+                self.instances.add_factory(sid, partial(
+                    self._create_instance,
+                    sectiongroupname, instance_class, sid, config),
+                    instance_class)
+
+    def _create_instance(self, sectiongroupname, instance_class, sid, config):
+        self.main_config.setdefault(instance_class.sectiongroupname, config.__class__())
+        self.main_config[instance_class.sectiongroupname][sid] = config.copy()
+        instance = instance_class(self, sid, self.main_config[instance_class.sectiongroupname][sid])
+        instance.sectiongroupname = sectiongroupname
+        return instance
 
 
 class InstanceHooks(object):
@@ -207,12 +300,16 @@ class BaseInstance(object):
 
     _id_regexp = re.compile('^[a-zA-Z0-9-_]+$')
 
-    def validate_id(self, sid):
-        if self._id_regexp.match(sid) is None:
+    @classmethod
+    def check_id(cls, sid):
+        if cls._id_regexp.match(sid) is None:
             log.error("Invalid instance name '%s'. An instance name may only contain letters, numbers, dashes and underscores." % sid)
             sys.exit(1)
         return sid
 
+    def validate_id(self, sid):
+        return self.check_id(sid)
+
     @property
     def uid(self):
         master_instance = getattr(self.master, 'instance', None)
@@ -227,6 +324,7 @@ class BaseInstance(object):
 
     @lazy
     def _sshconfig(self):
+        import paramiko
         sshconfig = paramiko.SSHConfig()
         path = os.path.expanduser('~/.ssh/config')
         if not os.path.exists(path):
@@ -246,8 +344,10 @@ class BaseInstance(object):
         return self._default_ssh_info
 
     def _init_conn(self):
+        import paramiko
         try:
-            ssh_info = self.init_ssh_key()
+            with conn_lock:
+                ssh_info = self.init_ssh_key()
         except paramiko.SSHException as e:
             log.error("Couldn't connect to %s." % (self.config_id))
             log.error(str(e))
@@ -265,11 +365,12 @@ class BaseInstance(object):
 
     @property
     def conn(self):
-        if getattr(self, '_conn', None) is not None:
-            if self._conn.get_transport() is not None:
-                return self._conn
-        self._init_conn()
-        return self._conn
+        with conn_lock:
+            if getattr(self, '_conn', None) is not None:
+                if self._conn.get_transport() is not None:
+                    return self._conn
+            self._init_conn()
+            return self._conn
 
     def close_conn(self):
         if getattr(self, '_conn', None) is not None:
@@ -317,13 +418,22 @@ class BaseExecutor:
     def _run(self):
         raise NotImplementedError
 
-    def __call__(self, *cmd_args, **kw):
+    def _prepare(self, cmd_args, kw):
+        # splits the expected results and stdin from the options for _run
         args = self.prefix_args + cmd_args
-        rc = kw.pop('rc', None)
-        out = kw.pop('out', None)
-        err = kw.pop('err', None)
+        expected = dict(
+            rc=kw.pop('rc', None),
+            out=kw.pop('out', None),
+            err=kw.pop('err', None))
         stdin = kw.pop('stdin', None)
-        (_rc, _out, _err) = self._run(args, stdin, **kw)
+        return (args, stdin, expected)
+
+    def __call__(self, *cmd_args, **kw):
+        (args, stdin, expected) = self._prepare(cmd_args, kw)
+        return self._check_result(args, self._run(args, stdin, **kw), **expected)
+
+    def _check_result(self, args, run_result, rc=None, out=None, err=None):
+        (_rc, _out, _err) = run_result
         result = []
         if rc is None:
             result.append(_rc)
@@ -398,6 +508,7 @@ class InstanceExecutor(BaseExecutor):
         rerr = chan.makefile_stderr('rb', -1)
         forward = None
         if self.instance.conn._ploy_forward_agent:
+            import paramiko
             forward = paramiko.agent.AgentRequestHandler(chan)
         chan.exec_command(cmd)
         if stdin is not None:
@@ -442,6 +553,127 @@ class InstanceExecutor(BaseExecutor):
             _stderr.getvalue() if stderr is None else None)
 
 
+class PrefixedOutput(object):
+    """ A file like object for the ``stdout`` and ``stderr`` of executors,
+        which writes the decoded output to a text stream.
+
+        With a prefix only complete lines are written, each starting with
+        the prefix. Writes of several outputs sharing the lock don't mix.
+    """
+    def __init__(self, stream, prefix='', lock=None):
+        self.stream = stream
+        self.prefix = prefix
+        self.lock = lock
+        self._buffer = ''
+        self._decoder = codecs.getincrementaldecoder('utf-8')('replace')
+
+    def _write(self, text):
+        if not text:
+            return
+        if self.lock is None:
+            self.stream.write(text)
+            self.stream.flush()
+            return
+        with self.lock:
+            self.stream.write(text)
+            self.stream.flush()
+
+    def write(self, data):
+        text = self._buffer + self._decoder.decode(data)
+        self._buffer = ''
+        if self.prefix:
+            lines = text.split('\n')
+            self._buffer = lines.pop()
+            text = ''.join("%s%s\n" % (self.prefix, x) for x in lines)
+        self._write(text)
+
+    def close(self):
+        text = self._buffer + self._decoder.decode(b'', True)
+        self._buffer = ''
+        if self.prefix and text:
+            text = "%s%s\n" % (self.prefix, text)
+        self._write(text)
+
+
+def batch_size(value):
+    """ Checks a batch size like ``10`` or ``25%``, for use as argparse type.
+    """
+    number = value[:-1] if value.endswith('%') else value
+    try:
+        if int(number) < 1:
+            raise ValueError
+    except ValueError:
+        raise ValueError("Invalid batch size '%s'." % value)
+    return value
+
+
+def get_batch_size(value, count):
+    """ Returns the number of items for a batch size from ``batch_size``. """
+    if value.endswith('%'):
+        return max(1, int(math.ceil(count * int(value[:-1]) / 100.0)))
+    return int(value)
+
+
+def run_rolling(func, items, batch_size, canary=0, max_failures=None,
+                pause=0, failed=bool):
+    """ Calls ``func`` for each item with up to ``batch_size`` calls running
+        at the same time. The next item is started as soon as any running
+        one is done, after waiting ``pause`` seconds.
+
+        The first ``canary`` items are processed before all others and
+        nothing else is started if one of them fails. Otherwise nothing is
+        started anymore once more than ``max_failures`` items failed. The
+        running calls are finished in both cases. Whether the result of a
+        call is a failure is decided by ``failed``.
+
+        Returns the results in the order of the items with ``None`` for
+        items which weren't processed. Without ``concurrent.futures`` the
+        items are processed one after another.
+    """
+    items = list(items)
+    results = [None] * len(items)
+    state = dict(failures=0, started=False)
+    executor = None
+    if ThreadPoolExecutor is not None and batch_size > 1 and len(items) > 1:
+        executor = ThreadPoolExecutor(max_workers=min(batch_size, len(items)))
+
+    def done(index, result):
+        results[index] = result
+        if failed(result):
+            state['failures'] += 1
+
+    def process(indexes, window, budget):
+        pending = list(indexes)
+        running = {}
+        while pending or running:
+            while pending and len(running) < window and state['failures'] <= budget:
+                if state['started'] and pause:
+                    time.sleep(pause)
+                state['started'] = True
+                index = pending.pop(0)
+                if executor is None:
+                    done(index, func(items[index]))
+                else:
+                    running[executor.submit(func, items[index])] = index
+            if not running:
+                break
+            (finished, _) = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in finished:
+                done(running.pop(future), future.result())
+        return state['failures'] <= budget
+
+    indexes = list(range(len(items)))
+    if max_failures is None:
+        max_failures = len(items)
+    try:
+        if process(indexes[:canary], batch_size, 0):
+            process(indexes[canary:], batch_size, max_failures)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return results
+
+
 def Executor(instance=None, **kw):
     if instance is None:
         return LocalExecutor(**kw)
@@ -572,6 +804,7 @@ class SSHKeyFingerprintInstance(object):
         self.fingerprints = None
 
     def match(self, other):
+        import paramiko
         if self.fingerprints is None:
             func = getattr(self.instance, 'get_fingerprints', None)
             if func is not None:
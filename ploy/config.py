@@ -12,15 +12,27 @@ try:
     from inspect import getfullargspec
 except ImportError:
     from inspect import getargspec as getfullargspec
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:  # pragma: nocover
+    ThreadPoolExecutor = None
+from functools import partial
 from io import BytesIO
 from ploy.common import split_option
 from pluggy import HookimplMarker
 from weakref import proxy
 import attr
+import hashlib
+import heapq
+import json
 import logging
 import os
+import struct
 import sys
+import tempfile
+import time
 import warnings
+import zlib
 
 
 log = logging.getLogger('ploy')
@@ -33,8 +45,19 @@ except NameError:  # pragma: nocover
     basestring = str
 
 
+try:
+    intern = sys.intern
+except AttributeError:  # pragma: nocover
+    # on Python 2 the keys are unicode, which can't be interned
+    def intern(value):
+        return value
+
+
 _marker = object()
 
+SNAPSHOT_MAGIC = b'PLOYSNAP'
+SNAPSHOT_VERSION = 2
+
 
 def value_asbool(value):
     if isinstance(value, bool):
@@ -46,6 +69,11 @@ def value_asbool(value):
 
 
 class BaseMassager(object):
+    # if true, the massaged value is reused until the value or massagers
+    # change. Only set it for massagers which depend on nothing but the
+    # value and return immutable results, as they are shared by copies
+    _memoize = False
+
     def __init__(self, sectiongroupname, key):
         self.sectiongroupname = sectiongroupname
         self.key = key
@@ -61,6 +89,8 @@ class BaseMassager(object):
 
 
 class BooleanMassager(BaseMassager):
+    _memoize = True
+
     def __call__(self, config, sectionname):
         value = BaseMassager.__call__(self, config, sectionname)
         result = value_asbool(value)
@@ -70,6 +100,8 @@ class BooleanMassager(BaseMassager):
 
 
 class IntegerMassager(BaseMassager):
+    _memoize = True
+
     def __call__(self, config, sectionname):
         value = BaseMassager.__call__(self, config, sectionname)
         return int(value)
@@ -84,6 +116,7 @@ def expand_path(value, base):
 
 class PathMassager(BaseMassager):
     _massage_for_yaml = False
+    _memoize = True
 
     def __call__(self, config, sectionname):
         value = BaseMassager.__call__(self, config, sectionname)
@@ -129,6 +162,7 @@ class StartupScriptMassager(BaseMassager):
 
 class UserMassager(BaseMassager):
     _massage_for_yaml = False
+    _memoize = True
 
     def __call__(self, config, sectionname):
         value = BaseMassager.__call__(self, config, sectionname)
@@ -138,13 +172,55 @@ class UserMassager(BaseMassager):
         return value
 
 
+class Schema(object):
+    """ Declares the typed options of a section group.
+
+        The ``options`` map option names to massager classes. The massagers
+        are registered with the config and ``Config.compile_schemas`` checks
+        the options of all sections in the group when the config is loaded.
+        The converted values are available as records from
+        ``Config.get_record``, with dashes in option names replaced by
+        underscores.
+    """
+    def __init__(self, sectiongroupname, options):
+        self.sectiongroupname = sectiongroupname
+        self.options = dict(options)
+        self.massagers = [
+            (key, str(key.replace('-', '_')), massager(sectiongroupname, key))
+            for key, massager in sorted(self.options.items())]
+        # records with mutable values can't be reused
+        self.memoize = all(
+            getattr(x[2], '_memoize', False) for x in self.massagers)
+        self.record_class = attr.make_class(
+            str('Record'),
+            dict((x[1], attr.ib(default=None)) for x in self.massagers),
+            slots=True)
+
+    def get_massagers(self):
+        return [x[2] for x in self.massagers]
+
+    def get_record(self, section):
+        values = {}
+        for key, name, massager in self.massagers:
+            if key in section._dict:
+                values[name] = massager(section, section.sectionname)
+        return self.record_class(**values)
+
+
 @attr.s(slots=True)
 class ConfigValue(object):
     path = attr.ib()
     value = attr.ib()
-    src = attr.ib(default=None)
+    _src = attr.ib(default=None)
     comment = attr.ib(default=None)
 
+    @property
+    def src(self):
+        src = self._src
+        if isinstance(src, _CallerSrc):
+            src = self._src = src.resolve()
+        return src
+
 
 def get_package_name(module):
     f = getattr(module, '__file__', '')
@@ -155,7 +231,28 @@ def get_package_name(module):
         return module.__name__.rsplit('.', 1)[0]
 
 
-def get_caller_src():
+@attr.s(slots=True)
+class _CallerSrc(object):
+    """ Location of the code which set a config value.
+
+        Formatting it is comparatively expensive and rarely needed, so that
+        only happens when the ``src`` of a ``ConfigValue`` is accessed.
+    """
+    module_name = attr.ib()
+    filename = attr.ib()
+    lineno = attr.ib()
+
+    def resolve(self):
+        module = sys.modules.get(self.module_name)
+        if module is None:
+            return "%s:%s" % (self.filename, self.lineno)
+        package_name = get_package_name(module)
+        f = getattr(sys.modules[package_name], '__file__', '')
+        path = os.path.relpath(self.filename, os.path.dirname(f))
+        return "%s:%s:%s" % (package_name, path, self.lineno)
+
+
+def get_caller_src(lazy=False):
     skip = frozenset([
         ('_abcoll', 'setdefault'),
         ('_abcoll', 'update'),
@@ -175,22 +272,112 @@ def get_caller_src():
             continue
         if (module_name, f_code.co_name) in stop:
             return
-        package_name = get_package_name(sys.modules[module_name])
-        f = getattr(sys.modules[package_name], '__file__', '')
-        path = os.path.relpath(f_code.co_filename, os.path.dirname(f))
-        return "%s:%s:%s" % (package_name, path, lineno)
+        src = _CallerSrc(module_name, f_code.co_filename, lineno)
+        if lazy:
+            return src
+        return src.resolve()
     sys.exit(0)
 
 
+_deleted = object()
+
+
+class _LayeredDict(MutableMapping):
+    """ A dict with changes stored separately from a shared base dict.
+
+        The base dict is never modified, so any number of these can share it.
+    """
+    __slots__ = ('_base', '_delta')
+
+    def __init__(self, base):
+        self._base = base
+        self._delta = {}
+
+    def __getitem__(self, key):
+        value = self._delta.get(key, _marker)
+        if value is _marker:
+            return self._base[key]
+        if value is _deleted:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        value = self._delta.get(key, _marker)
+        if value is _marker:
+            return key in self._base
+        return value is not _deleted
+
+    def __setitem__(self, key, value):
+        self._delta[key] = value
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        if key in self._base:
+            self._delta[key] = _deleted
+        else:
+            del self._delta[key]
+
+    def __iter__(self):
+        base = self._base
+        delta = self._delta
+        for key in base:
+            if delta.get(key) is not _deleted:
+                yield key
+        for key in delta:
+            if key not in base:
+                yield key
+
+    def __len__(self):
+        base = self._base
+        result = len(base)
+        for key, value in self._delta.items():
+            if key not in base:
+                result += 1
+            elif value is _deleted:
+                result -= 1
+        return result
+
+    def frozen(self):
+        """ Returns a dict with the current content which must not be
+            changed anymore. """
+        if not self._delta:
+            return self._base
+        return dict(self.items())
+
+
 class ConfigSection(MutableMapping):
+    __slots__ = (
+        '_config', '_dict', '_dispatch', '_dispatch_serial', '_group_index',
+        '_massaged', '_massagers', '_serial', 'sectiongroupname',
+        'sectionname')
+
     def __init__(self, *args, **kw):
         self._dict = {}
-        for k, v in dict(*args, **kw).items():
-            self[k] = v
+        # these dicts are only created when needed, because most sections
+        # don't have massagers or massaged values
+        self._dispatch = None
+        self._dispatch_serial = None
+        self._massaged = None
+        self._massagers = None
+        self._serial = 0
         self.sectionname = None
         self.sectiongroupname = None
         self._config = None
-        self.massagers = {}
+        # the index of the config if this is a section group in it
+        self._group_index = None
+        for k, v in dict(*args, **kw).items():
+            self[k] = v
+
+    @property
+    def massagers(self):
+        if self._massagers is None:
+            self._massagers = {}
+        return self._massagers
+
+    @massagers.setter
+    def massagers(self, value):
+        self._massagers = value
 
     def add_massager(self, massager):
         key = (massager.sectiongroupname, massager.key)
@@ -203,9 +390,12 @@ class ConfigSection(MutableMapping):
                 return
             raise ValueError("Massager for option '%s' in section group '%s' already registered." % (massager.key, massager.sectiongroupname))
         self.massagers[key] = massager
+        self._serial += 1
 
     def __delitem__(self, key):
         del self._dict[key]
+        if self._massaged:
+            self._massaged.pop(key, None)
 
     def get_path(self, key, default=_marker):
         if default is not _marker:
@@ -213,47 +403,96 @@ class ConfigSection(MutableMapping):
                 return default
         return self._dict[key].path
 
-    def _get_massager(self, key):
-        if key in self._dict:
-            if self._config is not None:
-                massage = self._config.massagers.get((self.sectiongroupname, key))
-                if not callable(massage):
-                    massage = self._config.massagers.get((None, key))
-                    if callable(massage):
-                        if len(getfullargspec(massage.__call__).args) == 3:
-                            return (massage, (self.sectionname,))
-                        else:
-                            return (massage, (self.sectiongroupname, self.sectionname))
-                else:
-                    return (massage, (self.sectionname,))
-            massage = self.massagers.get((self.sectiongroupname, key))
-            if callable(massage):
-                return (massage, (self.sectionname, ))
+    def _get_dispatch(self):
+        # the dispatch table and massaged values are valid as long as no
+        # massager was added to this section or the config
+        serial = self._serial
+        if self._config is not None:
+            serial = (serial, self._config._serial)
+        if serial != self._dispatch_serial:
+            self._dispatch = {}
+            self._massaged = None
+            self._dispatch_serial = serial
+        return self._dispatch
+
+    def _resolve_massager(self, key):
+        if self._config is not None:
+            massage = self._config.massagers.get((self.sectiongroupname, key))
+            if not callable(massage):
+                massage = self._config.massagers.get((None, key))
+                if callable(massage):
+                    if len(getfullargspec(massage.__call__).args) == 3:
+                        return (massage, (self.sectionname,))
+                    else:
+                        return (massage, (self.sectiongroupname, self.sectionname))
+            else:
+                return (massage, (self.sectionname,))
+        massage = None
+        if self._massagers:
+            massage = self._massagers.get((self.sectiongroupname, key))
+        if callable(massage):
+            return (massage, (self.sectionname, ))
         return (None, None)
 
+    def _get_massager(self, key):
+        if key not in self._dict:
+            return (None, None)
+        dispatch = self._get_dispatch()
+        result = dispatch.get(key)
+        if result is None:
+            result = dispatch[key] = self._resolve_massager(key)
+        return result
+
     def __getitem__(self, key):
         if key == '__groupname__':
             return self.sectiongroupname
         if key == '__name__':
             return self.sectionname
         (massager, args) = self._get_massager(key)
-        if massager is not None:
-            return massager(self, *args)
         value = self._dict[key]
+        if massager is not None:
+            if self._massaged is not None:
+                massaged = self._massaged.get(key)
+                if massaged is not None and massaged[0] is value:
+                    return massaged[1]
+            result = massager(self, *args)
+            if getattr(massager, '_memoize', False):
+                if self._massaged is None:
+                    self._massaged = {}
+                self._massaged[key] = (value, result)
+            return result
         if isinstance(value, ConfigValue):
             return value.value
         return value
 
+    def __contains__(self, key):
+        # doesn't use __getitem__, to avoid massaging and creating sections
+        if key in self._dict:
+            return True
+        return key in ('__groupname__', '__name__')
+
     def __setitem__(self, key, value):
         if not isinstance(value, ConfigValue):
             src = None
             if not isinstance(value, ConfigSection):
-                src = get_caller_src()
+                provenance = 'lazy'
+                if self._config is not None:
+                    provenance = self._config.provenance
+                if provenance is not None:
+                    src = get_caller_src(lazy=provenance == 'lazy')
             value = ConfigValue(None, value, src=src)
         self._dict[key] = value
+        if self._massaged:
+            self._massaged.pop(key, None)
         if self._config is not None:
             self._config._values.append(
                 (self.sectiongroupname, self.sectionname, key, value))
+            self._config._index.add_key(
+                self.sectiongroupname, self.sectionname, key, value)
+        elif self._group_index is not None:
+            if isinstance(value.value, ConfigSection):
+                self._group_index.add_section(
+                    self.sectiongroupname, key, value.value)
 
     def keys(self):
         return self._dict.keys()
@@ -264,13 +503,33 @@ class ConfigSection(MutableMapping):
     def __iter__(self):
         return iter(self.keys())
 
+    def _freeze(self):
+        # from now on changes to this section go into a delta, so the
+        # current content can be shared with copies
+        if isinstance(self._dict, _LayeredDict):
+            base = self._dict.frozen()
+            if base is self._dict._base:
+                return base
+        else:
+            base = self._dict
+        self._dict = _LayeredDict(base)
+        return base
+
     def copy(self):
         new = ConfigSection()
-        new._dict = self._dict.copy()
+        new._dict = _LayeredDict(self._freeze())
         new.sectionname = self.sectionname
         new.sectiongroupname = self.sectiongroupname
-        new.massagers = self.massagers.copy()
+        if self._massagers:
+            new._massagers = self._massagers.copy()
         new._config = self._config
+        if self._massaged:
+            # the copy shares the values, so the massaged ones stay valid.
+            # Only immutable results are memoized, so they can be shared
+            new._serial = self._serial
+            new._dispatch = dict(self._dispatch)
+            new._dispatch_serial = self._dispatch_serial
+            new._massaged = dict(self._massaged)
         return new
 
     def __repr__(self):
@@ -292,272 +551,432 @@ class _RawConfigValue(object):
     comments = attr.ib(default=(None, None))
 
 
-class _ConfigDict(configparser._default_dict):
-    prefix_comment = None
-    key_prefix_comments = None
-    key_comments = None
-
-    def set_prefix_comment(self, value):
-        self.prefix_comment = value
-
-    def set_key_prefix_comment(self, key, value):
-        if self.key_prefix_comments is None:
-            self.key_prefix_comments = dict()
-        self.key_prefix_comments[key] = value
-
-    def set_key_comment(self, key, value):
-        if self.key_comments is None:
-            self.key_comments = dict()
-        self.key_comments[key] = value
-
-
-class CommentedConfigParser(configparser.RawConfigParser):
-    def _read(self, fp, fpname):
-        self._dict = _ConfigDict
-        cursect = None                        # None, or a dictionary
-        optname = None
-        lineno = 0
-        e = None                              # None, or an exception
-        comments = []
-        while True:
-            line = fp.readline()
-            if not line:
-                if comments:
-                    self.comments = comments
-                break
-            lineno = lineno + 1
-            # blank line?
-            if line.strip() == '':
-                continue
-            # comment?
-            if line[0] in '#;':
-                comments.append((line[0:1], line[1:]))
-                continue
-            if line.split(None, 1)[0].lower() == 'rem' and line[0] in "rR":
-                comments.append((line[0:3], line[3:]))
-                # no leading whitespace
+@attr.s(slots=True)
+class _IniSection(object):
+    name = attr.ib()
+    prefix_comment = attr.ib(default=None)
+    options = attr.ib(default=attr.Factory(configparser._default_dict))
+    key_prefix_comments = attr.ib(default=attr.Factory(dict))
+    key_comments = attr.ib(default=attr.Factory(dict))
+
+
+@attr.s(slots=True)
+class _IniFile(object):
+    sections = attr.ib(default=attr.Factory(configparser._default_dict))
+    defaults = attr.ib(default=attr.Factory(
+        lambda: _IniSection(configparser.DEFAULTSECT)))
+    comments = attr.ib(default=None)
+
+    def get_extends(self):
+        for sectionname in ('global', 'global:global'):
+            section = self.sections.get(sectionname)
+            if section is None:
                 continue
-            # continuation line?
-            if line[0].isspace() and cursect is not None and optname:
-                value = line.strip()
-                if value:
-                    cursect[optname].append(value)
-            # a section header or option header?
+            extends = section.options.get(
+                'extends', self.defaults.options.get('extends'))
+            if extends is not None:
+                return extends.split()
+
+
+def _read_ini(fp, fpname):
+    """ Parses an INI file in a single pass.
+
+        The values are the same as with ``RawConfigParser``, but comments
+        are kept with the section or option they precede.
+    """
+    result = _IniFile()
+    cursect = None
+    optname = None
+    lineno = 0
+    e = None
+    comments = []
+    for line in fp:
+        lineno = lineno + 1
+        # blank line?
+        if line.strip() == '':
+            continue
+        # comment?
+        if line[0] in '#;':
+            comments.append((line[0:1], line[1:]))
+            continue
+        if line.split(None, 1)[0].lower() == 'rem' and line[0] in "rR":
+            comments.append((line[0:3], line[3:]))
+            # no leading whitespace
+            continue
+        # continuation line?
+        if line[0].isspace() and cursect is not None and optname:
+            value = line.strip()
+            if value:
+                cursect.options[optname].append(value)
+            continue
+        # is it a section header?
+        mo = configparser.RawConfigParser.SECTCRE.match(line)
+        if mo:
+            sectname = mo.group('header')
+            if sectname in result.sections:
+                cursect = result.sections[sectname]
+            elif sectname == configparser.DEFAULTSECT:
+                cursect = result.defaults
             else:
-                # is it a section header?
-                mo = self.SECTCRE.match(line)
-                if mo:
-                    sectname = mo.group('header')
-                    if sectname in self._sections:
-                        cursect = self._sections[sectname]
-                    elif sectname == configparser.DEFAULTSECT:
-                        cursect = self._defaults
-                    else:
-                        cursect = self._dict()
-                        cursect['__name__'] = sectname
-                        self._sections[sectname] = cursect
-                    if comments:
-                        cursect.set_prefix_comment(comments)
-                        comments = []
-                    # So sections can't start with a continuation line
-                    optname = None
-                # no section header in the file?
-                elif cursect is None:
-                    raise configparser.MissingSectionHeaderError(fpname, lineno, line)
-                # an option line?
-                else:
-                    mo = self._optcre.match(line)
-                    if mo:
-                        optname, vi, optval = mo.group('option', 'vi', 'value')
-                        optname = optname.rstrip()
-                        if comments:
-                            cursect.set_key_prefix_comment(optname, comments)
-                            comments = []
-                        # This check is fine because the OPTCRE cannot
-                        # match if it would set optval to None
-                        if optval is not None:
-                            if vi in ('=', ':') and ';' in optval:
-                                # ';' is a comment delimiter only if it follows
-                                # a spacing character
-                                pos = optval.find(';')
-                                if pos != -1 and optval[pos - 1].isspace():
-                                    cursect.set_key_comment(
-                                        optname, [(optval[pos:pos + 1], optval[pos + 1:])])
-                                    optval = optval[:pos]
-                            optval = optval.strip()
-                            # allow empty values
-                            if optval == '""':
-                                optval = ''
-                            cursect[optname] = [optval]
-                        else:
-                            # valueless option handling
-                            cursect[optname] = optval
-                    else:
-                        # a non-fatal parsing error occurred.  set up the
-                        # exception but keep going. the exception will be
-                        # raised at the end of the file and will contain a
-                        # list of all bogus lines
-                        if not e:
-                            e = configparser.ParsingError(fpname)
-                        e.append(lineno, repr(line))
-        # if any parsing errors occurred, raise an exception
-        if e:
-            raise e
-
-        # join the multi-line values collected while reading
-        all_sections = [self._defaults]
-        all_sections.extend(self._sections.values())
-        for options in all_sections:
-            for name, val in options.items():
-                if isinstance(val, list):
-                    options[name] = '\n'.join(val)
-
-
-def _read_config(config, path, parser, shallow=False):
+                cursect = _IniSection(sectname)
+                result.sections[sectname] = cursect
+            if comments:
+                cursect.prefix_comment = comments
+                comments = []
+            # So sections can't start with a continuation line
+            optname = None
+        # no section header in the file?
+        elif cursect is None:
+            raise configparser.MissingSectionHeaderError(fpname, lineno, line)
+        # an option line?
+        else:
+            mo = configparser.RawConfigParser.OPTCRE.match(line)
+            if mo:
+                optname, vi, optval = mo.group('option', 'vi', 'value')
+                optname = optname.rstrip()
+                if comments:
+                    cursect.key_prefix_comments[optname] = comments
+                    comments = []
+                if vi in ('=', ':') and ';' in optval:
+                    # ';' is a comment delimiter only if it follows
+                    # a spacing character
+                    pos = optval.find(';')
+                    if pos != -1 and optval[pos - 1].isspace():
+                        cursect.key_comments[optname] = [
+                            (optval[pos:pos + 1], optval[pos + 1:])]
+                        optval = optval[:pos]
+                optval = optval.strip()
+                # allow empty values
+                if optval == '""':
+                    optval = ''
+                cursect.options[optname] = [optval]
+            else:
+                # a non-fatal parsing error occurred.  set up the
+                # exception but keep going. the exception will be
+                # raised at the end of the file and will contain a
+                # list of all bogus lines
+                if not e:
+                    e = configparser.ParsingError(fpname)
+                e.append(lineno, repr(line))
+    # if any parsing errors occurred, raise an exception
+    if e:
+        raise e
+    if comments:
+        result.comments = comments
+    # join the multi-line values collected while reading
+    all_sections = [result.defaults]
+    all_sections.extend(result.sections.values())
+    for section in all_sections:
+        for name, val in section.options.items():
+            section.options[name] = '\n'.join(val)
+    return result
+
+
+def _load_parsed(load, parsed, config):
+    if not isinstance(config, basestring):
+        return load(config)
+    try:
+        signature = _get_files_signature([config])
+    except OSError:
+        # let ``load`` report the missing file
+        return load(config)
+    cached = parsed.get(config)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+    result = load(config)
+    parsed[config] = (signature, result)
+    return result
+
+
+def _resolve_extends(config, load, parsed=None):
+    """ Returns the results of ``load`` for ``config`` and all files it
+        extends, the ones with the lowest precedence come first.
+
+        The ``load`` function is called exactly once for each file and
+        returns a tuple of the result and the absolute paths of the files
+        extended by that file. Files which are extended from several places
+        come after all files extending them. Otherwise the order is breadth
+        first in the order of the ``extends`` options.
+
+        If ``parsed`` is a dict, the results for files are stored in it and
+        reused as long as the size and modification time of the file stay
+        the same.
+    """
+    if parsed is not None:
+        load = partial(_load_parsed, load, parsed)
+    loaded = {config: load(config)}
+    order = [config]
+    for current in order:
+        for extended in loaded[current][1]:
+            if extended not in loaded:
+                loaded[extended] = load(extended)
+                order.append(extended)
+    # check for cycles with a depth first search
+    stack = [(config, iter(loaded[config][1]))]
+    on_stack = set([config])
+    done = set()
+    while stack:
+        (current, extends) = stack[-1]
+        for extended in extends:
+            if extended in on_stack:
+                log.error("Circular config file extension on '%s'.", extended)
+                sys.exit(1)
+            if extended not in done:
+                on_stack.add(extended)
+                stack.append((extended, iter(loaded[extended][1])))
+                break
+        else:
+            stack.pop()
+            on_stack.remove(current)
+            done.add(current)
+    # a file is only used once all files extending it are
+    index = dict((x, i) for i, x in enumerate(order))
+    pending = dict.fromkeys(order, 0)
+    for current in order:
+        for extended in set(loaded[current][1]):
+            pending[extended] += 1
+    heap = [0]
     result = []
-    stack = [config]
-    seen = set()
-    while 1:
-        config = stack.pop()
-        if config in seen:
-            log.error("Circular config file extension on '%s'.", config)
-            sys.exit(1)
-        seen.add(config)
+    while heap:
+        current = order[heapq.heappop(heap)]
+        result.append(loaded[current][0])
+        for extended in set(loaded[current][1]):
+            pending[extended] -= 1
+            if not pending[extended]:
+                heapq.heappush(heap, index[extended])
+    result.reverse()
+    return result
+
+
+def _read_config(config, path, shallow=False, parsed=None):
+    def load(config):
         src = None
         if isinstance(config, basestring):
             src = os.path.relpath(config)
-        try:
-            _config = parser(
-                strict=False,
-                comment_prefixes=('#', ';', 'REM ', 'rem ', 'REm ', 'ReM ', 'rEM ', 'Rem ', 'rEm ', 'reM '),
-                inline_comment_prefixes=(';',))
-        except TypeError:
-            _config = parser(strict=False)
         if getattr(config, 'read', None) is not None:
-            if hasattr(_config, 'read_file'):
-                _config.read_file(config)
-            else:
-                _config.readfp(config)
+            ini = _read_ini(config, getattr(config, 'name', '<???>'))
             config.seek(0)
+            _path = path
         else:
             if not os.path.exists(config):
                 log.error("Config file '%s' doesn't exist.", config)
                 sys.exit(1)
-            _config.read(config)
-            path = os.path.dirname(config)
-        comments = getattr(_config, 'comments', None)
-        if comments is not None:
-            assert not isinstance(_config, ConfigParser)
-            result.append(_RawConfigValue(
+            with open(config) as f:
+                ini = _read_ini(f, config)
+            _path = os.path.dirname(config)
+        extends = None
+        if not shallow:
+            extends = ini.get_extends()
+        return (
+            (config, src, _path, ini),
+            [os.path.abspath(os.path.join(_path, x)) for x in extends or ()])
+
+    return _resolve_extends(config, load, parsed=parsed)
+
+
+# shared by all values without comments, which are most of them
+_no_comments = (None, None)
+
+
+def _make_comments(prefix_comment, comment):
+    if prefix_comment is None and comment is None:
+        return _no_comments
+    return (prefix_comment, comment)
+
+
+def _iter_config_values(files):
+    for config, src, path, ini in files:
+        for sectionname, section in ini.sections.items():
+            yield _RawConfigValue(
                 src=src,
                 path=path,
-                section=None,
+                section=sectionname,
                 key=None,
                 value=None,
-                comments=(comments, None)))
-        for sectionname, section in reversed(list(_config._sections.items())):
-            key_comments = getattr(section, 'key_comments', None) or {}
-            key_prefix_comments = getattr(section, 'key_prefix_comments', None) or {}
-            for key, value in reversed(list(section.items())):
-                if key == '__name__':
-                    continue
-                result.append(_RawConfigValue(
+                comments=_make_comments(section.prefix_comment, None))
+            for key, value in section.options.items():
+                yield _RawConfigValue(
                     src=src,
                     path=path,
                     section=sectionname,
                     key=key,
                     value=value,
-                    comments=(key_prefix_comments.get(key), key_comments.get(key))))
-            prefix_comment = getattr(section, 'prefix_comment', None)
-            result.append(_RawConfigValue(
+                    comments=_make_comments(
+                        section.key_prefix_comments.get(key),
+                        section.key_comments.get(key)))
+        if ini.comments is not None:
+            yield _RawConfigValue(
                 src=src,
                 path=path,
-                section=sectionname,
+                section=None,
                 key=None,
                 value=None,
-                comments=(prefix_comment, None)))
-        if _config.has_option('global', 'extends'):
-            extends = _config.get('global', 'extends').split()
-        elif _config.has_option('global:global', 'extends'):
-            extends = _config.get('global:global', 'extends').split()
+                comments=(ini.comments, None))
+
+
+def _check_config(files, values):
+    expected = []
+    for config, src, path, ini in files:
+        try:
+            _config = ConfigParser(
+                strict=False,
+                comment_prefixes=('#', ';', 'REM ', 'rem ', 'REm ', 'ReM ', 'rEM ', 'Rem ', 'rEm ', 'reM '),
+                inline_comment_prefixes=(';',))
+        except TypeError:
+            _config = ConfigParser(strict=False)
+        if getattr(config, 'read', None) is not None:
+            if hasattr(_config, 'read_file'):
+                _config.read_file(config)
+            else:
+                _config.readfp(config)
+            config.seek(0)
         else:
-            break
-        if shallow:
-            break
-        stack[0:0] = [
-            os.path.abspath(os.path.join(path, x))
-            for x in reversed(extends)]
-    return list(reversed(result))
-
-
-def read_config(config, path, shallow=False):
-    _control_config = _read_config(config, path, ConfigParser, shallow=shallow)
-    _config = _read_config(config, path, CommentedConfigParser, shallow=shallow)
-    index = 0
-    for item in _config:
-        if item.section is None:
-            assert item.key is None
-            assert item.value is None
-            continue
-        if _control_config[index].comments != (None, None):
-            assert _control_config[index].comments == item.comments
-        index += 1
-    return _config
+            _config.read(config)
+        for sectionname, section in _config._sections.items():
+            expected.append((sectionname, None))
+            expected.extend(
+                (sectionname, key) for key in section if key != '__name__')
+    result = [(x.section, x.key) for x in values if x.section is not None]
+    assert result == expected
+
+
+def read_config(config, path, shallow=False, check=None, files=None, parsed=None):
+    """ Returns an iterator over all values of the config file and the
+        files it extends, including their comments and where they come from.
+
+        If ``check`` is true, the result is cross-checked against the
+        standard library parser. By default that only happens with debug
+        logging enabled, as it requires a second parse of every file.
+
+        If ``files`` is a list, the names of all files read are added to it.
+
+        If ``parsed`` is a dict, files which didn't change since they were
+        stored in it aren't parsed again.
+    """
+    _files = _read_config(config, path, shallow=shallow, parsed=parsed)
+    if files is not None:
+        files.extend(
+            x[0] for x in _files if isinstance(x[0], basestring))
+    files = _files
+    result = _iter_config_values(files)
+    if check is None:
+        check = log.isEnabledFor(logging.DEBUG)
+    if check:
+        result = list(result)
+        _check_config(files, result)
+    return result
 
 
-def read_yml_config(config, path):
-    from ruamel.yaml import YAML
-    result = []
-    stack = [config]
-    seen = set()
-    while 1:
-        config = stack.pop()
-        if config in seen:
-            log.error("Circular config file extension on '%s'.", config)
-            sys.exit(1)
-        seen.add(config)
-        yaml = YAML(typ='rt')
+def _read_mapping_config(config, path, parse, mode='r', files=None, parsed=None):
+    """ Returns a list of all values of the config file and the files it
+        extends.
+
+        The ``parse`` function gets an open file and returns a mapping of
+        section groups to sections to options.
+    """
+    def load(config):
+        _path = path
         if getattr(config, 'read', None) is not None:
-            _config = yaml.load(config)
+            _config = parse(config)
         else:
             if not os.path.exists(config):
                 log.error("Config file '%s' doesn't exist.", config)
                 sys.exit(1)
-            with open(config, 'r') as f:
-                _config = yaml.load(f)
-            path = os.path.dirname(config)
+            with open(config, mode) as f:
+                _config = parse(f)
+            _path = os.path.dirname(config)
         if not _config:
             _config = {}
         src = None
         if isinstance(config, basestring):
             src = os.path.relpath(config)
-        for sectiongroupname in reversed(list(_config.keys())):
-            for sectionname in reversed(list(_config[sectiongroupname].keys())):
-                for key, value in reversed(list(_config[sectiongroupname][sectionname].items())):
-                    result.append(_RawConfigValue(
-                        src=src,
-                        path=path,
-                        section="%s:%s" % (sectiongroupname, sectionname),
-                        key=key,
-                        value=value))
+        result = []
+        for sectiongroupname, sectiongroup in _config.items():
+            for sectionname, section in sectiongroup.items():
                 result.append(_RawConfigValue(
                     src=src,
-                    path=path,
+                    path=_path,
                     section="%s:%s" % (sectiongroupname, sectionname),
                     key=None,
                     value=None))
+                for key, value in section.items():
+                    result.append(_RawConfigValue(
+                        src=src,
+                        path=_path,
+                        section="%s:%s" % (sectiongroupname, sectionname),
+                        key=key,
+                        value=value))
         extends = None
         if 'global' in _config:
             if 'extends' in _config['global']:
                 extends = _config['global']['extends'].split()
             elif 'global' in _config['global'] and 'extends' in _config['global']['global']:
                 extends = _config['global']['global']['extends'].split()
-        if not extends:
-            break
-        stack[0:0] = [
-            os.path.abspath(os.path.join(path, x))
-            for x in reversed(extends)]
-    return reversed(result)
+        return (
+            (config, result),
+            [os.path.abspath(os.path.join(_path, x)) for x in extends or ()])
+
+    _files = _resolve_extends(config, load, parsed=parsed)
+    if files is not None:
+        files.extend(
+            x[0] for x in _files if isinstance(x[0], basestring))
+    return [
+        value
+        for config, values in _files
+        for value in values]
+
+
+def read_yml_config(config, path, files=None, round_trip=False, parsed=None):
+    """ Returns a list of all values of the config file and the files it
+        extends.
+
+        The round trip loader of ruamel.yaml is only used if ``round_trip``
+        is true, as it is much slower than the safe loader, which uses the
+        C implementation if available.
+
+        The ``files`` and ``parsed`` arguments are the same as for
+        ``read_config``.
+    """
+    from ruamel.yaml import YAML
+    yaml = YAML(typ='rt' if round_trip else 'safe')
+    return _read_mapping_config(
+        config, path, yaml.load, files=files, parsed=parsed)
+
+
+def _get_toml_module():
+    try:
+        import tomllib
+    except ImportError:  # pragma: nocover
+        try:
+            import tomli as tomllib
+        except ImportError:
+            log.error(
+                "Reading TOML configs requires Python 3.11 or the 'tomli' package.")
+            sys.exit(1)
+    return tomllib
+
+
+def read_toml_config(config, path, files=None, parsed=None):
+    """ Returns a list of all values of the config file and the files it
+        extends.
+
+        Top level tables are section groups and the tables in them are
+        sections. Options keep their TOML types, so booleans and numbers
+        don't need massagers. Macros use the quoted ``"<"`` key.
+
+        The ``files`` and ``parsed`` arguments are the same as for
+        ``read_config``.
+    """
+    tomllib = _get_toml_module()
+
+    def parse(f):
+        data = f.read()
+        if not isinstance(data, type('')):
+            data = data.decode('utf-8')
+        return tomllib.loads(data)
+
+    return _read_mapping_config(
+        config, path, parse, mode='rb', files=files, parsed=parsed)
 
 
 def _make_comment(value, indent):
@@ -572,53 +991,347 @@ def _make_comment(value, indent):
     return result
 
 
+class _ConfigIndex(object):
+    """ Maps section names to section groups, keys to sections, master ids
+        to sections and macros to the sections using them.
+
+        Entries are only added when values are set. Lookups have to check
+        the config, as the entries may be outdated.
+    """
+    __slots__ = ('groups', 'keys', 'macros', 'masters')
+
+    def __init__(self):
+        self.groups = {}
+        self.keys = {}
+        self.macros = {}
+        self.masters = {}
+
+    def add_key(self, sectiongroupname, sectionname, key, value):
+        # the sets are per section group to avoid creating tuples
+        sectiongroups = self.keys.get(key)
+        if sectiongroups is None:
+            sectiongroups = self.keys[key] = {}
+        sections = sectiongroups.get(sectiongroupname)
+        if sections is None:
+            sections = sectiongroups[sectiongroupname] = set()
+        sections.add(sectionname)
+        if key == 'master':
+            value = value.value
+            if isinstance(value, basestring):
+                for master in value.split():
+                    self.masters.setdefault(master, {}).setdefault(
+                        sectiongroupname, set()).add(sectionname)
+        elif key == '<':
+            value = value.value
+            if isinstance(value, basestring):
+                for macroname in value.split():
+                    if ':' not in macroname:
+                        macroname = "%s:%s" % (sectiongroupname, macroname)
+                    self.macros.setdefault(macroname, {}).setdefault(
+                        sectiongroupname, set()).add(sectionname)
+
+    def iter_sections(self, index, key):
+        for sectiongroupname, sectionnames in index.get(key, {}).items():
+            for sectionname in sectionnames:
+                yield (sectiongroupname, sectionname)
+
+    def add_group(self, sectiongroupname, sectionname):
+        # tuples use less memory than sets and there are rarely more than
+        # a few section groups with the same section name
+        sectiongroupnames = self.groups.get(sectionname, ())
+        if sectiongroupname not in sectiongroupnames:
+            self.groups[sectionname] = sectiongroupnames + (sectiongroupname,)
+
+    def add_section(self, sectiongroupname, sectionname, section):
+        self.add_group(sectiongroupname, sectionname)
+        for key, value in section._dict.items():
+            self.add_key(sectiongroupname, sectionname, key, value)
+
+
+class _PendingSection(object):
+    """ The values and massagers of a section in a lazy config, which isn't
+        created yet. """
+    __slots__ = (
+        '_config', '_dict', '_massagers', 'sectiongroupname', 'sectionname')
+
+    def __init__(self, sectiongroupname, sectionname, config):
+        self._config = config
+        self._dict = {}
+        self._massagers = []
+        self.sectiongroupname = sectiongroupname
+        self.sectionname = sectionname
+
+    def __setitem__(self, key, value):
+        self._dict[key] = value
+        self._config._values.append(
+            (self.sectiongroupname, self.sectionname, key, value))
+        self._config._index.add_key(
+            self.sectiongroupname, self.sectionname, key, value)
+
+    def add_massager(self, massager):
+        self._massagers.append(massager)
+
+
+class _SectionDict(MutableMapping):
+    """ The sections of a section group in a lazy config.
+
+        Pending sections are created on first access.
+    """
+    __slots__ = ('_config', '_data', 'sectiongroupname')
+
+    def __init__(self, config, sectiongroupname):
+        self._config = config
+        self._data = {}
+        self.sectiongroupname = sectiongroupname
+
+    def __getitem__(self, key):
+        value = self._data[key]
+        if value.__class__ is _PendingSection:
+            value = self._config._materialize(self, key, value)
+        return value
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __setitem__(self, key, value):
+        self._data[key] = value
+
+    def __delitem__(self, key):
+        del self._data[key]
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+
 class Config(ConfigSection):
-    def _expand(self, sectiongroupname, sectionname, section, seen):
+    def _expand(self, sectiongroupname, sectionname, section, seen, expanded=None):
+        # macros are expanded depth first, so they are complete before they
+        # are used. The ``expanded`` dict caches the values of a macro after
+        # applying the macro cleaners of the section group using it
+        if expanded is None:
+            expanded = {}
         if (sectiongroupname, sectionname) in seen:
             raise ValueError("Circular macro expansion.")
         seen.add((sectiongroupname, sectionname))
         macronames = section['<'].split()
+        _dict = section._dict
         for macroname in macronames:
             if ':' in macroname:
                 macrogroupname, macroname = macroname.split(':')
             else:
                 macrogroupname = sectiongroupname
-            macro = self[macrogroupname][macroname]
-            if '<' in macro:
-                self._expand(macrogroupname, macroname, macro, seen)
-            if sectiongroupname in self.macro_cleaners:
-                macro = macro.copy()
-                self.macro_cleaners[sectiongroupname](macro)
-            for key in macro:
-                if key not in section:
-                    section._dict[key] = macro._dict[key]
+            macro_key = (macrogroupname, macroname, sectiongroupname)
+            items = expanded.get(macro_key)
+            if items is None:
+                macro = self[macrogroupname][macroname]
+                if '<' in macro._dict:
+                    self._expand(macrogroupname, macroname, macro, seen, expanded)
+                if sectiongroupname in self.macro_cleaners:
+                    macro = macro.copy()
+                    self.macro_cleaners[sectiongroupname](macro)
+                items = expanded[macro_key] = list(macro._dict.items())
+            for key, value in items:
+                if key not in _dict:
+                    _dict[key] = value
+                    self._index.add_key(
+                        sectiongroupname, sectionname, key, value)
         # this needs to be after the recursive _expand call, so circles are
         # properly detected
         del section['<']
 
-    def __init__(self, config, path=None, plugins=None):
+    def __init__(self, config, path=None, plugins=None, lazy=False):
         ConfigSection.__init__(self)
+        self._expanded = {}
+        self._index = _ConfigIndex()
         self._values = []
+        # if true, sections are only created and their macros expanded when
+        # they are accessed for the first time
+        self.lazy = lazy
         self.config = config
+        self.files = []
+        # shared by all sections to refer back to the config
+        self._weakself = proxy(self)
+        # how the source of values set from code is recorded, 'full' formats
+        # it immediately, 'lazy' only when it's accessed and None disables it
+        self.provenance = 'lazy'
         if path is None:
             if getattr(config, 'read', None) is None:
                 path = os.path.dirname(config)
         self.path = path
         self.macro_cleaners = {}
+        self.schemas = {}
+        self._records = {}
         if plugins is not None:
             for plugin in plugins.values():
                 for massager in plugin.get('get_massagers', lambda: [])():
                     self.add_massager(massager)
+                for schema in plugin.get('get_schemas', lambda: [])():
+                    self.add_schema(schema)
                 if 'get_macro_cleaners' in plugin:
                     self.macro_cleaners.update(plugin['get_macro_cleaners'](self))
 
+    def __setitem__(self, key, value):
+        ConfigSection.__setitem__(self, key, value)
+        if isinstance(value, ConfigSection):
+            value.sectiongroupname = key
+            value._group_index = self._index
+            sections = value._dict
+            if isinstance(sections, _SectionDict):
+                sections = sections._data
+            for sectionname, section in sections.items():
+                if section.__class__ is not _PendingSection:
+                    section = section.value
+                self._index.add_section(key, sectionname, section)
+
+    def _get_raw_section(self, sectiongroupname, sectionname):
+        # returns the section or pending section without creating it
+        sectiongroup = self._dict.get(sectiongroupname)
+        if sectiongroup is None:
+            return
+        sections = sectiongroup.value._dict
+        if isinstance(sections, _SectionDict):
+            sections = sections._data
+        section = sections.get(sectionname)
+        if section is None or section.__class__ is _PendingSection:
+            return section
+        return section.value
+
+    def get_section_groups(self, sectionname):
+        """ Returns the sorted names of the section groups which have a
+            section with the given name. """
+        return sorted(
+            x for x in self._index.groups.get(sectionname, ())
+            if self._get_raw_section(x, sectionname) is not None)
+
+    def get_sections_with_key(self, key):
+        """ Returns a sorted list of (sectiongroupname, sectionname) tuples of
+            all sections with the given key. """
+        index = self._index
+        names = set(index.iter_sections(index.keys, key))
+        # sections in a lazy config only get the keys of their macros
+        # once they are created, so those using the found ones are checked
+        pending = list(names)
+        while pending:
+            macroname = "%s:%s" % pending.pop()
+            for name in index.iter_sections(index.macros, macroname):
+                if name not in names:
+                    names.add(name)
+                    pending.append(name)
+        result = []
+        for name in names:
+            section = self._get_raw_section(*name)
+            if section is None:
+                continue
+            if key not in section._dict and '<' in section._dict:
+                section = self[name[0]][name[1]]
+            if key in section._dict:
+                result.append(name)
+        return sorted(result)
+
+    def get_sections_for_master(self, master):
+        """ Returns a sorted list of (sectiongroupname, sectionname) tuples of
+            all sections which have the given id in their ``master`` option.
+        """
+        result = []
+        for name in self._index.iter_sections(self._index.masters, master):
+            section = self._get_raw_section(*name)
+            if section is None:
+                continue
+            value = section._dict.get('master')
+            if value is None or not isinstance(value.value, basestring):
+                continue
+            if master in value.value.split():
+                result.append(name)
+        return sorted(result)
+
+    def add_schema(self, schema):
+        if schema.sectiongroupname in self.schemas:
+            raise ValueError("Schema for section group '%s' already registered." % schema.sectiongroupname)
+        for massager in schema.get_massagers():
+            self.add_massager(massager)
+        self.schemas[schema.sectiongroupname] = schema
+
+    def compile_schemas(self):
+        """ Checks the options of all sections in section groups with a
+            schema.
+
+            Only the values stored in the sections are checked, so pending
+            sections of a lazy config aren't created. Values from macros are
+            checked with the sections of the macros. All conversion errors
+            are logged before exiting.
+        """
+        errors = []
+        # most values are the same in many sections, the results of
+        # memoizing massagers only depend on the value
+        checked = set()
+        check = ConfigSection()
+        check._config = self._weakself
+        for sectiongroupname, schema in sorted(self.schemas.items()):
+            sectiongroup = self._dict.get(sectiongroupname)
+            if sectiongroup is None:
+                continue
+            sections = sectiongroup.value._dict
+            if isinstance(sections, _SectionDict):
+                sections = sections._data
+            check.sectiongroupname = sectiongroupname
+            for sectionname, section in sections.items():
+                if section.__class__ is not _PendingSection:
+                    section = section.value
+                check.sectionname = sectionname
+                check._dict = section._dict
+                for key, name, massager in schema.massagers:
+                    value = section._dict.get(key)
+                    if value is None:
+                        continue
+                    value_key = None
+                    if getattr(massager, '_memoize', False):
+                        value_key = (key, value.path, repr(value.value))
+                        if value_key in checked:
+                            continue
+                    try:
+                        massager(check, sectionname)
+                    except Exception as e:
+                        errors.append(
+                            "Invalid value for '%s' in section '%s:%s': %s" % (
+                                key, sectiongroupname, sectionname, e))
+                    else:
+                        checked.add(value_key)
+        if errors:
+            for error in errors:
+                log.error(error)
+            sys.exit(1)
+
+    def get_record(self, sectiongroupname, sectionname, section=None):
+        """ Returns a record with the typed options of a section in a
+            section group with a schema.
+
+            If ``section`` is given, it's used instead of the one in the
+            config, for example for the config of an instance with overrides.
+            The record is reused as long as the values stay the same.
+        """
+        schema = self.schemas[sectiongroupname]
+        if section is None:
+            section = self[sectiongroupname][sectionname]
+        values = tuple(section._dict.get(x[0]) for x in schema.massagers)
+        cached = self._records.get((sectiongroupname, sectionname))
+        if cached is not None:
+            if all(a is b for a, b in zip(cached[0], values)):
+                return cached[1]
+        record = schema.get_record(section)
+        if schema.memoize:
+            self._records[(sectiongroupname, sectionname)] = (values, record)
+        return record
+
     def get_section(self, sectiongroupname, sectionname):
         sectiongroup = self[sectiongroupname]
         if sectionname not in sectiongroup:
             section = ConfigSection()
             section.sectiongroupname = sectiongroupname
             section.sectionname = sectionname
-            section._config = proxy(self)
+            section._config = self._weakself
             sectiongroup[sectionname] = section
         return sectiongroup[sectionname]
 
@@ -634,8 +1347,7 @@ class Config(ConfigSection):
             if sectiongroupname == 'global' and sectionname == 'global' and info.key == 'extends':
                 self._values.append((sectiongroupname, sectionname, info.key, ConfigValue(info.path, info.value, src=info.src, comment=info.comments)))
                 continue
-            sectiongroup = self.setdefault(sectiongroupname, ConfigSection())
-            self.get_section(sectiongroupname, sectionname)
+            section = self._get_parse_section(sectiongroupname, sectionname)
             if info.key is None:
                 self._values.append((sectiongroupname, sectionname, info.key, ConfigValue(info.path, info.value, src=info.src, comment=info.comments)))
             else:
@@ -681,44 +1393,161 @@ class Config(ConfigSection):
                         if massager_sectionname is None:
                             self.add_massager(massager)
                         else:
-                            massager_section = self.get_section(
+                            massager_section = self._get_parse_section(
                                 sectiongroupname, massager_sectionname)
                             massager_section.add_massager(massager)
                 else:
-                    sectiongroup[sectionname][info.key] = ConfigValue(
+                    key = info.key
+                    if isinstance(key, str):
+                        # YAML allows keys like numbers
+                        key = intern(key)
+                    section[key] = ConfigValue(
                         info.path, info.value, src=info.src, comment=info.comments)
         if 'plugin' in self:  # pragma: no cover
             warnings.warn("The 'plugin' section isn't used anymore.")
             del self['plugin']
+        if not self.lazy:
+            self._expand_all()
+        return self
+
+    def _expand_all(self):
         seen = set()
         for sectiongroupname in self:
             sectiongroup = self[sectiongroupname]
             for sectionname in sectiongroup:
                 section = sectiongroup[sectionname]
-                if '<' in section:
-                    self._expand(sectiongroupname, sectionname, section, seen)
-        return self
+                if '<' in section._dict:
+                    self._expand(
+                        sectiongroupname, sectionname, section, seen,
+                        self._expanded)
+
+    def _adopt_section(self, sectiongroupname, sectionname, section):
+        """ Stores a section of another config, which then refers to this
+            one. """
+        section._config = self._weakself
+        # massagers and massaged values have to be looked up again
+        section._dispatch_serial = None
+        self.setdefault(sectiongroupname, ConfigSection())
+        self[sectiongroupname][sectionname] = section
+
+    def _get_parse_section(self, sectiongroupname, sectionname):
+        if not self.lazy:
+            self.setdefault(sectiongroupname, ConfigSection())
+            return self.get_section(sectiongroupname, sectionname)
+        if sectiongroupname not in self._dict:
+            sectiongroup = ConfigSection()
+            sectiongroup._dict = _SectionDict(self._weakself, sectiongroupname)
+            self[sectiongroupname] = sectiongroup
+        sections = self._dict[sectiongroupname].value._dict
+        if not isinstance(sections, _SectionDict):
+            return self.get_section(sectiongroupname, sectionname)
+        section = sections._data.get(sectionname)
+        if section is None:
+            section = sections._data[sectionname] = _PendingSection(
+                sectiongroupname, sectionname, self._weakself)
+            self._index.add_group(sectiongroupname, sectionname)
+        elif section.__class__ is not _PendingSection:
+            section = section.value
+        return section
+
+    def _materialize(self, sections, sectionname, pending):
+        section = ConfigSection()
+        section.sectiongroupname = pending.sectiongroupname
+        section.sectionname = sectionname
+        section._config = self._weakself
+        section._dict.update(pending._dict)
+        # stored before expanding, so circular macros are detected
+        value = sections._data[sectionname] = ConfigValue(None, section)
+        for massager in pending._massagers:
+            section.add_massager(massager)
+        if '<' in section._dict:
+            self._expand(
+                pending.sectiongroupname, sectionname, section, set(),
+                self._expanded)
+        return value
 
     def parse(self):
         if isinstance(self.config, basestring) and self.config.endswith('.yml'):
-            _config = read_yml_config(self.config, self.path)
+            _config = read_yml_config(self.config, self.path, files=self.files)
+        elif isinstance(self.config, basestring) and self.config.endswith('.toml'):
+            _config = read_toml_config(self.config, self.path, files=self.files)
         else:
-            _config = read_config(self.config, self.path)
+            _config = read_config(self.config, self.path, files=self.files)
         return self._parse(_config)
 
+    def _get_state(self):
+        sectiongroups = []
+        for sectiongroupname, sectiongroup in self._dict.items():
+            sections = []
+            items = sectiongroup.value._dict
+            if isinstance(items, _SectionDict):
+                # don't create pending sections
+                items = items._data
+            for sectionname, section in items.items():
+                if section.__class__ is _PendingSection:
+                    massagers = section._massagers
+                else:
+                    section = section.value
+                    massagers = (section._massagers or {}).values()
+                sections.append((
+                    sectionname,
+                    list(section._dict.items()),
+                    list(massagers)))
+            sectiongroups.append((sectiongroupname, sections))
+        return dict(
+            files=self.files,
+            massagers=list(self.massagers.values()),
+            sectiongroups=sectiongroups,
+            values=self._values)
+
+    def _set_state(self, state):
+        for massager in state['massagers']:
+            self.add_massager(massager)
+        for sectiongroupname, sections in state['sectiongroups']:
+            for sectionname, items, massagers in sections:
+                section = self._get_parse_section(sectiongroupname, sectionname)
+                section._dict.update(items)
+                for key, value in items:
+                    self._index.add_key(
+                        sectiongroupname, sectionname, key, value)
+                for massager in massagers:
+                    section.add_massager(massager)
+        self.files = state['files']
+        self._values = state['values']
+        if not self.lazy:
+            self._expand_all()
+        return self
+
     def get_section_with_overrides(self, sectiongroupname, sectionname, overrides):
         config = self[sectiongroupname][sectionname].copy()
         if overrides is not None:
             config._dict.update(overrides)
         return config
 
-    def _dump_yaml(self, writer):
-        from ruamel.yaml import YAML
+    def _iter_yaml_values(self):
+        # groups the values by file, keeping the order of first appearance
+        result = {}
+        order = []
+        for item in self._values:
+            value = item[3]
+            if value.path:
+                conf_key = os.path.abspath(value.src)
+            else:
+                conf_key = None
+            values = result.get(conf_key)
+            if values is None:
+                values = result[conf_key] = []
+                order.append(conf_key)
+            values.append(item)
+        for conf_key in order:
+            yield (conf_key, result.pop(conf_key))
+
+    def _make_yaml(self, values):
         from ruamel.yaml.comments import CommentedMap, CommentedSeq
-        configs = dict()
+        conf = CommentedMap()
         sectiongroup = None
         section = None
-        for sectiongroupname, sectionname, key, value in self._values:
+        for sectiongroupname, sectionname, key, value in values:
             if value.comment:
                 (prefix_comment, comment) = value.comment
             else:
@@ -727,11 +1556,6 @@ class Config(ConfigSection):
                 prefix_comment = "\n".join(x[1].rstrip() for x in prefix_comment)
             if comment:
                 comment = "\n".join(x[1][1:].rstrip() for x in comment)
-            if value.path:
-                conf_key = os.path.abspath(value.src)
-            else:
-                conf_key = None
-            conf = configs.setdefault(conf_key, CommentedMap())
             if sectiongroupname is None:
                 assert sectionname is None
                 if prefix_comment:
@@ -777,7 +1601,22 @@ class Config(ConfigSection):
             else:
                 if prefix_comment:
                     sectiongroup._yaml_add_comment([None, _make_comment(prefix_comment, 4)], key=sectionname)
-        for conf in configs:
+        return conf
+
+    def _dump_yaml(self, writer, workers=4):
+        """ Converts the values of each file to YAML and passes the result
+            to ``writer``.
+
+            The values are massaged in this thread one file after another,
+            rendering and writing happens in up to ``workers`` threads. At
+            most ``workers`` converted files are pending at a time.
+
+            Returns a list of ``(conf, seconds)`` tuples with the time spent
+            on each file.
+        """
+        from ruamel.yaml import YAML
+
+        def dump(conf, data, start):
             if conf is None:
                 dirname = None
                 basename = None
@@ -786,20 +1625,397 @@ class Config(ConfigSection):
             yaml = YAML(typ='rt')
             content = BytesIO()
             yaml.indent(mapping=4, sequence=4, offset=2)
-            yaml.dump(configs[conf], content)
+            yaml.dump(data, content)
             writer(dirname, basename, content.getvalue())
+            return time.time() - start
+
+        executor = None
+        if ThreadPoolExecutor is not None and workers > 1:
+            executor = ThreadPoolExecutor(max_workers=workers)
+        pending = []
+        result = []
+        try:
+            for conf, values in self._iter_yaml_values():
+                start = time.time()
+                data = self._make_yaml(values)
+                if executor is None:
+                    result.append((conf, dump(conf, data, start)))
+                    continue
+                if len(pending) >= workers:
+                    (_conf, future) = pending.pop(0)
+                    result.append((_conf, future.result()))
+                pending.append((conf, executor.submit(dump, conf, data, start)))
+            for conf, future in pending:
+                result.append((conf, future.result()))
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        return result
+
+    def dump_yaml(self, workers=4):
+        def get_filename(dirname, basename):
+            return os.path.join(dirname, basename.replace('.conf', '.yml'))
 
-    def dump_yaml(self):
         def writer(dirname, basename, value):
             if dirname is None:
                 return
-            filename = os.path.join(dirname, basename.replace('.conf', '.yml'))
-            with open(filename, 'w') as f:
+            with open(get_filename(dirname, basename), 'wb') as f:
                 f.write(value)
-            log.info('Wrote %s', os.path.relpath(filename))
-        self._dump_yaml(writer)
+        for conf, seconds in self._dump_yaml(writer, workers=workers):
+            if conf is None:
+                continue
+            log.info(
+                'Wrote %s in %.2f s',
+                os.path.relpath(get_filename(*os.path.split(conf))), seconds)
         sys.exit(0)
 
+    def dump_snapshot(self, f):
+        """ Writes a binary snapshot of the fully expanded config to the
+            file object ``f``.
+
+            The snapshot contains the values with their provenance and the
+            massagers, so ``load_snapshot`` can restore the config without
+            reading any of the original files.
+        """
+        # create all pending sections, so the snapshot contains the
+        # expanded macros
+        for sectiongroupname in self:
+            sectiongroup = self[sectiongroupname]
+            for sectionname in sectiongroup:
+                sectiongroup[sectionname]
+        config = self.config
+        if not isinstance(config, basestring):
+            config = None
+        data = dict(
+            config=config, path=self.path,
+            state=_encode_snapshot_state(self._get_state()))
+        try:
+            data = json.dumps(data, separators=(',', ':'))
+        except TypeError as e:
+            raise ValueError("Can't store config in a snapshot: %s" % e)
+        f.write(SNAPSHOT_MAGIC)
+        f.write(struct.pack('>H', SNAPSHOT_VERSION))
+        f.write(zlib.compress(data.encode('utf-8')))
+
+
+def get_cache_dir():
+    """ Returns the directory for cached configs.
+
+        It can be set with the ``PLOY_CACHE_DIR`` environment variable,
+        setting it to an empty value disables caching.
+    """
+    cache_dir = os.environ.get('PLOY_CACHE_DIR')
+    if cache_dir is None:
+        cache_dir = os.path.join(
+            os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+            'ploy')
+    return cache_dir or None
+
+
+def _get_files_signature(files):
+    result = []
+    for fn in files:
+        st = os.stat(fn)
+        result.append((fn, st.st_size, st.st_mtime))
+    return result
+
+
+class ConfigCache(object):
+    """ Stores the parsed config on disk.
+
+        The cache is only valid as long as the size and modification time of
+        all files in the ``extends`` chain are the same. The source of values
+        is relative to the working directory, so there is a separate cache
+        for each directory ploy runs in. The config is stored as JSON in the
+        same way as snapshots, so reading the cache can't run code.
+    """
+    version = 2
+    # files modified more recently than this aren't cached, because another
+    # change within the timestamp resolution wouldn't be detected
+    min_age = 2
+
+    def __init__(self, config, cache_dir=_marker, options=None):
+        if cache_dir is _marker:
+            cache_dir = get_cache_dir()
+        self.cache_dir = cache_dir
+        self.path = None
+        cwd = os.getcwd()
+        if cache_dir is not None:
+            name = hashlib.sha1(
+                ("%s\0%s" % (config.config, cwd)).encode('utf-8')).hexdigest()
+            self.path = os.path.join(cache_dir, '%s.json' % name)
+        key = (
+            self.version,
+            sys.version_info[:2],
+            cwd,
+            sorted(
+                (
+                    x.__class__.__module__, x.__class__.__name__,
+                    x.sectiongroupname or '', x.key)
+                for x in config.massagers.values()),
+            sorted(config.macro_cleaners),
+            sorted((options or {}).items()))
+        # the same as after reading it from the file
+        self.key = json.loads(json.dumps(key))
+
+    def load(self):
+        if self.path is None:
+            return
+        try:
+            with open(self.path, 'rb') as f:
+                data = json.loads(f.read().decode('utf-8'))
+        except Exception as e:
+            if os.path.exists(self.path):
+                log.debug("Couldn't read cached config '%s': %s", self.path, e)
+            return
+        if data.get('key') != self.key:
+            return
+        try:
+            files = _get_files_signature(data['state']['files'])
+        except OSError:
+            return
+        if [list(x) for x in files] != data['files']:
+            return
+        return data['state']
+
+    def save(self, config):
+        if self.path is None or not config.files:
+            return
+        try:
+            files = _get_files_signature(config.files)
+        except OSError:
+            return
+        now = time.time()
+        if any(now - x[2] < self.min_age for x in files):
+            return
+        try:
+            data = json.dumps(dict(
+                key=self.key, files=files,
+                state=_encode_snapshot_state(config._get_state())))
+        except (TypeError, ValueError) as e:
+            log.debug("Couldn't cache config '%s': %s", config.config, e)
+            return
+        tmp = None
+        try:
+            if not os.path.exists(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            (fd, tmp) = tempfile.mkstemp(dir=self.cache_dir)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data.encode('utf-8'))
+            getattr(os, 'replace', os.rename)(tmp, self.path)
+        except Exception as e:
+            log.debug("Couldn't write cached config '%s': %s", self.path, e)
+            if tmp is not None and os.path.exists(tmp):
+                os.remove(tmp)
+
+
+def load_config(fn, plugins, reader, parsed=None, **kw):
+    config = Config(fn, plugins=plugins, lazy=True)
+    cache = ConfigCache(config, options=kw)
+    # with ``parsed`` the files are read, so their results can be kept
+    state = None if parsed is not None else cache.load()
+    if state is not None:
+        try:
+            return config._set_state(
+                _decode_snapshot_state(state, config.massagers))
+        except Exception as e:
+            log.debug("Couldn't use cached config '%s': %s", cache.path, e)
+            config = Config(fn, plugins=plugins, lazy=True)
+    if parsed is not None:
+        kw['parsed'] = parsed
+    config._parse(reader(config.config, config.path, files=config.files, **kw))
+    if parsed is not None:
+        for name in set(parsed).difference(config.files):
+            del parsed[name]
+    cache.save(config)
+    return config
+
+
+def _get_config_sections(state):
+    """ Returns a dict of comparable contents of all sections from the
+        result of ``Config._get_state``.
+    """
+    def massager_ids(massagers):
+        return sorted(
+            (
+                x.__class__.__module__, x.__class__.__name__,
+                x.sectiongroupname or '', x.key)
+            for x in massagers)
+
+    result = {None: massager_ids(state['massagers'])}
+    for sectiongroupname, sections in state['sectiongroups']:
+        for sectionname, items, massagers in sections:
+            result[(sectiongroupname, sectionname)] = (
+                sorted(
+                    ((k, v.value, v.path) for k, v in items),
+                    key=lambda x: x[0]),
+                massager_ids(massagers))
+    return result
+
+
+def _diff_config_sections(old, new):
+    """ Returns a sorted list of (sectiongroupname, sectionname) tuples of
+        sections which were added, removed or changed between the results of
+        two ``_get_config_sections`` calls.
+
+        Sections which use a changed section as macro are changed as well.
+        If the global massagers changed, all sections are.
+    """
+    names = set(old).union(new)
+    names.discard(None)
+    if old.get(None) != new.get(None):
+        return sorted(names)
+    changed = set(x for x in names if old.get(x) != new.get(x))
+    users = {}
+    for name in names:
+        items = dict((k, v) for k, v, p in new.get(name, ((), ()))[0])
+        for macroname in items.get('<', '').split():
+            if ':' in macroname:
+                macro = tuple(macroname.split(':'))
+            else:
+                macro = (name[0], macroname)
+            users.setdefault(macro, []).append(name)
+    pending = list(changed)
+    while pending:
+        for user in users.get(pending.pop(), ()):
+            if user not in changed:
+                changed.add(user)
+                pending.append(user)
+    return sorted(changed)
+
+
+def _get_massager_name(massager):
+    cls = massager.__class__
+    name = "%s.%s" % (cls.__module__, cls.__name__)
+    try:
+        resolved = resolve_dotted_name(name)
+    except (ImportError, AttributeError):
+        resolved = None
+    if resolved is not cls:
+        raise ValueError(
+            "Can't store massager '%s' in a snapshot, it needs to be importable." % name)
+    return name
+
+
+def _encode_snapshot_state(state):
+    """ Converts the result of ``Config._get_state`` to plain data.
+
+        Each value is stored once in a list and referred to by its index.
+        Massagers are stored by the dotted name of their class.
+    """
+    values = []
+    indexes = {}
+
+    def encode_value(value):
+        index = indexes.get(id(value))
+        if index is None:
+            index = indexes[id(value)] = len(values)
+            values.append([value.path, value.value, value.src, value.comment])
+        return index
+
+    def encode_massagers(massagers):
+        return [
+            [_get_massager_name(x), x.sectiongroupname, x.key]
+            for x in massagers]
+
+    return dict(
+        files=state['files'],
+        massagers=encode_massagers(state['massagers']),
+        sectiongroups=[
+            [sectiongroupname, [
+                [
+                    sectionname,
+                    [[k, encode_value(v)] for k, v in items],
+                    encode_massagers(massagers)]
+                for sectionname, items, massagers in sections]]
+            for sectiongroupname, sections in state['sectiongroups']],
+        values=[
+            [sectiongroupname, sectionname, key, encode_value(value)]
+            for sectiongroupname, sectionname, key, value in state['values']],
+        value_table=values)
+
+
+def _decode_comment(comment):
+    # JSON turns the tuples of comments into lists
+    if comment is None:
+        return
+    (prefix_comment, comment) = (
+        None if x is None else [tuple(y) for y in x] for x in comment)
+    return _make_comments(prefix_comment, comment)
+
+
+def _decode_snapshot_state(data, massagers):
+    """ Rebuilds the result of ``Config._get_state`` from the plain data
+        written by ``_encode_snapshot_state``.
+
+        Massagers which are already in ``massagers`` with the same class
+        are left out, so the ones of plugins aren't registered twice.
+    """
+    values = [
+        ConfigValue(path, value, src=src, comment=_decode_comment(comment))
+        for path, value, src, comment in data['value_table']]
+
+    def decode_massager(name, sectiongroupname, key):
+        cls = resolve_dotted_name(name)
+        if not (isinstance(cls, type) and issubclass(cls, BaseMassager)):
+            raise ValueError("'%s' isn't a massager." % name)
+        return cls(sectiongroupname, key)
+
+    def decode_massagers(items, existing=None):
+        result = []
+        for name, sectiongroupname, key in items:
+            massager = None
+            if existing is not None:
+                massager = existing.get((sectiongroupname, key))
+            if massager is not None:
+                cls = massager.__class__
+                if name == "%s.%s" % (cls.__module__, cls.__name__):
+                    continue
+            result.append(decode_massager(name, sectiongroupname, key))
+        return result
+
+    return dict(
+        files=data['files'],
+        massagers=decode_massagers(data['massagers'], massagers),
+        sectiongroups=[
+            (sectiongroupname, [
+                (
+                    sectionname,
+                    [(k, values[i]) for k, i in items],
+                    decode_massagers(section_massagers))
+                for sectionname, items, section_massagers in sections])
+            for sectiongroupname, sections in data['sectiongroups']],
+        values=[
+            (sectiongroupname, sectionname, key, values[i])
+            for sectiongroupname, sectionname, key, i in data['values']])
+
+
+def load_snapshot(f, path=None, plugins=None):
+    """ Returns a ``Config`` from a snapshot written by
+        ``Config.dump_snapshot``.
+
+        The ``path`` defaults to the directory of the original config.
+        Snapshots only contain data, the massagers are imported by the
+        dotted name of their class.
+    """
+    header = f.read(len(SNAPSHOT_MAGIC) + 2)
+    if header[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+        raise ValueError("Not a config snapshot.")
+    (version,) = struct.unpack('>H', header[len(SNAPSHOT_MAGIC):])
+    if version != SNAPSHOT_VERSION:
+        raise ValueError("Unsupported config snapshot version %s." % version)
+    data = json.loads(zlib.decompress(f.read()).decode('utf-8'))
+    if path is None:
+        path = data['path']
+    config = Config(
+        data['config'] or getattr(f, 'name', ''),
+        path=path, plugins=plugins, lazy=True)
+    try:
+        state = _decode_snapshot_state(data['state'], config.massagers)
+    except (ImportError, AttributeError, KeyError, TypeError) as e:
+        raise ValueError("Invalid config snapshot: %s" % e)
+    return config._set_state(state)
+
 
 class ConfigPlugin:
     @hookimpl
@@ -808,13 +2024,10 @@ class ConfigPlugin:
             return fn
 
     @hookimpl
-    def ploy_load_config(self, fn, plugins):
+    def ploy_load_config(self, fn, plugins, parsed):
         if not fn.endswith('.conf'):
             return
-        config = Config(fn, plugins=plugins)
-        _config = read_config(config.config, config.path)
-        config._parse(_config)
-        return config
+        return load_config(fn, plugins, read_config, parsed=parsed)
 
 
 class YamlConfigPlugin:
@@ -825,10 +2038,41 @@ class YamlConfigPlugin:
             return fn
 
     @hookimpl
-    def ploy_load_config(self, fn, plugins):
+    def ploy_load_config(self, fn, plugins, round_trip, parsed):
         if not fn.endswith('.yml'):
             return
-        config = Config(fn, plugins=plugins)
-        _config = read_yml_config(config.config, config.path)
-        config._parse(_config)
-        return config
+        return load_config(
+            fn, plugins, read_yml_config, parsed=parsed,
+            round_trip=round_trip)
+
+
+class TomlConfigPlugin:
+    @hookimpl
+    def ploy_locate_config(self, fn):
+        fn = os.path.splitext(fn)[0] + '.toml'
+        if os.path.exists(fn):
+            return fn
+
+    @hookimpl
+    def ploy_load_config(self, fn, plugins, parsed):
+        if not fn.endswith('.toml'):
+            return
+        return load_config(fn, plugins, read_toml_config, parsed=parsed)
+
+
+class SnapshotConfigPlugin:
+    @hookimpl
+    def ploy_locate_config(self, fn):
+        if fn.endswith('.snapshot') and os.path.exists(fn):
+            return fn
+
+    @hookimpl
+    def ploy_load_config(self, fn, plugins):
+        if not fn.endswith('.snapshot'):
+            return
+        try:
+            with open(fn, 'rb') as f:
+                return load_snapshot(f, plugins=plugins)
+        except (ValueError, zlib.error) as e:
+            log.error("Couldn't load config snapshot '%s': %s", fn, e)
+            sys.exit(1)
@@ -0,0 +1,8 @@
+import sys
+
+
+# in the package, so it also applies when tox runs the installed copy
+collect_ignore = []
+if sys.version_info < (3, 7):
+    # uses async syntax
+    collect_ignore.extend(['aio.py', 'tests/test_aio.py'])
@@ -10,5 +10,13 @@ def ploy_locate_config(fn):
 
 
 @hookspec(firstresult=True)
-def ploy_load_config(fn, plugins):
-    pass
+def ploy_load_config(fn, plugins, round_trip, parsed):
+    """ Returns the loaded config.
+
+        If ``round_trip`` is true, the config is dumped again later on,
+        so the loader should preserve as much of the original as possible.
+
+        If ``parsed`` isn't ``None``, it's a dict in which the loader can
+        keep the parsed contents of each file, to only parse changed files
+        when the config is loaded again.
+    """
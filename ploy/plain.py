@@ -7,6 +7,7 @@ from ploy.common import SSHKeyFingerprintAsk
 from ploy.common import SSHKeyFingerprintIgnore
 from ploy.common import SSHKeyFingerprintInstance
 from ploy.common import SSHKeyInfo
+from ploy.common import conn_lock
 from ploy.common import parse_fingerprint, parse_ssh_keygen
 from ploy.common import split_option
 from ploy.common import wait_for_ssh, wait_for_ssh_on_sock
@@ -14,7 +15,6 @@ import getpass
 import hashlib
 import logging
 import os
-import paramiko
 import socket
 import subprocess
 import sys
@@ -24,6 +24,8 @@ log = logging.getLogger('ploy')
 
 
 def ServerHostKeyPolicy(*args, **kwarks):
+    import paramiko
+
     class ServerHostKeyPolicy(paramiko.MissingHostKeyPolicy):
         def __init__(self, fingerprints_func):
             self.fingerprints_func = fingerprints_func
@@ -73,6 +75,7 @@ class Instance(BaseInstance):
         return self.config.get('port', 22)
 
     def get_ssh_pub_host_keys(self):
+        import paramiko
         key_types_map = {
             'ssh-dss': paramiko.DSSKey,
             'ssh-rsa': paramiko.RSAKey}
@@ -105,6 +108,7 @@ class Instance(BaseInstance):
         return host_keys
 
     def get_ssh_fingerprints(self):
+        import paramiko
         fingerprints = self.config.get('ssh-fingerprints')
         if fingerprints is None:
             fingerprints = self.config.get('fingerprint')
@@ -165,6 +169,7 @@ class Instance(BaseInstance):
             return proxy_command.format(**d)
 
     def get_proxy_sock(self, hostname, port):
+        import paramiko
         proxy_command = self.proxy_command
         if proxy_command:
             try:
@@ -177,6 +182,7 @@ class Instance(BaseInstance):
         return sock
 
     def _fix_known_hosts(self, known_hosts):
+        import paramiko
         lines = []
         with open(known_hosts, 'r') as f:
             for lineno, line in enumerate(f):
@@ -195,7 +201,23 @@ class Instance(BaseInstance):
     def ssh_timeout(self):
         return int(self.config.get('ssh-timeout', 5))
 
+    @property
+    def record(self):
+        """ The typed options of the instance config, ``None`` if the
+            section group has no schema, like for subclasses from other
+            plugins. """
+        config = self.master.main_config
+        if self.sectiongroupname not in config.schemas:
+            return
+        return config.get_record(self.sectiongroupname, self.id, self.config)
+
     def init_ssh_key(self, user=None):
+        # hooks and plugins call this directly, also in threads
+        with conn_lock:
+            return self._init_ssh_key(user=user)
+
+    def _init_ssh_key(self, user=None):
+        import paramiko
         try:
             host = self.get_host()
         except KeyError:
@@ -216,6 +238,13 @@ class Instance(BaseInstance):
         client.set_missing_host_key_policy(ServerHostKeyPolicy(self.get_ssh_fingerprints))
         known_hosts = self.master.known_hosts
         client.known_hosts = None
+        record = self.record
+        if record is None:
+            config_user = self.config.get('user')
+            password_fallback = self.config.get('password-fallback', False)
+        else:
+            config_user = record.user
+            password_fallback = record.password_fallback
         while 1:
             sock_factory = partial(self.get_proxy_sock, hostname, port)
             wait_for_ssh_on_sock(sock_factory, timeout=self.ssh_timeout)
@@ -226,7 +255,8 @@ class Instance(BaseInstance):
             try:
                 if user is None:
                     user = self.sshconfig.get('user', 'root')
-                    user = self.config.get('user', user)
+                    if config_user is not None:
+                        user = config_user
                 client_args = dict(
                     port=int(port),
                     username=user,
@@ -236,7 +266,7 @@ class Instance(BaseInstance):
                 client.connect(hostname, **client_args)
                 break
             except paramiko.AuthenticationException:
-                if not self.config.get('password-fallback', False):
+                if not password_fallback:
                     log.error('Failed to connect to %s (%s)' % (self.config_id, hostname))
                     for option in ('username', 'password', 'port', 'key_filename', 'sock'):
                         if client_args[option] is not None:
@@ -291,13 +321,18 @@ class Master(BaseMaster):
     instance_class = Instance
 
 
-def get_massagers():
-    from ploy.config import BooleanMassager, UserMassager
+def get_schemas():
+    from ploy.config import BooleanMassager, Schema, UserMassager
 
-    sectiongroupname = 'plain-instance'
     return [
-        UserMassager(sectiongroupname, 'user'),
-        BooleanMassager(sectiongroupname, 'password-fallback')]
+        Schema('plain-instance', {
+            'user': UserMassager,
+            'password-fallback': BooleanMassager})]
+
+
+def get_massagers():
+    (schema,) = get_schemas()
+    return schema.get_massagers()
 
 
 def get_masters(ctrl):
@@ -307,5 +342,5 @@ def get_masters(ctrl):
 
 
 plugin = dict(
-    get_massagers=get_massagers,
-    get_masters=get_masters)
+    get_masters=get_masters,
+    get_schemas=get_schemas)
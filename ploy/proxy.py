@@ -14,7 +14,7 @@ class ProxyConfigSection(ConfigSection):
         ConfigSection.__setitem__(self, name, value)
         if not hasattr(self, '_proxied'):
             return
-        self._proxied[name] = value
+        self._proxied[name] = self._dict[name]
 
     def __delitem__(self, name):
         ConfigSection.__delitem__(self, name)
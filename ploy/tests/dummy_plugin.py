@@ -116,6 +116,7 @@ def augment_instance(instance):
 
 plugin = dict(
     augment_instance=augment_instance,
+    augmented_commands=[],
     get_list_commands=get_list_commands,
     get_massagers=get_massagers,
     get_masters=get_masters)
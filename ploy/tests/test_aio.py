@@ -0,0 +1,151 @@
+from __future__ import unicode_literals
+import os
+import pytest
+import subprocess
+
+
+class MockChannel(object):
+    def __init__(self, out, err, rc):
+        self.in_buffer = bytearray(out)
+        self.in_stderr_buffer = bytearray(err)
+        self.rc = rc
+        self.cmd = None
+        self.stdin = None
+        self.closed = False
+        # always readable, like the pipe of a channel with data in it
+        (self._r, self._w) = os.pipe()
+        os.write(self._w, b'x')
+
+    def exec_command(self, cmd):
+        self.cmd = cmd
+
+    def sendall(self, data):
+        self.stdin = data
+
+    def shutdown_write(self):
+        pass
+
+    def fileno(self):
+        return self._r
+
+    def recv_ready(self):
+        return len(self.in_buffer) > 0
+
+    def recv_stderr_ready(self):
+        return len(self.in_stderr_buffer) > 0
+
+    def _recv(self, buffer, nbytes):
+        # returns the data in small chunks to exercise the loop
+        nbytes = min(nbytes, 3)
+        data = bytes(buffer[:nbytes])
+        del buffer[:nbytes]
+        return data
+
+    def recv(self, nbytes):
+        return self._recv(self.in_buffer, nbytes)
+
+    def recv_stderr(self, nbytes):
+        return self._recv(self.in_stderr_buffer, nbytes)
+
+    def exit_status_ready(self):
+        return self.cmd is not None
+
+    def recv_exit_status(self):
+        return self.rc
+
+    def shutdown_read(self):
+        pass
+
+    def close(self):
+        self.closed = True
+        os.close(self._r)
+        os.close(self._w)
+
+
+class MockInstance(object):
+    uid = 'default-foo'
+    _ploy_forward_agent = False
+
+    def __init__(self, *channels):
+        self.channels = list(channels)
+        self.conn = self
+
+    def get_transport(self):
+        return self
+
+    def open_session(self):
+        return self.channels.pop(0)
+
+
+def run(coro):
+    import asyncio
+    return asyncio.run(coro)
+
+
+def test_call():
+    from ploy.aio import AsyncInstanceExecutor
+    chan = MockChannel(b'output\n', b'error', 0)
+    executor = AsyncInstanceExecutor(MockInstance(chan), prefix_args=('sudo',))
+    assert run(executor('ls', '-la', stdin=b'input')) == (0, b'output\n', b'error')
+    assert chan.cmd == 'sudo ls -la'
+    assert chan.stdin == b'input'
+    assert chan.closed
+
+
+def test_splitlines_and_checks():
+    from ploy.aio import AsyncInstanceExecutor
+    chan = MockChannel(b'foo\nbar\n', b'', 0)
+    executor = AsyncInstanceExecutor(MockInstance(chan), splitlines=True)
+    assert run(executor('ls', rc=0, err=b'')) == ['foo', 'bar']
+    chan = MockChannel(b'', b'failed', 1)
+    executor = AsyncInstanceExecutor(MockInstance(chan))
+    with pytest.raises(subprocess.CalledProcessError):
+        run(executor('ls', rc=0))
+
+
+def test_concurrent():
+    from ploy.aio import AsyncInstanceExecutor
+    import asyncio
+    channels = [MockChannel(b'%d' % i, b'', i % 2) for i in range(50)]
+    instance = MockInstance(*channels)
+
+    async def main():
+        return await asyncio.gather(*(
+            AsyncInstanceExecutor(instance)('echo', str(i))
+            for i in range(50)))
+
+    results = run(main())
+    assert sorted(results) == sorted(
+        (i % 2, b'%d' % i, b'') for i in range(50))
+
+
+def test_conn_setup_serialized():
+    from ploy.aio import AsyncInstanceExecutor
+    from ploy.common import BaseInstance
+    import asyncio
+    import time
+    active = []
+    overlaps = []
+
+    class Instance(BaseInstance):
+        sshconfig = {}
+
+        @property
+        def uid(self):
+            return self.id
+
+        def init_ssh_key(self, user=None):
+            active.append(self)
+            overlaps.append(len(active))
+            time.sleep(0.01)
+            active.remove(self)
+            return dict(client=MockInstance(MockChannel(b'', b'', 0)))
+
+    instances = [Instance(None, 'foo%s' % i, {}) for i in range(4)]
+
+    async def main():
+        return await asyncio.gather(*(
+            AsyncInstanceExecutor(x)('ls') for x in instances))
+
+    assert run(main()) == [(0, b'', b'')] * 4
+    assert overlaps == [1, 1, 1, 1]
@@ -225,6 +225,166 @@ class TestBaseMaster:
                 occurences.append(instance.uid)
         assert occurences == ['warden-separate']
 
+    def test_instances_created_on_access(self, ctrl):
+        instances = ctrl.instances
+        warden = ctrl.masters['warden']
+        assert 'ham' in warden.instances
+        assert warden.instances.get_created('ham') is None
+        assert 'separate' in warden.instances
+        assert warden.instances.get_created('separate') is None
+        instance = instances['warden-ham']
+        assert warden.instances.get_created('ham') is instance
+        assert instance.config_id == 'dummy-instance:ham'
+        assert ctrl.masters['master'].instances.get_created('ham') is None
+        assert warden.instances.get_created('foo') is None
+        assert instances['foo'] is warden.instances['foo']
+        assert warden.instances.get_created('separate') is None
+
+    def test_instance_conflict(self, ctrl, mock, ployconf):
+        ployconf.append([
+            '[instance:foo]',
+            'master = warden'])
+        with mock.patch('ploy.log') as LogMock:
+            with pytest.raises(SystemExit):
+                ctrl.instances
+        LogMock.error.assert_called_once_with(
+            "Instance 'instance:foo' conflicts with another instance with id 'foo' in master 'warden'.")
+
+
+class TestMasterInstanceDict:
+    def test_invalid_id(self, mock):
+        from ploy.common import MasterInstanceDict
+        instances = MasterInstanceDict()
+        factory = mock.Mock()
+        with mock.patch('ploy.common.log') as LogMock:
+            with pytest.raises(SystemExit):
+                instances.add_factory('fo o', factory, BaseInstance)
+        LogMock.error.assert_called_once_with(
+            "Invalid instance name 'fo o'. An instance name may only contain letters, numbers, dashes and underscores.")
+        assert 'fo o' not in instances
+
+    def test_custom_validate_id(self, mock):
+        from ploy.common import MasterInstanceDict
+
+        class Instance(BaseInstance):
+            def validate_id(self, sid):
+                return sid
+
+        instances = MasterInstanceDict()
+        factory = mock.Mock()
+        instances.add_factory('fo o', factory, Instance)
+        assert factory.call_count == 0
+        assert instances['fo o'] is factory.return_value
+
+
+def test_conn_setup_serialized(mock):
+    import threading
+    import time
+    active = []
+    overlaps = []
+
+    class Instance(BaseInstance):
+        sshconfig = {}
+
+        def init_ssh_key(self, user=None):
+            active.append(self)
+            overlaps.append(len(active))
+            time.sleep(0.01)
+            active.remove(self)
+            return dict(client=mock.MagicMock())
+
+    instances = [Instance(None, 'foo%s' % i, {}) for i in range(4)]
+    threads = [
+        threading.Thread(target=lambda x: x.conn, args=(x,))
+        for x in instances]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert overlaps == [1, 1, 1, 1]
+
+
+def test_prefixed_output():
+    from ploy.common import PrefixedOutput
+    from io import StringIO
+    import threading
+    stream = StringIO()
+    output = PrefixedOutput(stream, 'foo: ', threading.Lock())
+    output.write(b'one\ntw')
+    assert stream.getvalue() == 'foo: one\n'
+    output.write(b'o\n\xc3')
+    output.write(b'\xa4 end')
+    output.close()
+    assert stream.getvalue() == 'foo: one\nfoo: two\nfoo: \xe4 end\n'
+    stream = StringIO()
+    output = PrefixedOutput(stream)
+    output.write(b'partial')
+    assert stream.getvalue() == 'partial'
+
+
+@pytest.mark.parametrize("value, count, expected", [
+    ('10', 100, 10),
+    ('25%', 10, 3),
+    ('1%', 10, 1),
+    ('100%', 7, 7)])
+def test_get_batch_size(value, count, expected):
+    from ploy.common import batch_size, get_batch_size
+    assert get_batch_size(batch_size(value), count) == expected
+
+
+@pytest.mark.parametrize("value", ['0', '-1', 'x', '%', '0%'])
+def test_invalid_batch_size(value):
+    from ploy.common import batch_size
+    with pytest.raises(ValueError):
+        batch_size(value)
+
+
+class TestRunRolling:
+    def test_completion_driven(self):
+        from ploy.common import run_rolling
+        import threading
+        started = threading.Event()
+
+        def func(item):
+            if item == 'slow':
+                # only returns if the later items didn't wait for this one
+                return started.wait(5)
+            if item == 'c':
+                started.set()
+            return True
+
+        assert run_rolling(func, ['slow', 'a', 'b', 'c'], 2) == [
+            True, True, True, True]
+
+    def test_max_failures(self):
+        from ploy.common import run_rolling
+        calls = []
+
+        def func(item):
+            calls.append(item)
+            return item
+
+        results = run_rolling(
+            func, [1, 2, 3, 4, 5], 1, max_failures=1,
+            failed=lambda x: x in (2, 3))
+        assert results == [1, 2, 3, None, None]
+        assert calls == [1, 2, 3]
+
+    def test_canary(self):
+        from ploy.common import run_rolling
+        results = run_rolling(
+            lambda x: x, [1, 2, 3], 3, canary=1, failed=lambda x: x == 1)
+        assert results == [1, None, None]
+        results = run_rolling(
+            lambda x: x, [1, 2, 3], 3, canary=1, failed=lambda x: x == 2)
+        assert results == [1, 2, 3]
+
+    def test_pause(self, mock):
+        from ploy.common import run_rolling
+        with mock.patch('ploy.common.time.sleep') as SleepMock:
+            assert run_rolling(lambda x: x, [1, 2, 3], 1, pause=2) == [1, 2, 3]
+        assert SleepMock.call_args_list == [((2,), {}), ((2,), {})]
+
 
 @pytest.mark.parametrize("default, all, question, answer, expected", [
     (None, False, 'Foo [yes/no] ', ['y'], True),
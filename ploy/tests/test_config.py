@@ -1,17 +1,20 @@
 from __future__ import print_function, unicode_literals
+from io import BytesIO
 from ploy.config import Config
 import os
 import pytest
+import sys
 
 
 @pytest.fixture
 def make_parsed_config(make_file_io):
 
-    def make_parsed_config(content, path=None, plugins=None):
+    def make_parsed_config(content, path=None, plugins=None, lazy=False):
         return Config(
             make_file_io(content),
             path=path,
-            plugins=plugins).parse()
+            plugins=plugins,
+            lazy=lazy).parse()
 
     return make_parsed_config
 
@@ -52,6 +55,41 @@ class TestConfig:
         assert isinstance(config['global']['baz']._dict['macrovalue'], ConfigValue)
         assert isinstance(config['global']['baz']._dict['bazvalue'], ConfigValue)
 
+    def testProvenance(self, make_parsed_config):
+        from ploy.config import _CallerSrc
+        config = make_parsed_config(u"[foo]")
+        section = config['global']['foo']
+        section['lazy'] = 'value'
+        assert isinstance(section._dict['lazy']._src, _CallerSrc)
+        assert section._dict['lazy'].src.startswith('ploy.tests:test_config.py:')
+        assert section._dict['lazy']._src == section._dict['lazy'].src
+        config.provenance = 'full'
+        section['full'] = 'value'
+        assert section._dict['full']._src.startswith('ploy.tests:test_config.py:')
+        config.provenance = None
+        section['none'] = 'value'
+        assert section._dict['none'].src is None
+
+    def testCompactSections(self, make_parsed_config):
+        config = make_parsed_config(u"""
+            [macro]
+            macrovalue=1
+            [foo]
+            <=macro
+            value=2
+            [bar]
+            <=macro
+            value=3""")
+        foo = config['global']['foo']
+        bar = config['global']['bar']
+        assert not hasattr(foo, '__dict__')
+        assert foo._config is bar._config
+        assert foo._dict['macrovalue'] is bar._dict['macrovalue']
+        if sys.version_info >= (3,):
+            (foo_key,) = [x for x in foo._dict if x == 'value']
+            (bar_key,) = [x for x in bar._dict if x == 'value']
+            assert foo_key is bar_key
+
     def testGroupMacroExpansion(self, make_parsed_config):
         config = make_parsed_config(u"""
             [group:macro]
@@ -99,6 +137,59 @@ class TestConfig:
             'group': {
                 'macro': {'macrovalue': '1', 'cleanvalue': '3'}}}
 
+    def testIndirectCircularMacroExpansion(self, make_file_io):
+        contents = make_file_io(u"""
+            [foo]
+            <=bar
+            [bar]
+            <=baz
+            [baz]
+            <=foo""")
+        with pytest.raises(ValueError):
+            Config(contents).parse()
+
+    def testMacroExpandedOnce(self, make_parsed_config):
+        dummyplugin = DummyPlugin()
+        plugins = dict(
+            dummy=dict(
+                get_macro_cleaners=dummyplugin.get_macro_cleaners))
+        cleaned = []
+
+        def cleaner(macro):
+            cleaned.append(macro.sectionname)
+            if 'cleanvalue' in macro:
+                del macro['cleanvalue']
+
+        dummyplugin.macro_cleaners = {'global': cleaner}
+        config = make_parsed_config(
+            u"""
+                [group:base]
+                basevalue=0
+                cleanvalue=3
+                [group:macro]
+                <=base
+                macrovalue=1
+                [foo]
+                <=group:macro
+                [bar]
+                <=group:macro
+                macrovalue=2
+                [group:other]
+                <=macro""",
+            plugins=plugins)
+        assert config == {
+            'global': {
+                'foo': {'basevalue': '0', 'macrovalue': '1'},
+                'bar': {'basevalue': '0', 'macrovalue': '2'}},
+            'group': {
+                'base': {'basevalue': '0', 'cleanvalue': '3'},
+                'macro': {'basevalue': '0', 'cleanvalue': '3', 'macrovalue': '1'},
+                'other': {'basevalue': '0', 'cleanvalue': '3', 'macrovalue': '1'}}}
+        assert cleaned == ['macro']
+        foo = config['global']['foo']
+        bar = config['global']['bar']
+        assert foo._dict['basevalue'] is bar._dict['basevalue']
+
     def testOverrides(self, make_parsed_config):
         config = make_parsed_config(u"""
             [section]
@@ -134,6 +225,162 @@ class TestConfig:
         assert config['global']['section']['__groupname__'] == 'global'
 
 
+class TestLazyConfig:
+    content = u"""
+        [macro]
+        macrovalue = 1
+        [foo]
+        <= macro
+        massagers = value=ploy.config.IntegerMassager
+        value = 2
+        [group:bar]
+        <= global:macro
+        barvalue = 3"""
+
+    def testSameAsEager(self, make_parsed_config):
+        eager = make_parsed_config(self.content)
+        config = make_parsed_config(self.content, lazy=True)
+        assert config == eager
+        assert len(config._values) == len(eager._values)
+
+    def testSectionsCreatedOnAccess(self, make_parsed_config):
+        from ploy.config import _PendingSection
+        config = make_parsed_config(self.content, lazy=True)
+        assert sorted(config) == ['global', 'group']
+        assert sorted(config['global']) == ['foo', 'macro']
+        assert len(config['group']) == 1
+        assert 'bar' in config['group']
+        data = config['group']._dict._data
+        assert isinstance(data['bar'], _PendingSection)
+        assert isinstance(config['global']._dict._data['macro'], _PendingSection)
+        assert config['group']['bar'] == {'macrovalue': '1', 'barvalue': '3'}
+        assert not isinstance(data['bar'], _PendingSection)
+        assert not isinstance(config['global']._dict._data['macro'], _PendingSection)
+        assert isinstance(config['global']._dict._data['foo'], _PendingSection)
+        assert config['global']['foo'] == {'macrovalue': '1', 'value': 2}
+
+    def testCircularMacroExpansion(self, make_parsed_config):
+        config = make_parsed_config(u"""
+            [foo]
+            <=bar
+            [bar]
+            <=foo""", lazy=True)
+        with pytest.raises(ValueError):
+            config['global']['foo']
+
+
+class TestConfigIndex:
+    @pytest.fixture(params=[False, True], ids=["eager", "lazy"])
+    def config(self, make_parsed_config, request):
+        return make_parsed_config(u"""
+            [macro]
+            user = root
+            [plain-instance:foo]
+            <= global:macro
+            master = default other
+            [plain-instance:bar]
+            master = other
+            host = bar
+            [group:foo]
+            host = foo""", lazy=request.param)
+
+    def testSectionGroups(self, config):
+        from ploy.config import ConfigSection
+        assert config.get_section_groups('foo') == ['group', 'plain-instance']
+        assert config.get_section_groups('bar') == ['plain-instance']
+        assert config.get_section_groups('baz') == []
+        config.setdefault('new', ConfigSection())
+        config.get_section('new', 'baz')
+        assert config.get_section_groups('baz') == ['new']
+        del config['group']['foo']
+        assert config.get_section_groups('foo') == ['plain-instance']
+
+    def testSectionsWithKey(self, config):
+        assert config.get_sections_with_key('host') == [
+            ('group', 'foo'), ('plain-instance', 'bar')]
+        assert config.get_sections_with_key('user') == [
+            ('global', 'macro'), ('plain-instance', 'foo')]
+        config['group']['foo']['user'] = 'admin'
+        del config['plain-instance']['bar']['host']
+        assert config.get_sections_with_key('host') == [('group', 'foo')]
+        assert config.get_sections_with_key('user') == [
+            ('global', 'macro'), ('group', 'foo'), ('plain-instance', 'foo')]
+
+    def testSectionsForMaster(self, config):
+        assert config.get_sections_for_master('default') == [
+            ('plain-instance', 'foo')]
+        assert config.get_sections_for_master('other') == [
+            ('plain-instance', 'bar'), ('plain-instance', 'foo')]
+        config['plain-instance']['foo']['master'] = 'default'
+        config['group']['foo']['master'] = 'other'
+        assert config.get_sections_for_master('other') == [
+            ('group', 'foo'), ('plain-instance', 'bar')]
+
+    def testNewSectionGroup(self, config):
+        from ploy.config import ConfigSection
+        section = ConfigSection(host='baz', master='default')
+        config.setdefault('new', ConfigSection())
+        config['new']['baz'] = section
+        assert config.get_section_groups('baz') == ['new']
+        assert config.get_sections_with_key('host') == [
+            ('group', 'foo'), ('new', 'baz'), ('plain-instance', 'bar')]
+        assert config.get_sections_for_master('default') == [
+            ('new', 'baz'), ('plain-instance', 'foo')]
+
+
+class TestConfigSectionCopy:
+    def testCopyIsIndependent(self, make_parsed_config):
+        config = make_parsed_config(u"""
+            [section]
+            foo = 1
+            bar = 2
+            baz = 3""")
+        section = config['global']['section']
+        copy = section.copy()
+        assert copy == section
+        copy['foo'] = 'a'
+        del copy['bar']
+        copy['ham'] = 'egg'
+        section['baz'] = 'b'
+        assert section == {'foo': '1', 'bar': '2', 'baz': 'b'}
+        assert copy == {'foo': 'a', 'baz': '3', 'ham': 'egg'}
+        assert list(copy) == ['foo', 'baz', 'ham']
+        assert len(copy) == 3
+        assert 'bar' not in copy
+        with pytest.raises(KeyError):
+            copy['bar']
+        with pytest.raises(KeyError):
+            del copy['bar']
+        copy['bar'] = 'c'
+        assert copy['bar'] == 'c'
+        assert len(copy) == 4
+
+    def testCopiesShareContent(self, make_parsed_config):
+        config = make_parsed_config(u"""
+            [section]
+            foo = 1""")
+        section = config['global']['section']
+        copy1 = section.copy()
+        copy2 = section.copy()
+        assert copy1._dict._base is copy2._dict._base
+        assert copy1._dict._base is section._dict._base
+        assert copy1._dict['foo'] is section._dict['foo']
+        copy1['foo'] = '2'
+        copy3 = copy1.copy()
+        assert copy3._dict._base is not section._dict._base
+        assert copy3 == {'foo': '2'}
+        assert section == {'foo': '1'}
+
+    def testOverridesDontChangeSection(self, make_parsed_config):
+        config = make_parsed_config(u"""
+            [section]
+            foo = 1""")
+        result = config.get_section_with_overrides(
+            'global', 'section', overrides={'foo': '2', 'bar': '3'})
+        assert result == {'foo': '2', 'bar': '3'}
+        assert config['global']['section'] == {'foo': '1'}
+
+
 class DummyPlugin(object):
     def __init__(self):
         self.macro_cleaners = {}
@@ -393,6 +640,178 @@ class TestMassagers:
         # make sure nothing is changed afterwards
         assert config['global'] == {'section': {'value': 1}}
 
+    def testMassagedValueMemoized(self, make_parsed_config_plugins, plugin):
+        from ploy.config import BaseMassager
+
+        calls = []
+
+        class CountingMassager(BaseMassager):
+            _memoize = True
+
+            def __call__(self, config, sectionname):
+                calls.append(sectionname)
+                return int(BaseMassager.__call__(self, config, sectionname))
+
+        plugin.massagers.append(CountingMassager('section', 'value'))
+        config = make_parsed_config_plugins(
+            u"""
+                [section:foo]
+                value=1""")
+        section = config['section']['foo']
+        assert section['value'] == 1
+        assert section['value'] == 1
+        assert calls == ['foo']
+        section['value'] = '2'
+        assert section['value'] == 2
+        assert section['value'] == 2
+        assert calls == ['foo', 'foo']
+        del section['value']
+        assert 'value' not in section
+        section['value'] = '3'
+        assert section['value'] == 3
+        assert calls == ['foo', 'foo', 'foo']
+
+    def testMassagedValueNotMemoized(self, make_parsed_config_plugins, plugin):
+        from ploy.config import BaseMassager
+
+        calls = []
+
+        class CountingMassager(BaseMassager):
+            def __call__(self, config, sectionname):
+                calls.append(sectionname)
+                return int(BaseMassager.__call__(self, config, sectionname))
+
+        plugin.massagers.append(CountingMassager('section', 'value'))
+        config = make_parsed_config_plugins(
+            u"""
+                [section:foo]
+                value=1""")
+        section = config['section']['foo']
+        assert section['value'] == 1
+        assert section['value'] == 1
+        assert calls == ['foo', 'foo']
+
+    def testMutableMassagedValuesNotShared(self, make_parsed_config_plugins, plugin):
+        from ploy.config import StartupScriptMassager
+        plugin.massagers.append(StartupScriptMassager('section', 'startup_script'))
+        config = make_parsed_config_plugins(
+            u"""
+                [section:foo]
+                startup_script=foo.sh""",
+            path='/config')
+        section = config['section']['foo']
+        assert section['startup_script'] == {'path': '/config/foo.sh'}
+        a = section.copy()
+        b = section.copy()
+        a['startup_script']['path'] = 'X'
+        assert section['startup_script']['path'] == '/config/foo.sh'
+        assert b['startup_script']['path'] == '/config/foo.sh'
+
+    def testAddMassagerInvalidatesMemoized(self, make_parsed_config):
+        from ploy.config import BooleanMassager, IntegerMassager
+
+        config = make_parsed_config(
+            u"""
+                [section:foo]
+                value=1
+                flag=yes""")
+        section = config['section']['foo']
+        assert section['value'] == '1'
+        assert section['flag'] == 'yes'
+        config.add_massager(IntegerMassager('section', 'value'))
+        assert section['value'] == 1
+        section.add_massager(BooleanMassager('section', 'flag'))
+        assert section['flag'] is True
+
+
+class TestSchema:
+    @pytest.fixture
+    def make_parsed_config_schema(self, make_parsed_config):
+        from functools import partial
+        from ploy.config import BooleanMassager, IntegerMassager, Schema
+        schema = Schema('section', {
+            'flag': BooleanMassager,
+            'ssh-port': IntegerMassager})
+        plugins = dict(dummy=dict(get_schemas=lambda: [schema]))
+        return partial(make_parsed_config, plugins=plugins, lazy=True)
+
+    def testRecords(self, make_parsed_config_schema):
+        config = make_parsed_config_schema(u"""
+            [section:foo]
+            flag = yes
+            ssh-port = 22
+            other = 1
+            [section:bar]
+            flag = off""")
+        config.compile_schemas()
+        assert config._records == {}
+        foo = config.get_record('section', 'foo')
+        assert foo.flag is True
+        assert foo.ssh_port == 22
+        assert not hasattr(foo, 'other')
+        bar = config.get_record('section', 'bar')
+        assert bar.flag is False
+        assert bar.ssh_port is None
+        assert config['section']['foo']['ssh-port'] == 22
+        with pytest.raises(KeyError):
+            config.get_record('global', 'foo')
+
+    def testSectionsNotCreated(self, make_parsed_config_schema):
+        from ploy.config import _PendingSection
+        config = make_parsed_config_schema(u"""
+            [section:base]
+            flag = yes
+            [section:foo]
+            <= base
+            ssh-port = 22""")
+        config.compile_schemas()
+        sections = config._dict['section'].value._dict._data
+        assert [x.__class__ for x in sections.values()] == [
+            _PendingSection, _PendingSection]
+        assert config.get_record('section', 'foo').flag is True
+
+    def testSameValueCheckedOnce(self, make_parsed_config_schema, mock):
+        from ploy.config import IntegerMassager
+        config = make_parsed_config_schema(u"""
+            [section:foo]
+            ssh-port = 22
+            [section:bar]
+            ssh-port = 22""")
+        with mock.patch.object(IntegerMassager, '__call__') as call_mock:
+            call_mock.return_value = 22
+            config.compile_schemas()
+        assert call_mock.call_count == 1
+
+    def testRecordReused(self, make_parsed_config_schema):
+        config = make_parsed_config_schema(u"""
+            [section:foo]
+            ssh-port = 22""")
+        record = config.get_record('section', 'foo')
+        assert config.get_record('section', 'foo') is record
+        config['section']['foo']['ssh-port'] = '23'
+        assert config.get_record('section', 'foo').ssh_port == 23
+
+    def testAllErrorsReported(self, make_parsed_config_schema, mock):
+        config = make_parsed_config_schema(u"""
+            [section:foo]
+            flag = yess
+            ssh-port = 22
+            [section:bar]
+            ssh-port = twenty""")
+        with mock.patch('ploy.config.log') as LogMock:
+            with pytest.raises(SystemExit):
+                config.compile_schemas()
+        assert [x[0][0] for x in LogMock.error.call_args_list] == [
+            "Invalid value for 'flag' in section 'section:foo': Can't convert 'yess' to boolean for flag in section:foo.",
+            "Invalid value for 'ssh-port' in section 'section:bar': invalid literal for int() with base 10: 'twenty'"]
+
+    def testDuplicateSchema(self):
+        from ploy.config import Schema
+        config = Config(None, path='')
+        config.add_schema(Schema('section', {}))
+        with pytest.raises(ValueError):
+            config.add_schema(Schema('section', {}))
+
 
 @pytest.mark.parametrize("description, massagers, expected", [
     (
@@ -493,6 +912,160 @@ class TestMassagersFromConfig:
         assert LogMock.error.call_args_list[0][1] == {}
 
 
+class TestReadConfig:
+    def testValuesAndComments(self, make_file_io):
+        from ploy.config import read_config
+        contents = make_file_io(u"""
+            # file comment
+            [section]
+            # key comment
+            value = 1 ; inline comment
+            multi = foo
+                bar
+            [group:section]
+            value = 2
+            # ending comment""")
+        result = [
+            (x.section, x.key, x.value, x.comments)
+            for x in read_config(contents, None)]
+        assert result == [
+            ('section', None, None, ([('#', ' file comment\n')], None)),
+            ('section', 'value', '1', ([('#', ' key comment\n')], [(';', ' inline comment')])),
+            ('section', 'multi', 'foo\nbar', (None, None)),
+            ('group:section', None, None, (None, None)),
+            ('group:section', 'value', '2', (None, None)),
+            (None, None, None, ([('#', ' ending comment')], None))]
+
+    def testNoStandardParserByDefault(self, make_file_io, mock):
+        from ploy.config import read_config
+        contents = make_file_io(u"""
+            [section]
+            value = 1""")
+        with mock.patch('ploy.config.ConfigParser') as ConfigParserMock:
+            result = list(read_config(contents, None))
+        assert ConfigParserMock.call_count == 0
+        assert [(x.section, x.key) for x in result] == [
+            ('section', None), ('section', 'value')]
+
+    def testCheck(self, make_file_io, mock):
+        from ploy.config import read_config
+        contents = make_file_io(u"""
+            REM a comment
+            [section]
+            value = 1
+            remark = not a comment
+            [section]
+            other = 2""")
+        result = read_config(contents, None, check=True)
+        assert [(x.section, x.key) for x in result] == [
+            ('section', None), ('section', 'value'),
+            ('section', 'remark'), ('section', 'other')]
+
+
+class TestReadYmlConfig:
+    def testSafeAndRoundTrip(self, tempdir):
+        from ploy.config import read_yml_config
+        from ruamel.yaml.comments import CommentedSeq
+        tempdir['ploy.yml'].fill(u"""
+            global:
+                section:
+                    # comment
+                    ratio: 1.50
+                    items:
+                        - foo
+                        - bar""")
+        path = tempdir['ploy.yml'].path
+        result = read_yml_config(path, None)
+        assert [(x.section, x.key, x.value) for x in result] == [
+            ('global:section', None, None),
+            ('global:section', 'ratio', 1.5),
+            ('global:section', 'items', ['foo', 'bar'])]
+        assert type(result[2].value) is list
+        result = read_yml_config(path, None, round_trip=True)
+        assert [(x.section, x.key, x.value) for x in result] == [
+            ('global:section', None, None),
+            ('global:section', 'ratio', 1.5),
+            ('global:section', 'items', ['foo', 'bar'])]
+        assert isinstance(result[2].value, CommentedSeq)
+
+    def testNonStringKey(self, tempdir):
+        tempdir['ploy.yml'].fill(u"""
+            global:
+                section:
+                    1: foo""")
+        config = Config(tempdir['ploy.yml'].path).parse()
+        assert config['global']['section'][1] == 'foo'
+
+
+class TestReadTomlConfig:
+    @pytest.fixture(autouse=True)
+    def tomllib(self):
+        try:
+            import tomllib
+        except ImportError:  # pragma: nocover
+            tomllib = pytest.importorskip('tomli')
+        return tomllib
+
+    def testTypes(self, tempdir):
+        from ploy.config import read_toml_config
+        tempdir['ploy.toml'].fill(u"""
+            [global.section]
+            # comment
+            ratio = 1.5
+            count = 3
+            enabled = true
+            items = ["foo", "bar"]""")
+        result = read_toml_config(tempdir['ploy.toml'].path, None)
+        assert [(x.section, x.key, x.value) for x in result] == [
+            ('global:section', None, None),
+            ('global:section', 'ratio', 1.5),
+            ('global:section', 'count', 3),
+            ('global:section', 'enabled', True),
+            ('global:section', 'items', ['foo', 'bar'])]
+
+    def testExtendsMacrosAndMassagers(self, tempdir):
+        tempdir['ploy.toml'].fill(u"""
+            [global.global]
+            extends = "base.toml"
+
+            [plain-instance.foo]
+            "<" = "base"
+            host = "localhost"
+            """)
+        tempdir['base.toml'].fill(u"""
+            [plain-instance.base]
+            massagers = "port=ploy.config.IntegerMassager"
+            port = "2222"
+            user = "root"
+            """)
+        config = Config(tempdir['ploy.toml'].path).parse()
+        assert config.files == [
+            tempdir['base.toml'].path, tempdir['ploy.toml'].path]
+        assert config['plain-instance']['base']['port'] == 2222
+        assert config['plain-instance']['foo'] == {
+            'host': 'localhost', 'port': '2222', 'user': 'root'}
+
+    def testPlugin(self, tempdir):
+        from ploy.config import TomlConfigPlugin
+        tempdir['ploy.toml'].fill(u"""
+            [global.section]
+            value = 1""")
+        path = tempdir['ploy.toml'].path
+        plugin = TomlConfigPlugin()
+        assert plugin.ploy_locate_config(path.replace('.toml', '.conf')) == path
+        assert plugin.ploy_load_config(
+            path.replace('.toml', '.yml'), plugins={}, parsed=None) is None
+        config = plugin.ploy_load_config(path, plugins={}, parsed=None)
+        assert config['global']['section']['value'] == 1
+
+    def testInvalid(self, tempdir):
+        tempdir['ploy.toml'].fill(u"""
+            [global.section]
+            value = """)
+        with pytest.raises(ValueError):
+            Config(tempdir['ploy.toml'].path).parse()
+
+
 class TestConfigExtend:
     def testExtend(self, confmaker):
         ployconf = confmaker('ploy.conf')
@@ -556,6 +1129,103 @@ class TestConfigExtend:
                 'global': {
                     'foo': 'blubber', 'ham': 'egg'}}}
 
+    def testMultipleExtends(self, confmaker):
+        ployconf = confmaker('ploy.conf')
+        ployconf.fill([
+            '[global]',
+            'extends = foo.conf bar.conf',
+            'ham = egg'])
+        confmaker('foo.conf').fill([
+            '[global]',
+            'foo = foo',
+            'ham = foo'])
+        confmaker('bar.conf').fill([
+            '[global]',
+            'extends = baz.conf',
+            'bar = bar',
+            'foo = bar'])
+        confmaker('baz.conf').fill([
+            '[global]',
+            'baz = baz',
+            'bar = baz'])
+        config = Config(ployconf.path).parse()
+        assert config == {
+            'global': {
+                'global': {
+                    'foo': 'foo', 'bar': 'bar', 'baz': 'baz', 'ham': 'egg'}}}
+
+    def testDiamondExtend(self, confmaker):
+        ployconf = confmaker('ploy.conf')
+        ployconf.fill([
+            '[global]',
+            'extends = foo.conf bar.conf base.conf'])
+        confmaker('foo.conf').fill([
+            '[global]',
+            'extends = base.conf',
+            'foo = foo'])
+        confmaker('bar.conf').fill([
+            '[global]',
+            'extends = base.conf',
+            'bar = bar',
+            'foo = bar'])
+        confmaker('base.conf').fill([
+            '[global]',
+            'bar = base',
+            'base = base',
+            'foo = base'])
+        files = []
+        config = Config(ployconf.path)
+        config.files = files
+        config.parse()
+        assert config == {
+            'global': {
+                'global': {
+                    'foo': 'foo', 'bar': 'bar', 'base': 'base'}}}
+        assert sorted(os.path.basename(x) for x in files) == sorted(
+            x.replace('.conf', os.path.splitext(ployconf.path)[1])
+            for x in ('base.conf', 'bar.conf', 'foo.conf', 'ploy.conf'))
+
+    def testDiamondExtendParsesOnce(self, mock, tempdir):
+        from ploy.config import _read_ini, read_config
+        tempdir['ploy.conf'].fill([
+            '[global]',
+            'extends = foo.conf bar.conf'], allow_conf=True)
+        tempdir['foo.conf'].fill([
+            '[global]',
+            'extends = base.conf'], allow_conf=True)
+        tempdir['bar.conf'].fill([
+            '[global]',
+            'extends = base.conf'], allow_conf=True)
+        tempdir['base.conf'].fill([
+            '[global]',
+            'base = base'], allow_conf=True)
+        with mock.patch('ploy.config._read_ini', wraps=_read_ini) as read_ini_mock:
+            result = list(read_config(tempdir['ploy.conf'].path, None))
+        assert sorted(
+            os.path.basename(x[0][1]) for x in read_ini_mock.call_args_list) == [
+                'bar.conf', 'base.conf', 'foo.conf', 'ploy.conf']
+        assert [os.path.basename(x.src) for x in result if x.key is None] == [
+            'base.conf', 'bar.conf', 'foo.conf', 'ploy.conf']
+
+    def testIndirectCircularExtend(self, confext, confmaker, mock):
+        ployconf = confmaker('ploy.conf')
+        ployconf.fill([
+            '[global]',
+            'extends = foo.conf'])
+        confmaker('foo.conf').fill([
+            '[global]',
+            'extends = bar.conf'])
+        confmaker('bar.conf').fill([
+            '[global]',
+            'extends = foo.conf'])
+        with mock.patch('ploy.config.log') as LogMock:
+            with pytest.raises(SystemExit):
+                Config(ployconf.path).parse()
+        path = os.path.join(ployconf.directory, 'foo.conf')
+        path = path.replace('.conf', confext)
+        assert LogMock.error.call_args_list == [
+            (("Circular config file extension on '%s'.", path), {})]
+
     def testExtendFromDifferentDirectoryWithMassager(self, confmaker):
         from ploy.config import PathMassager
         ployconf = confmaker('ploy.conf')
@@ -595,6 +1265,328 @@ class TestConfigExtend:
             (("Config file '%s' doesn't exist.", path), {})]
 
 
+class TestConfigCache:
+    @pytest.fixture
+    def cache_dir(self, monkeypatch, tempdir):
+        cache_dir = os.path.join(tempdir.directory, 'cache')
+        monkeypatch.setenv('PLOY_CACHE_DIR', cache_dir)
+        return cache_dir
+
+    @pytest.fixture
+    def load(self, confext):
+        from ploy.config import ConfigPlugin, YamlConfigPlugin
+        plugin = dict(
+            [('.conf', ConfigPlugin), ('.yml', YamlConfigPlugin)])[confext]()
+
+        def load(path):
+            if confext == '.yml':
+                return plugin.ploy_load_config(
+                    path, plugins={}, round_trip=False, parsed=None)
+            return plugin.ploy_load_config(path, plugins={}, parsed=None)
+
+        return load
+
+    def age(self, *paths):
+        for path in paths:
+            mtime = os.path.getmtime(path) - 10
+            os.utime(path, (mtime, mtime))
+
+    def testCacheHit(self, cache_dir, confmaker, load, mock):
+        ployconf = confmaker('ploy.conf')
+        ployconf.fill([
+            '[global]',
+            'extends = foo.conf',
+            '[section]',
+            'value = 1'])
+        fooconf = confmaker('foo.conf')
+        fooconf.fill([
+            '[plain-instance:foo]',
+            'massagers = password-fallback=ploy.config.BooleanMassager',
+            'password-fallback = yes'])
+        self.age(ployconf.path, fooconf.path)
+        config = load(ployconf.path)
+        assert len(os.listdir(cache_dir)) == 1
+        with mock.patch('ploy.config.read_config') as read_config_mock:
+            with mock.patch('ploy.config.read_yml_config') as read_yml_config_mock:
+                cached = load(ployconf.path)
+        assert read_config_mock.call_count == 0
+        assert read_yml_config_mock.call_count == 0
+        assert cached == config
+        assert cached['plain-instance']['foo']['password-fallback'] is True
+        assert cached.files == config.files
+        assert len(cached._values) == len(config._values)
+
+    def testCacheIsJSON(self, cache_dir, confmaker, load):
+        import json
+        ployconf = confmaker('ploy.conf')
+        ployconf.fill([
+            '[section]',
+            'value = 1'])
+        self.age(ployconf.path)
+        load(ployconf.path)
+        (name,) = os.listdir(cache_dir)
+        assert name.endswith('.json')
+        with open(os.path.join(cache_dir, name)) as f:
+            data = json.load(f)
+        assert data['state']['files'] == [ployconf.path]
+
+    def testSourceRelativeToWorkingDirectory(self, cache_dir, confmaker, load, monkeypatch, tempdir):
+        ployconf = confmaker('etc/ploy.conf')
+        ployconf.fill([
+            '[section]',
+            'value = 1'])
+        self.age(ployconf.path)
+        other = os.path.join(tempdir.directory, 'other')
+        os.mkdir(other)
+        monkeypatch.chdir(tempdir.directory)
+        config = load(ployconf.path)
+        assert [x[3].src for x in config._values] == [
+            os.path.join('etc', 'ploy' + os.path.splitext(ployconf.path)[1])] * 2
+        monkeypatch.chdir(other)
+        config = load(ployconf.path)
+        assert len(os.listdir(cache_dir)) == 2
+        assert [os.path.abspath(x[3].src) for x in config._values] == [
+            ployconf.path] * 2
+        monkeypatch.chdir(tempdir.directory)
+        config = load(ployconf.path)
+        assert [os.path.abspath(x[3].src) for x in config._values] == [
+            ployconf.path] * 2
+
+    def testCacheInvalidatedByExtendedFile(self, cache_dir, confmaker, load):
+        ployconf = confmaker('ploy.conf')
+        ployconf.fill([
+            '[global]',
+            'extends = foo.conf'])
+        fooconf = confmaker('foo.conf')
+        fooconf.fill([
+            '[section]',
+            'value = 1'])
+        self.age(ployconf.path, fooconf.path)
+        config = load(ployconf.path)
+        assert config['global']['section']['value'] == '1'
+        fooconf.fill([
+            '[section]',
+            'value = 22'])
+        self.age(fooconf.path)
+        config = load(ployconf.path)
+        assert config['global']['section']['value'] == '22'
+
+    def testRecentlyModifiedNotCached(self, cache_dir, confmaker, load):
+        ployconf = confmaker('ploy.conf')
+        ployconf.fill([
+            '[section]',
+            'value = 1'])
+        load(ployconf.path)
+        assert not os.path.exists(cache_dir)
+
+    def testDisabled(self, confmaker, load, monkeypatch, tempdir):
+        monkeypatch.delenv('XDG_CACHE_HOME', raising=False)
+        monkeypatch.setenv('HOME', tempdir.directory)
+        ployconf = confmaker('ploy.conf')
+        ployconf.fill([
+            '[section]',
+            'value = 1'])
+        self.age(ployconf.path)
+        load(ployconf.path)
+        assert not os.path.exists(os.path.join(tempdir.directory, '.cache'))
+
+
+class TestConfigSnapshot:
+    @pytest.fixture
+    def ployconf(self, confmaker):
+        ployconf = confmaker('ploy.conf')
+        ployconf.fill([
+            '[global]',
+            'extends = foo.conf',
+            '[plain-instance:base]',
+            'massagers = password-fallback=ploy.config.BooleanMassager',
+            'password-fallback = yes',
+            '[plain-instance:foo]',
+            '<= base',
+            'host = localhost'])
+        fooconf = confmaker('foo.conf')
+        fooconf.fill([
+            '[section]',
+            'value = 1'])
+        return ployconf
+
+    def roundtrip(self, config, **kw):
+        from ploy.config import load_snapshot
+        f = BytesIO()
+        config.dump_snapshot(f)
+        f.seek(0)
+        return load_snapshot(f, **kw)
+
+    @pytest.mark.parametrize("lazy", [False, True])
+    def testRoundtrip(self, lazy, ployconf):
+        config = Config(ployconf.path, lazy=lazy).parse()
+        expected = Config(ployconf.path).parse()
+        loaded = self.roundtrip(config)
+        assert loaded == expected
+        assert loaded.config == ployconf.path
+        assert loaded.path == expected.path
+        assert loaded.files == expected.files
+        assert loaded['plain-instance']['base']['password-fallback'] is True
+        assert loaded['plain-instance']['foo']['host'] == 'localhost'
+        assert [x[:3] for x in loaded._values] == [x[:3] for x in expected._values]
+        assert [x[3].src for x in loaded._values] == [x[3].src for x in expected._values]
+
+    def testNoParsing(self, mock, ployconf):
+        config = Config(ployconf.path).parse()
+        with mock.patch('ploy.config.read_config') as read_config_mock:
+            loaded = self.roundtrip(config)
+        assert read_config_mock.call_count == 0
+        assert loaded['global']['section']['value'] == '1'
+
+    def testPath(self, ployconf):
+        config = Config(ployconf.path).parse()
+        loaded = self.roundtrip(config, path='/srv/ploy')
+        assert loaded.path == '/srv/ploy'
+
+    def testInvalid(self):
+        from ploy.config import SNAPSHOT_MAGIC, load_snapshot
+        with pytest.raises(ValueError) as e:
+            load_snapshot(BytesIO(b'foo'))
+        assert e.value.args == ("Not a config snapshot.",)
+        with pytest.raises(ValueError) as e:
+            load_snapshot(BytesIO(SNAPSHOT_MAGIC + b'\xff\xff'))
+        assert e.value.args == ("Unsupported config snapshot version 65535.",)
+
+    def testOnlyData(self, ployconf):
+        from ploy.config import SNAPSHOT_MAGIC
+        import json
+        import zlib
+        from ploy.config import IntegerMassager
+        config = Config(ployconf.path).parse()
+        config.add_massager(IntegerMassager('global', 'value'))
+        f = BytesIO()
+        config.dump_snapshot(f)
+        data = json.loads(zlib.decompress(
+            f.getvalue()[len(SNAPSHOT_MAGIC) + 2:]).decode('utf-8'))
+        assert data['state']['massagers'] == [
+            ['ploy.config.IntegerMassager', 'global', 'value']]
+        loaded = self.roundtrip(config)
+        assert loaded['global']['section']['value'] == 1
+
+    def testUnsupportedValue(self, ployconf):
+        import datetime
+        config = Config(ployconf.path).parse()
+        config['global']['section']['value'] = datetime.date(2020, 1, 1)
+        with pytest.raises(ValueError) as e:
+            config.dump_snapshot(BytesIO())
+        assert "Can't store config in a snapshot" in e.value.args[0]
+
+    def testLocalMassager(self, ployconf):
+        from ploy.config import BaseMassager
+
+        class LocalMassager(BaseMassager):
+            pass
+
+        config = Config(ployconf.path).parse()
+        config.add_massager(LocalMassager('section', 'value'))
+        with pytest.raises(ValueError) as e:
+            config.dump_snapshot(BytesIO())
+        assert "it needs to be importable" in e.value.args[0]
+
+    def testNoCodeExecuted(self):
+        from ploy.config import SNAPSHOT_MAGIC, SNAPSHOT_VERSION, load_snapshot
+        import json
+        import struct
+        import zlib
+        data = dict(config=None, path='/', state=dict(
+            files=[], sectiongroups=[], values=[], value_table=[],
+            massagers=[['os.system', None, 'value']]))
+        f = BytesIO(
+            SNAPSHOT_MAGIC + struct.pack('>H', SNAPSHOT_VERSION)
+            + zlib.compress(json.dumps(data).encode('utf-8')))
+        with pytest.raises(ValueError) as e:
+            load_snapshot(f)
+        assert e.value.args == ("'os.system' isn't a massager.",)
+
+    def testPlugin(self, ployconf, tempdir):
+        from ploy.config import SnapshotConfigPlugin
+        config = Config(ployconf.path).parse()
+        snapshot = os.path.join(tempdir.directory, 'ploy.snapshot')
+        with open(snapshot, 'wb') as f:
+            config.dump_snapshot(f)
+        plugin = SnapshotConfigPlugin()
+        assert plugin.ploy_locate_config(snapshot) == snapshot
+        assert plugin.ploy_locate_config(ployconf.path) is None
+        assert plugin.ploy_load_config(ployconf.path, plugins={}) is None
+        assert plugin.ploy_load_config(snapshot, plugins={}) == config
+
+
+class TestIncrementalReload:
+    def touch(self, path):
+        mtime = os.path.getmtime(path) + 10
+        os.utime(path, (mtime, mtime))
+
+    def testOnlyChangedFilesParsed(self, confmaker, confext):
+        from ploy.config import ConfigPlugin, YamlConfigPlugin
+        plugin = dict(
+            [('.conf', ConfigPlugin), ('.yml', YamlConfigPlugin)])[confext]()
+        kw = dict(round_trip=False) if confext == '.yml' else {}
+        ployconf = confmaker('ploy.conf')
+        ployconf.fill([
+            '[global]',
+            'extends = foo.conf',
+            '[section]',
+            'value = 1'])
+        fooconf = confmaker('foo.conf')
+        fooconf.fill([
+            '[foo]',
+            'value = 2'])
+        parsed = {}
+        config = plugin.ploy_load_config(
+            ployconf.path, plugins={}, parsed=parsed, **kw)
+        assert sorted(parsed) == sorted(config.files)
+        ploy_result = parsed[ployconf.path][1]
+        foo_result = parsed[fooconf.path][1]
+        fooconf.fill([
+            '[foo]',
+            'value = 3'])
+        self.touch(fooconf.path)
+        config = plugin.ploy_load_config(
+            ployconf.path, plugins={}, parsed=parsed, **kw)
+        assert parsed[ployconf.path][1] is ploy_result
+        assert parsed[fooconf.path][1] is not foo_result
+        assert config['global']['section']['value'] == '1'
+        assert config['global']['foo']['value'] in ('3', 3)
+        ployconf.fill([
+            '[section]',
+            'value = 1'])
+        self.touch(ployconf.path)
+        config = plugin.ploy_load_config(
+            ployconf.path, plugins={}, parsed=parsed, **kw)
+        assert sorted(parsed) == [ployconf.path]
+
+    def testDiffSections(self, make_parsed_config):
+        from ploy.config import _diff_config_sections
+        from ploy.config import _get_config_sections
+        old = make_parsed_config(u"""
+            [macro]
+            value = 1
+            [foo]
+            <= macro
+            [bar]
+            value = 2
+            [baz]""", lazy=True)
+        new = make_parsed_config(u"""
+            [macro]
+            value = 2
+            [foo]
+            <= macro
+            [bar]
+            value = 2
+            [ham]""", lazy=True)
+        result = _diff_config_sections(
+            _get_config_sections(old._get_state()),
+            _get_config_sections(new._get_state()))
+        assert result == [
+            ('global', 'baz'), ('global', 'foo'),
+            ('global', 'ham'), ('global', 'macro')]
+
+
 class TestYAMLConversion:
     @pytest.fixture
     def make_config_obj(self, tempdir):
@@ -678,3 +1670,44 @@ class TestYAMLConversion:
             # ending comment
             # another comment
             """)
+
+    def testMultipleFiles(self, make_file_content, make_config_obj, tempdir, yaml_dumper):
+        names = ['ploy.conf'] + ['%s.conf' % i for i in range(6)]
+        for i, name in enumerate(names[1:]):
+            tempdir[name].fill(u"""\
+                [global]
+                extends = %s
+                [instance:foo%s]
+                value = %s""" % (names[i + 2] if i < 5 else '', i, i), allow_conf=True)
+        config = make_config_obj(u"""\
+            [global]
+            extends = 0.conf""")
+        timings = config._dump_yaml(yaml_dumper, workers=3)
+        assert sorted(x[0] for x in timings) == sorted(
+            tempdir[x].path for x in names)
+        assert all(x[1] >= 0 for x in timings)
+        assert sorted(yaml_dumper.output) == sorted(
+            x.replace('.conf', '.yml') for x in names)
+        assert yaml_dumper.output['3.yml'] == make_file_content(u"""\
+            global:
+                global:
+                    extends: 4.yml
+            instance:
+                foo3:
+                    value: '3'
+            """)
+        serial = type(yaml_dumper)()
+        config._dump_yaml(serial, workers=1)
+        assert serial.output == yaml_dumper.output
+
+    def testDumpYaml(self, make_config_obj, mock, tempdir):
+        config = make_config_obj(u"""\
+            [instance:foo]
+            value = 1""")
+        with mock.patch('ploy.config.log') as LogMock:
+            with pytest.raises(SystemExit):
+                config.dump_yaml()
+        assert tempdir['ploy.yml'].content() == "instance:\n    foo:\n        value: '1'\n"
+        ((msg, name, seconds), kw) = LogMock.info.call_args
+        assert msg == 'Wrote %s in %.2f s'
+        assert name == os.path.relpath(tempdir['ploy.yml'].path)
@@ -14,6 +14,26 @@ class TestPlain:
             'plain': ploy.plain.plugin}
         return ctrl
 
+    def testInvalidOptionReportedOnLoad(self, ctrl, mock, ployconf):
+        ployconf.fill([
+            '[plain-instance:foo]',
+            'password-fallback = maybe'])
+        with mock.patch('ploy.config.log') as LogMock:
+            with pytest.raises(SystemExit):
+                ctrl(['./bin/ploy', 'status', 'foo'])
+        LogMock.error.assert_called_once_with(
+            "Invalid value for 'password-fallback' in section 'plain-instance:foo': Can't convert 'maybe' to boolean for password-fallback in plain-instance:foo.")
+
+    def testRecord(self, ctrl, ployconf):
+        ployconf.fill([
+            '[plain-instance:foo]',
+            'password-fallback = yes',
+            'user = foo'])
+        ctrl.configfile = ployconf.path
+        record = ctrl.config.get_record('plain-instance', 'foo')
+        assert record.password_fallback is True
+        assert record.user == 'foo'
+
     def testInstanceHasNoStatus(self, ctrl, mock, ployconf):
         ployconf.fill([
             '[plain-instance:foo]'])
@@ -230,6 +250,88 @@ def test_conn(instance, mock, sshclient):
     assert conn.method_calls[2] == mock.call.save_host_keys(instance.master.known_hosts)
 
 
+def test_conn_user(instance, mock, sshclient):
+    instance.config['host'] = 'localhost'
+    instance.config['fingerprint'] = 'foo'
+    instance.config['user'] = 'foo'
+    conn = instance.conn
+    assert conn.method_calls[1] == mock.call.connect('localhost', username='foo', key_filename=None, password=None, sock=None, port=22)
+
+
+def test_conn_password_fallback(instance, mock, sshclient):
+    instance.config['host'] = 'localhost'
+    instance.config['fingerprint'] = 'foo'
+    instance.config['password-fallback'] = 'yes'
+    instance.config['password'] = 'secret'
+    sshclient().connect.side_effect = [
+        paramiko.AuthenticationException(), None]
+    conn = instance.conn
+    assert [x for x in conn.method_calls if x[0] == 'connect'] == [
+        mock.call.connect('localhost', username='root', key_filename=None, password=None, sock=None, port=22),
+        mock.call.connect('localhost', username='root', key_filename=None, password=b'secret', sock=None, port=22)]
+
+
+def test_conn_subclass_without_schema(confmaker, mock, sshclient, tempdir):
+    import ploy.plain
+
+    class SubInstance(ploy.plain.Instance):
+        sectiongroupname = 'sub-instance'
+
+    class SubMaster(ploy.plain.Master):
+        sectiongroupname = 'sub-instance'
+        instance_class = SubInstance
+
+    configfile = confmaker('ploy.conf')
+    configfile.fill([
+        '[sub-instance:foo]',
+        'host = localhost',
+        'fingerprint = foo',
+        'user = foo',
+        'password-fallback = yes',
+        'password = secret'])
+    ctrl = Controller(tempdir.directory)
+    ctrl.plugins = {
+        'plain': ploy.plain.plugin,
+        'sub': dict(get_masters=lambda ctrl: [SubMaster(ctrl, 'sub', {})])}
+    ctrl.configfile = configfile.path
+    instance = ctrl.instances['foo']
+    assert instance.record is None
+    sshclient().connect.side_effect = [
+        paramiko.AuthenticationException(), None]
+    conn = instance.conn
+    assert [x for x in conn.method_calls if x[0] == 'connect'] == [
+        mock.call.connect('localhost', username='foo', key_filename=None, password=None, sock=None, port=22),
+        mock.call.connect('localhost', username='foo', key_filename=None, password=b'secret', sock=None, port=22)]
+
+
+def test_init_ssh_key_fan_out_serialized(ctrl, mock, filled_ployconf, sshclient):
+    import time
+    filled_ployconf.fill([
+        '[plain-instance:foo]',
+        'host = foo.example.com',
+        'fingerprint = foo',
+        '[plain-instance:bar]',
+        'host = bar.example.com',
+        'fingerprint = bar'])
+    active = []
+    overlaps = []
+
+    def fix_known_hosts(known_hosts):
+        active.append(known_hosts)
+        overlaps.append(len(active))
+        time.sleep(0.01)
+        active.pop()
+
+    instances = [ctrl.instances['foo'], ctrl.instances['bar']]
+    for instance in instances:
+        instance._fix_known_hosts = fix_known_hosts
+        open(instance.master.known_hosts, 'w').close()
+    args = mock.Mock(jobs='2', canary=0, max_failures=None, pause=0)
+    with mock.patch('sys.stdout'):
+        ctrl._fan_out(instances, lambda x: x.init_ssh_key(), args)
+    assert overlaps == [1, 1]
+
+
 def test_conn_cached(instance, mock, sshclient):
     instance.config['host'] = 'localhost'
     instance.config['fingerprint'] = 'foo'
@@ -130,6 +130,49 @@ class TestPloy:
         assert 'dummy_augmented' in ctrl_dummy_plugin.instances['foo'].config
         assert ctrl_dummy_plugin.instances['foo'].config['dummy_augmented'] == 'augmented massaged'
 
+    def testGetInstancesDoesntCreateInstances(self, ctrl_dummy_plugin, ployconf):
+        import ploy.plain
+        ployconf.fill([
+            '[dummy-instance:foo]',
+            '[dummy-instance:bar]',
+            '[plain-instance:foo]'])
+        ctrl_dummy_plugin.plugins['plain'] = ploy.plain.plugin
+        instances = ctrl_dummy_plugin.get_instances(command='status')
+        assert list(instances) == ['bar', 'default-bar', 'default-foo']
+        assert 'default-foo' in instances
+        assert 'plain-foo' not in instances
+        assert 'foo' not in instances
+        ssh_instances = ctrl_dummy_plugin.get_instances(command='init_ssh_key')
+        assert list(ssh_instances) == [
+            'bar', 'default-bar', 'default-foo', 'plain-foo']
+        assert ctrl_dummy_plugin.instances._cache == {}
+        for master in ctrl_dummy_plugin.masters.values():
+            assert [x for x in master.instances if master.instances.get_created(x)] == []
+        assert instances['bar'].id == 'bar'
+        assert ctrl_dummy_plugin.masters['default'].instances.get_created('bar') is not None
+
+    @pytest.mark.parametrize("declared", [True, False])
+    def testGetInstancesWithAugmentedCommand(self, ctrl_dummy_plugin, declared, ployconf):
+        def augment_instance(instance):
+            if instance.id == 'foo':
+                instance.configure = lambda: None
+
+        ployconf.fill([
+            '[dummy-instance:foo]',
+            '[dummy-instance:bar]'])
+        plugin = dict(augment_instance=augment_instance)
+        if declared:
+            plugin['augmented_commands'] = ['configure']
+        ctrl_dummy_plugin.plugins['configure'] = plugin
+        assert list(ctrl_dummy_plugin.get_instances(command='other')) == []
+        # only undeclared commands of plugins require augmenting
+        assert (ctrl_dummy_plugin.instances._cache == {}) is declared
+        instances = ctrl_dummy_plugin.get_instances(command='configure')
+        assert list(instances) == ['default-foo', 'foo']
+        assert 'foo' in instances
+        assert 'bar' not in instances
+        assert hasattr(ctrl_dummy_plugin.instances['foo'], 'configure')
+
     def testInstanceAugmentationProxiedMaster(self, ctrl, ployconf):
         import ploy.tests.dummy_proxy_plugin
         import ploy.plain
@@ -285,6 +328,20 @@ class TestStatusCommand:
             ctrl_dummy_plugin(['./bin/ploy', 'status', 'foo'])
         LogMock.info.assert_called_with('status: %s', 'foo')
 
+    def testCallWithMultipleInstances(self, ctrl_dummy_plugin, mock, ployconf, capsys):
+        ployconf.fill([
+            '[dummy-instance:foo]',
+            '[dummy-instance:bar]'])
+        with mock.patch('ploy.tests.dummy_plugin.log') as LogMock:
+            ctrl_dummy_plugin(['./bin/ploy', 'status', '-j', '2', 'foo', 'default-foo', 'bar'])
+        assert sorted(LogMock.info.call_args_list) == [
+            (('status: %s', 'bar'), {}),
+            (('status: %s', 'foo'), {})]
+        lines = capsys.readouterr().out.splitlines()
+        assert lines[0].split() == ['instance', 'result', 'time']
+        assert [x.split()[:2] for x in lines[1:]] == [
+            ['default-foo', 'ok'], ['default-bar', 'ok']]
+
 
 class TestStopCommand:
     def testCallWithNoArguments(self, ctrl, mock, ployconf):
@@ -312,6 +369,46 @@ class TestStopCommand:
             ctrl_dummy_plugin(['./bin/ploy', 'stop', 'foo'])
         LogMock.info.assert_called_with('stop: %s', 'foo')
 
+    def testCallWithFailingCanary(self, ctrl_dummy_plugin, mock, ployconf, capsys):
+        from ploy.tests.dummy_plugin import Instance
+        ployconf.fill([
+            '[dummy-instance:foo]',
+            '[dummy-instance:bar]'])
+        with mock.patch.object(Instance, 'stop', autospec=True) as StopMock:
+            StopMock.side_effect = ValueError('API error')
+            with mock.patch('ploy.log'):
+                with pytest.raises(SystemExit) as e:
+                    ctrl_dummy_plugin(['./bin/ploy', 'stop', '--canary', '1', '-j', '50%', 'bar', 'foo'])
+        assert e.value.code == 1
+        assert StopMock.call_count == 1
+        lines = capsys.readouterr().out.splitlines()
+        assert [x.split()[:2] for x in lines[1:]] == [
+            ['default-bar', 'failed'], ['default-foo', 'skipped']]
+
+    def testCallWithFailingInstance(self, ctrl_dummy_plugin, mock, ployconf, capsys):
+        from ploy.tests.dummy_plugin import Instance
+
+        def stop(instance):
+            if instance.id == 'bar':
+                raise ValueError('API error')
+
+        ployconf.fill([
+            '[dummy-instance:foo]',
+            '[dummy-instance:bar]'])
+        with mock.patch.object(Instance, 'stop', autospec=True) as StopMock:
+            StopMock.side_effect = stop
+            with mock.patch('ploy.log') as LogMock:
+                with pytest.raises(SystemExit) as e:
+                    ctrl_dummy_plugin(['./bin/ploy', 'stop', 'foo', 'bar'])
+        assert e.value.code == 1
+        assert StopMock.call_count == 2
+        LogMock.exception.assert_called_once_with(
+            "Error for instance 'default-bar':")
+        lines = capsys.readouterr().out.splitlines()
+        assert [x.split()[:2] for x in lines[1:]] == [
+            ['default-foo', 'ok'], ['default-bar', 'failed']]
+        assert lines[2].endswith('API error')
+
 
 class TestTerminateCommand:
     def testCallWithNoArguments(self, ctrl, mock, ployconf):
@@ -351,6 +448,34 @@ class TestTerminateCommand:
             ctrl_dummy_plugin(['./bin/ploy', 'terminate', 'foo'])
         assert LogMock.info.call_args_list == [(('after_terminate',), {})]
 
+    def testCallWithMultipleInstances(self, ctrl_dummy_plugin, mock, ployconf, yesno_mock):
+        ployconf.fill([
+            '[dummy-instance:foo]',
+            'hooks = ploy.tests.test_ploy.DummyHooks',
+            '[dummy-instance:bar]',
+            'hooks = ploy.tests.test_ploy.DummyHooks'])
+        yesno_mock.expected = [
+            ("Are you sure you want to terminate 2 instances ('dummy-instance:foo', 'dummy-instance:bar')?", True)]
+        with mock.patch('ploy.tests.test_ploy.log') as LogMock:
+            with mock.patch('ploy.tests.dummy_plugin.log') as DummyLogMock:
+                ctrl_dummy_plugin(['./bin/ploy', 'terminate', 'foo', 'bar'])
+        assert yesno_mock.expected == []
+        assert LogMock.info.call_args_list == [
+            (('after_terminate',), {}), (('after_terminate',), {})]
+        assert sorted(DummyLogMock.info.call_args_list) == [
+            (('terminate: %s', 'bar'), {}),
+            (('terminate: %s', 'foo'), {})]
+
+    def testCallWithMultipleInstancesDeclined(self, ctrl_dummy_plugin, mock, ployconf, yesno_mock):
+        ployconf.fill([
+            '[dummy-instance:foo]',
+            '[dummy-instance:bar]'])
+        yesno_mock.expected = [
+            ("Are you sure you want to terminate 2 instances ('dummy-instance:bar', 'dummy-instance:foo')?", False)]
+        with mock.patch('ploy.tests.dummy_plugin.log') as DummyLogMock:
+            ctrl_dummy_plugin(['./bin/ploy', 'terminate', 'bar', 'foo'])
+        assert DummyLogMock.info.call_args_list == []
+
 
 class TestDebugCommand:
     def testCallWithNoArguments(self, ctrl, mock, ployconf):
@@ -516,6 +641,115 @@ class TestSSHCommand:
             ['ssh', '-o', 'UserKnownHostsFile=%s' % known_hosts, '-l', 'root', '-p', '22', 'localhost'])
 
 
+class TestExecCommand:
+    @pytest.fixture
+    def executor_mock(self, mock):
+        calls = []
+
+        def executor(instance):
+            def run(*args, **kw):
+                calls.append((instance.uid, args))
+                kw['stdout'].write(("%s\n" % instance.id).encode('ascii'))
+                return (int(instance.config.get('rc', 0)), None, None)
+            return run
+
+        with mock.patch('ploy.InstanceExecutor') as InstanceExecutorMock:
+            InstanceExecutorMock.side_effect = executor
+            yield calls
+
+    @pytest.fixture
+    def ctrl(self, ctrl_dummy_plugin, ployconf):
+        ployconf.fill([
+            '[dummy-instance:foo]',
+            '[dummy-instance:bar]',
+            '[dummy-instance:baz]',
+            'rc = 3'])
+        return ctrl_dummy_plugin
+
+    def testCallWithNoArguments(self, ctrl, mock):
+        with mock.patch('sys.stderr') as StdErrMock:
+            with pytest.raises(SystemExit):
+                ctrl(['./bin/ploy', 'exec'])
+        output = "".join(x[0][0] for x in StdErrMock.write.call_args_list)
+        assert 'usage: ploy exec' in output
+        assert 'no instances given' in output
+
+    def testSingleInstance(self, ctrl, executor_mock, capsys):
+        with pytest.raises(SystemExit) as e:
+            ctrl(['./bin/ploy', 'exec', 'foo', 'ls', '-la'])
+        assert e.value.code == 0
+        assert executor_mock == [('default-foo', ('ls', '-la'))]
+        assert capsys.readouterr().out == 'foo\n'
+
+    def testSingleInstanceWithSeparatorInCommand(self, ctrl, executor_mock, capsys):
+        with pytest.raises(SystemExit) as e:
+            ctrl(['./bin/ploy', 'exec', 'foo', 'git', 'log', '--', 'README'])
+        assert e.value.code == 0
+        assert executor_mock == [
+            ('default-foo', ('git', 'log', '--', 'README'))]
+        assert capsys.readouterr().out == 'foo\n'
+
+    def testGlob(self, ctrl, executor_mock, capsys):
+        with pytest.raises(SystemExit) as e:
+            ctrl(['./bin/ploy', 'exec', '-j', '2', 'ba*', 'foo', '--', 'uptime'])
+        assert e.value.code == 3
+        assert sorted(executor_mock) == [
+            ('default-bar', ('uptime',)),
+            ('default-baz', ('uptime',)),
+            ('default-foo', ('uptime',))]
+        (out, err) = capsys.readouterr()
+        assert sorted(out.splitlines()) == [
+            'default-bar: bar', 'default-baz: baz', 'default-foo: foo']
+
+    def testFailureSummary(self, ctrl, executor_mock, mock):
+        with mock.patch('ploy.log') as LogMock:
+            with pytest.raises(SystemExit):
+                ctrl(['./bin/ploy', 'exec', '-m', 'default', '--', 'uptime'])
+        assert len(executor_mock) == 3
+        LogMock.error.assert_called_once_with(
+            "The command failed on 1 of 3 instances: default-baz")
+
+    def testMaxFailures(self, ctrl, executor_mock, mock):
+        with mock.patch('ploy.log') as LogMock:
+            with pytest.raises(SystemExit) as e:
+                ctrl(['./bin/ploy', 'exec', '-j', '1', '--max-failures', '0', 'ba*', 'foo', '--', 'uptime'])
+        assert e.value.code == 3
+        assert executor_mock == [
+            ('default-bar', ('uptime',)), ('default-baz', ('uptime',))]
+        assert LogMock.error.call_args_list == [
+            (("The command failed on 1 of 3 instances: default-baz",), {}),
+            (("The command wasn't run on 1 instances after too many failures: default-foo",), {})]
+
+    def testInvalidBatchSize(self, ctrl, mock):
+        with mock.patch('sys.stderr') as StdErrMock:
+            with pytest.raises(SystemExit):
+                ctrl(['./bin/ploy', 'exec', '-j', '0%', 'foo', 'uptime'])
+        output = "".join(x[0][0] for x in StdErrMock.write.call_args_list)
+        assert "argument -j/--jobs: invalid batch_size value: '0%'" in output
+
+    def testGroup(self, ctrl, executor_mock):
+        with pytest.raises(SystemExit):
+            ctrl(['./bin/ploy', 'exec', '-g', 'dummy-instance', '--', 'uptime'])
+        assert len(executor_mock) == 3
+
+    def testNoMatch(self, ctrl, executor_mock, mock):
+        with mock.patch('ploy.log') as LogMock:
+            with pytest.raises(SystemExit) as e:
+                ctrl(['./bin/ploy', 'exec', 'x*', '--', 'uptime'])
+        assert e.value.code == 1
+        LogMock.error.assert_called_once_with("No instance matches 'x*'.")
+        assert executor_mock == []
+
+    def testExceptionInWorker(self, ctrl, mock):
+        with mock.patch('ploy.InstanceExecutor') as InstanceExecutorMock:
+            InstanceExecutorMock.side_effect = RuntimeError('broken')
+            with mock.patch('ploy.log') as LogMock:
+                with pytest.raises(SystemExit) as e:
+                    ctrl(['./bin/ploy', 'exec', 'foo', 'bar', '--', 'uptime'])
+        assert e.value.code == 255
+        assert LogMock.exception.call_count == 2
+
+
 class TestSnapshotCommand:
     def testCallWithNoArguments(self, ctrl, mock, ployconf):
         ployconf.fill('')
@@ -545,6 +779,297 @@ class TestSnapshotCommand:
             (('snapshot: %s', 'foo'), {})]
 
 
+class TestConf2SnapshotCommand:
+    def testCallWithNoArguments(self, ctrl, mock, ployconf):
+        ployconf.fill('')
+        with mock.patch('sys.stderr') as StdErrMock:
+            with pytest.raises(SystemExit):
+                ctrl(['./bin/ploy', 'conf2snapshot'])
+        output = "".join(x[0][0] for x in StdErrMock.write.call_args_list)
+        assert 'usage: ploy conf2snapshot' in output
+        assert too_view_arguments in output
+
+    def testSnapshot(self, ctrl_dummy_plugin, ployconf, tempdir):
+        import ploy.tests.dummy_plugin
+        ployconf.fill([
+            '[dummy-instance:foo]',
+            'host = localhost'])
+        snapshot = os.path.join(tempdir.directory, 'ploy.snapshot')
+        ctrl_dummy_plugin(['./bin/ploy', 'conf2snapshot', snapshot])
+        ctrl = Controller(tempdir.directory)
+        ctrl.configfile = snapshot
+        ctrl.plugins = {'dummy': ploy.tests.dummy_plugin.plugin}
+        assert ctrl.config == ctrl_dummy_plugin.config
+        assert ctrl.config.path == ctrl_dummy_plugin.config.path
+        assert sorted(ctrl.instances) == ['default-foo', 'foo']
+
+
+class TestReloadConfig:
+    lines = [
+        '[dummy-instance:base]',
+        'port = 2222',
+        '[dummy-instance:foo]',
+        '<= base',
+        'host = foo',
+        '[dummy-instance:bar]',
+        'host = bar']
+
+    @pytest.fixture
+    def ctrl(self, ctrl_dummy_plugin, ployconf):
+        ployconf.fill(self.lines)
+        ctrl_dummy_plugin.config_watch = True
+        return ctrl_dummy_plugin
+
+    def touch(self, path):
+        mtime = os.path.getmtime(path) + 10
+        os.utime(path, (mtime, mtime))
+
+    def testNotLoaded(self, ctrl):
+        assert ctrl.reload_config() is None
+
+    def testUnchanged(self, ctrl):
+        foo = ctrl.instances['foo']
+        assert ctrl.reload_config() is None
+        assert ctrl.instances['foo'] is foo
+
+    def testChangedInstance(self, ctrl, ployconf):
+        foo = ctrl.instances['foo']
+        bar = ctrl.instances['bar']
+        ployconf.fill([x.replace('host = bar', 'host = bar2') for x in self.lines] + [
+            '[dummy-instance:baz]',
+            'host = baz'])
+        self.touch(ployconf.path)
+        calls = []
+        changes = ctrl.reload_config(callback=calls.append)
+        assert calls == [changes]
+        assert changes.sections == [
+            ('dummy-instance', 'bar'), ('dummy-instance', 'baz')]
+        assert changes.masters == []
+        assert changes.instances == ['default-bar', 'default-baz']
+        assert ctrl.instances['foo'] is foo
+        assert ctrl.instances['default-foo'] is foo
+        assert foo.master is ctrl.masters['default']
+        assert ctrl.instances['bar'] is not bar
+        assert ctrl.instances['bar'].config['host'] == 'bar2'
+        assert ctrl.instances['baz'].config['dummy_augmented'] == 'augmented massaged'
+
+    def testReusedInstanceConfig(self, ctrl, ployconf):
+        import gc
+        foo = ctrl.instances['foo']
+        assert foo.config['dummy_augmented'] == 'augmented massaged'
+        ployconf.fill([x.replace('host = bar', 'host = bar2') for x in self.lines])
+        self.touch(ployconf.path)
+        ctrl.reload_config()
+        gc.collect()
+        assert ctrl.instances['foo'] is foo
+        assert foo.config['host'] == 'foo'
+        assert foo.config['dummy_augmented'] == 'augmented massaged'
+        foo.config['host'] = 'foo2'
+        assert foo.config['host'] == 'foo2'
+        assert ctrl.config['dummy-instance']['foo'] is foo.config
+
+    def testChangedMacro(self, ctrl, ployconf):
+        foo = ctrl.instances['foo']
+        bar = ctrl.instances['bar']
+        ployconf.fill([x.replace('2222', '2223') for x in self.lines])
+        self.touch(ployconf.path)
+        changes = ctrl.reload_config()
+        assert changes.sections == [
+            ('dummy-instance', 'base'), ('dummy-instance', 'foo')]
+        assert 'default-foo' in changes.instances
+        assert 'default-bar' not in changes.instances
+        assert ctrl.instances['foo'] is not foo
+        assert ctrl.instances['foo'].config['port'] == '2223'
+        assert ctrl.instances['bar'] is bar
+
+    def testInvalidKeepsConfig(self, ctrl, ployconf):
+        config = ctrl.config
+        foo = ctrl.instances['foo']
+        ployconf.append([
+            '[global]',
+            'extends = missing.conf'])
+        self.touch(ployconf.path)
+        assert ctrl.reload_config() is None
+        assert ctrl.config is config
+        assert ctrl.instances['foo'] is foo
+        assert ctrl.reload_config() is None
+
+    def testWithoutWatch(self, ctrl, ployconf):
+        ctrl.config_watch = False
+        foo = ctrl.instances['foo']
+        self.touch(ployconf.path)
+        changes = ctrl.reload_config()
+        assert ('dummy-instance', 'foo') in changes.sections
+        assert ctrl.instances['foo'] is not foo
+        assert ctrl.reload_config() is None
+
+
+class DummyDistribution(object):
+    name = 'ploy-dummy'
+    version = '1.0'
+
+
+class DummyEntryPoint(object):
+    name = 'dummy'
+    value = 'ploy.tests.dummy_plugin:plugin'
+    dist = DummyDistribution()
+
+    def __init__(self):
+        self.loaded = 0
+
+    def load(self):
+        import ploy.tests.dummy_plugin
+        self.loaded += 1
+        return ploy.tests.dummy_plugin.plugin
+
+
+class TestPlugins:
+    @pytest.fixture
+    def entrypoint(self, mock):
+        entrypoint = DummyEntryPoint()
+        with mock.patch('ploy.iter_entry_points') as iter_entry_points_mock:
+            iter_entry_points_mock.side_effect = lambda group: iter([entrypoint])
+            yield entrypoint
+
+    @pytest.fixture
+    def cache_dir(self, monkeypatch, tempdir):
+        cache_dir = os.path.join(tempdir.directory, 'cache')
+        monkeypatch.setenv('PLOY_CACHE_DIR', cache_dir)
+        return cache_dir
+
+    def testWithoutCache(self, entrypoint):
+        ctrl = Controller()
+        assert sorted(ctrl.plugins['dummy']) == [
+            'augment_instance', 'augmented_commands', 'get_list_commands',
+            'get_massagers', 'get_masters']
+        assert entrypoint.loaded == 1
+        assert Controller().plugins['dummy']['get_masters'] is not None
+        assert entrypoint.loaded == 2
+
+    def testManifest(self, cache_dir, entrypoint):
+        plugins = Controller().plugins
+        assert entrypoint.loaded == 1
+        assert os.listdir(cache_dir) == ['plugins.json']
+        plugins = Controller().plugins
+        assert 'get_masters' in plugins['dummy']
+        assert 'get_commands' not in plugins['dummy']
+        assert plugins['dummy'].get('get_commands') is None
+        assert plugins['dummy']['augmented_commands'] == []
+        assert entrypoint.loaded == 1
+        import ploy.tests.dummy_plugin
+        assert plugins['dummy']['get_masters'] is ploy.tests.dummy_plugin.get_masters
+        assert entrypoint.loaded == 2
+
+    def testManifestInvalidatedByVersion(self, cache_dir, entrypoint):
+        Controller().plugins
+        entrypoint.dist = DummyDistribution()
+        entrypoint.dist.version = '1.1'
+        Controller().plugins
+        assert entrypoint.loaded == 2
+        Controller().plugins
+        assert entrypoint.loaded == 2
+
+    def testFailingLazyLoad(self, cache_dir, entrypoint, mock):
+        Controller().plugins
+        plugins = Controller().plugins
+        entrypoint.load = mock.Mock(side_effect=ImportError('foo'))
+        assert 'get_masters' in plugins['dummy']
+        with mock.patch('ploy.log') as LogMock:
+            assert list(plugins['dummy']['get_masters'](None)) == []
+        LogMock.error.assert_called_once_with(
+            "Plugin 'dummy' could not be loaded: foo")
+        assert 'get_masters' not in plugins['dummy']
+        assert len(plugins['dummy']) == 0
+        assert entrypoint.load.call_count == 1
+
+
+class TestCommandRegistry:
+    @pytest.fixture
+    def plugin_commands(self, ctrl_dummy_plugin, mock):
+        cmd_mock = mock.Mock()
+        cmd_mock.__doc__ = "A plugin command"
+        get_commands = mock.Mock(return_value=[('plugincmd', cmd_mock)])
+        ctrl_dummy_plugin.plugins['cmds'] = dict(get_commands=get_commands)
+        return (get_commands, cmd_mock)
+
+    def testBuiltinCommandDoesntCollectPluginCommands(self, ctrl_dummy_plugin, mock, plugin_commands, ployconf):
+        (get_commands, cmd_mock) = plugin_commands
+        ployconf.fill([
+            '[dummy-instance:foo]'])
+        with mock.patch('ploy.tests.dummy_plugin.log') as LogMock:
+            ctrl_dummy_plugin(['./bin/ploy', '-c', ployconf.path, 'status', 'foo'])
+        assert LogMock.info.call_args_list == [(('status: %s', 'foo'), {})]
+        assert get_commands.call_count == 0
+        assert list(ctrl_dummy_plugin.subparsers) == ['status']
+
+    def testPluginCommand(self, ctrl_dummy_plugin, plugin_commands):
+        (get_commands, cmd_mock) = plugin_commands
+        ctrl_dummy_plugin(['./bin/ploy', 'plugincmd', 'foo'])
+        assert get_commands.call_count == 1
+        cmd_mock.assert_called_once_with(['foo'], "A plugin command")
+
+    def testAllCommandsForHelp(self, ctrl_dummy_plugin, mock, plugin_commands):
+        with mock.patch('sys.stdout') as StdOutMock:
+            with pytest.raises(SystemExit):
+                ctrl_dummy_plugin(['./bin/ploy', '-h'])
+        output = "".join(x[0][0] for x in StdOutMock.write.call_args_list)
+        assert 'plugincmd' in output
+        assert 'status' in output
+
+    def testInstanceChoicesOnlyAugmentChosen(self, ctrl_dummy_plugin, ployconf):
+        ployconf.fill([
+            '[dummy-instance:foo]',
+            '[dummy-instance:bar]'])
+        instances = ctrl_dummy_plugin.get_instances(command='status')
+        assert 'foo' in instances
+        assert 'ham' not in instances
+        assert instances['foo'].id == 'foo'
+        assert list(ctrl_dummy_plugin.instances._cache) == ['foo']
+        assert list(instances) == ['bar', 'default-bar', 'default-foo', 'foo']
+        assert 'foo' not in ctrl_dummy_plugin.get_instances(command='missing')
+
+
+class TestImportProfile:
+    def testNoSSHImports(self):
+        import subprocess
+        output = subprocess.check_output([
+            sys.executable, '-c',
+            'import sys, ploy, ploy.config, ploy.plain, ploy.proxy; '
+            'print(sorted(x for x in sys.modules '
+            'if x.split(".")[0] in ("paramiko", "cryptography")))'])
+        assert output.strip() == b'[]'
+
+    def testParse(self):
+        from ploy import parse_import_profile
+        assert parse_import_profile([
+            'import time: self [us] | cumulative | imported package',
+            'ploy-import-profile: ploy',
+            'import time:       100 |        100 |     attr._make',
+            'import time:        50 |        150 |   attr',
+            'import time:       200 |        350 | ploy',
+            'ploy-import-profile: plugin plain',
+            'ploy-import-profile: plugin dummy',
+            'import time:        10 |         10 | ploy_dummy']) == [
+                ('ploy', [
+                    ('attr._make', 100, 100),
+                    ('attr', 50, 150),
+                    ('ploy', 200, 350)]),
+                ('plugin plain', []),
+                ('plugin dummy', [('ploy_dummy', 10, 10)])]
+
+    @pytest.mark.skipif(sys.version_info < (3, 7), reason="needs -X importtime")
+    def testImportProfile(self, ctrl, mock):
+        with mock.patch('sys.stdout') as StdOutMock:
+            with pytest.raises(SystemExit) as e:
+                ctrl(['./bin/ploy', '--import-profile'])
+        assert e.value.code == 0
+        output = "".join(x[0][0] for x in StdOutMock.write.call_args_list)
+        lines = output.splitlines()
+        assert lines[0].startswith('ploy ')
+        assert any(x.startswith('plugin plain ') for x in lines)
+        assert not any(x.split()[0] == 'paramiko' for x in lines)
+
+
 class TestHelpCommand:
     def testCallWithNoArguments(self, ctrl, mock):
         with mock.patch('sys.stdout') as StdOutMock:
@@ -61,6 +61,13 @@ def tempdir():
     shutil.rmtree(directory)
 
 
+@pytest.fixture(autouse=True)
+def ploy_cache_dir(monkeypatch):
+    """ Disables the config cache, so tests don't depend on each other.
+    """
+    monkeypatch.setenv('PLOY_CACHE_DIR', '')
+
+
 @pytest.fixture(scope="session")
 def mock():
     try:
@@ -13,7 +13,8 @@ install_requires = [
     'lazy',
     'paramiko',
     'pluggy',
-    'ruamel.yaml']
+    'ruamel.yaml',
+    'tomli;python_version>="3.7" and python_version<"3.11"']
 
 setup(
     version=version,